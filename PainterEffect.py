@@ -4,34 +4,1576 @@ bl_info = {
     "category": "Object",
 }
 
+import argparse
 import collections
+import cProfile
+import contextlib
 import bpy
 import bmesh
+import hashlib
+import itertools
+import json
 import math
+import multiprocessing
+import numpy as np
 import os
+import sys
+import time
+
+try: # optional, speeds up the field engine's smoothing
+    import scipy.sparse
+    import scipy.sparse.linalg
+except ImportError:
+    scipy = None
 
 SHADER_NAME = "painter_brush_material"
 GEOMETRY_NAME = "painter_effect_geometry"
 CURVE_TANGENT_NAME = "Painter Effect Curve Tangent"
+BRUSH_TEXTURE_NAME = "Brush Texture"
+# stroke style that mixes every stroke image of the blend file's folder through one atlas
+ATLAS_STYLE = "ATLAS"
+ATLAS_NAME = "painter_stroke_atlas"
+# custom property of the atlas image holding its layout as JSON
+ATLAS_MANIFEST_PROPERTY = "painter_atlas"
+# styles a painter object can pick from, the first ones of the atlas
+MAX_ATLAS_STYLES = 8
+# seconds the stroke style menu trusts its folder listing before checking the folders again
+STROKE_LIBRARY_INTERVAL = 2.0
+# object custom property weighting the atlas styles, {stroke image: weight}
+STYLE_WEIGHTS_PROPERTY = "painter_style_weights"
+# unit sized stroke card instanced by every painter modifier, kept out of the scenes
+CARD_NAME = "painter_brush_card"
+BAKE_READER_NAME = "Painter Effect Bake Reader"
+BAKE_MODIFIER_NAME = "PainterBake"
+# name of the points object holding the baked strokes of an object, after the object's name
+BAKE_SUFFIX = " Painter Bake"
+BAKE_DIRECTORY = "//painter_effect_bake"
+# name of the points object binding the strokes of a deforming object to its rest surface
+BIND_SUFFIX = " Painter Binding"
+# strokes bound per stroke of the default density; the Density input of a deforming
+# object shows at most this many
+BIND_DENSITY = 2.0
+# arrays of a bake, as stored in the .npz files
+BAKE_ARRAYS = ("positions", "rotations", "scales", "normals")
 ATTRIBUTE_UVMAP = "brushUV"
-ATTRIBUTE_RANDOM = "random"
-ATTRIBUTE_NORMAL = "normal"
-ATTRIBUTE_BRIGHTNESS = "brightness"
-ATTRIBUTE_CONTRAST = "contrast"
-ATTRIBUTE_ALPHA = "alpha"
-ATTRIBUTE_GAMMA = "gamma"
+# the only per instance attribute: the rotated surface normal, with 1 + the atlas style
+# index as alpha. Alpha 0 is the object's own surface.
+ATTRIBUTE_INSTANCE = "painter_instance"
+# guide direction baked on the mesh vertices, read by the scattered points
+ATTRIBUTE_TANGENT = "painter_tangent"
+# curvature baked on the mesh vertices and on bound strokes, times the mesh size. Strokes
+# shrink from full size at 0 to CURVATURE_MIN_SCALE at CURVATURE_RANGE and beyond.
+ATTRIBUTE_CURVATURE = "painter_curvature"
+CURVATURE_RANGE = 16.0
+CURVATURE_MIN_SCALE = 0.5
+# per stroke transform on the points of a bake
+ATTRIBUTE_ROTATION = "painter_rotation"
+ATTRIBUTE_SCALE = "painter_scale"
+# binding of a stroke to a rest triangle: its corner vertices, barycentric weights, guide
+# direction in the triangle's edge basis and a random rank deciding when it is shown
+ATTRIBUTE_BIND_VERTICES = ("painter_bind_a", "painter_bind_b", "painter_bind_c")
+ATTRIBUTE_BIND_WEIGHTS = "painter_bind_weights"
+ATTRIBUTE_BIND_TANGENT = "painter_bind_tangent"
+ATTRIBUTE_BIND_RANK = "painter_bind_rank"
+# neighbour averaging passes over the baked guide directions
+TANGENT_SMOOTHING_STEPS = 2
+# object custom properties, copied from the modifier inputs by sync_look_properties and
+# read by the brush shader through instancer attribute lookups. (property, modifier panel, inputs)
+LOOK_PROPERTIES = (
+    ("painter_color_value", "Color Value", ("Hue", "Saturation", "Brightness")),
+    ("painter_color_randomness", "Color Randomness", ("Hue", "Saturation", "Brightness")),
+    ("painter_color_adjustment", "Color Adjustment", ("Brightness", "Contrast", "Transparency", "Gamma")),
+)
 
 TARGET_LINE_NUMBER = 50
+MAX_CURVE_POINTS = 200
+CURVE_TOLERANCE = 0.005
+# points per loop used to measure how well the chosen loops cover the surface
+COVERAGE_SAMPLES = 8
+# value of the 'AUTO' bezier handle type when written with foreach_set
+HANDLE_TYPE_AUTO = 1
+# field engine: how strongly the stroke direction field is smoothed, the most solver
+# iterations and the residual they stop at, and how closely a guide path's edges must follow the field (cosine)
+FIELD_SMOOTHNESS = 10.0
+FIELD_ITERATIONS = 50
+FIELD_TOLERANCE = 1e-2
+FIELD_MIN_ALIGNMENT = 0.7
+# edge loops that reach less than this share of the vertices, or are all shorter than
+# FIELD_MIN_LOOP_POINTS, are stray quads of a triangulated mesh and the field is traced instead
+FIELD_MIN_COVERAGE = 0.25
+FIELD_MIN_LOOP_POINTS = 5
+# longest wait in seconds for the next traced mesh from the worker pool before it is
+# taken for hung and the meshes are traced on the main thread
+GUIDE_WORKER_TIMEOUT = 300
+# memory and disk budget of the traced guide loop cache
+GUIDE_CACHE_BYTES = 256 * 1024 * 1024
+# .npz files of traced guide loops, next to the blend file
+GUIDE_CACHE_DIRECTORY = "//painter_effect_cache"
+
+# instance budget standing for "no limit", far above what a scene can hold
+UNLIMITED_INSTANCES = 1e12
+# custom property with the instance count of a painter object at the last budget update
+INSTANCE_COUNT_PROPERTY = "painter_effect_instances"
+# custom property with the estimated instances of a painter object at the last budget
+# update, so the panel does not sum the face areas on every redraw
+INSTANCE_ESTIMATE_PROPERTY = "painter_effect_estimate"
+# custom property with the modifier Density the estimate was made with, to notice edits
+ESTIMATE_DENSITY_PROPERTY = "painter_effect_estimate_density"
+
+# profile log and cProfile dump of the last profiled apply, next to the blend file
+PROFILE_LOG_PATH = "//painter_effect_profile.json"
+PROFILE_STATS_PATH = "//painter_effect_profile.prof"
+# profile entry for work shared by all objects of an apply
+PROFILE_SHARED_ENTRY = "(shared)"
+
+# custom property on a guide curve storing the guide loop cache key it was built from
+GUIDE_KEY_PROPERTY = "painter_effect_guide"
+# custom property with the layout version of a painter geometry node tree; bump it
+# whenever build_geometry_nodes changes so older trees are rebuilt
+GEOMETRY_VERSION_PROPERTY = "painter_effect_version"
+GEOMETRY_TREE_VERSION = 7
+# nodes of the painter geometry node tree holding per object values
+TANGENT_NODE_NAME = "Curve Tangent"
+CARD_NODE_NAME = "Brush Card"
+CARD_SIZE_NODE_NAME = "Card Size"
+OFFSET_NODE_NAME = "Brush Offset"
+MATERIAL_NODE_NAME = "Brush Material"
+POINTS_NODE_NAME = "Preview Points"
+# "Style Threshold 0" ... : random values at or above a threshold pick the next atlas style
+STYLE_NODE_NAME = "Style Threshold"
+ATLAS_COLUMNS_NODE_NAME = "Atlas Columns"
+ATLAS_ROWS_NODE_NAME = "Atlas Rows"
+
+# custom property storing the content hash of a node group built by this add-on
+NODE_SIGNATURE_PROPERTY = "painter_effect_signature"
+# layout version of the brush material, part of its key so older materials are not reused
+MATERIAL_LAYOUT_VERSION = 3
+# custom property storing the stroke style and base look a brush material was built for
+MATERIAL_KEY_PROPERTY = "painter_effect_key"
+# node properties that only change how a node is drawn in the editor
+NODE_LAYOUT_PROPERTIES = {"name", "label", "location", "width", "width_hidden", "height",
+                          "select", "show_options", "show_preview", "show_texture", "hide",
+                          "color", "use_custom_color"}
+
+# signature of the graph each node group builder produces in this session, keyed by group name
+node_group_signatures = {}
+
+
+
+def rna_value(value):
+    if isinstance(value, bpy.types.ID):
+        return value.name
+    if isinstance(value, float):
+        return round(value, 6)
+    if isinstance(value, set):
+        return tuple(sorted(value))
+    if hasattr(value, "__len__") and not isinstance(value, str):
+        return tuple(rna_value(v) for v in value)
+    return value
+
+
+
+# hash everything that affects what a node tree computes: interface, node settings,
+# unlinked socket values and links. Node positions and labels are ignored.
+def node_tree_signature(node_tree):
+    content = []
+    for item in node_tree.interface.items_tree:
+        content.append((item.item_type, item.name, getattr(item, "in_out", None),
+                        getattr(item, "socket_type", None),
+                        rna_value(getattr(item, "default_value", None)),
+                        rna_value(getattr(item, "min_value", None)),
+                        rna_value(getattr(item, "max_value", None))))
+    for node in sorted(node_tree.nodes, key=lambda n: n.name):
+        content.append((node.name, node.bl_idname))
+        for prop in node.bl_rna.properties:
+            if prop.is_readonly or prop.identifier in NODE_LAYOUT_PROPERTIES \
+                or prop.identifier.startswith("bl_") \
+                or prop.type not in {'BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM'}:
+                continue
+            content.append((prop.identifier, rna_value(getattr(node, prop.identifier))))
+        for socket in node.inputs:
+            if not socket.is_linked and hasattr(socket, "default_value"):
+                content.append((socket.identifier, rna_value(socket.default_value)))
+        # value nodes keep their value on the output, e.g. the density of legacy groups
+        if node.bl_idname == 'ShaderNodeValue':
+            content.append((node.outputs[0].identifier, rna_value(node.outputs[0].default_value)))
+        if node.bl_idname == 'GeometryNodeCaptureAttribute':
+            content.extend((item.name, item.data_type) for item in node.capture_items)
+    content.extend(sorted((link.from_node.name, link.from_socket.identifier,
+                           link.to_node.name, link.to_socket.identifier) for link in node_tree.links))
+    return hashlib.sha1(repr(content).encode()).hexdigest()
+
+
+
+# assign a socket value only when it changed, so re-applying does not trigger a re-evaluation
+def set_socket_value(socket, value):
+    if isinstance(value, float):
+        if math.isclose(socket.default_value, value, rel_tol=1e-6):
+            return
+    elif socket.default_value == value:
+        return
+    socket.default_value = value
+
+
+
+def find_node_group(signature, exclude=None):
+    for node_tree in bpy.data.node_groups:
+        if node_tree != exclude and node_tree.get(NODE_SIGNATURE_PROPERTY) == signature:
+            return node_tree
+    return None
+
+
+
+# return a node group built by build_func, reusing an existing group with identical content.
+# The graph is only built once per session to learn its signature.
+def get_shared_node_group(name, build_func):
+    signature = node_group_signatures.get(name)
+    if signature is not None:
+        node_tree = find_node_group(signature)
+        if node_tree is not None:
+            return node_tree
+
+    node_tree = build_func()
+    signature = node_tree_signature(node_tree)
+    node_group_signatures[name] = signature
+    existing = find_node_group(signature, exclude=node_tree)
+    if existing is not None:
+        bpy.data.node_groups.remove(node_tree)
+        return existing
+    node_tree[NODE_SIGNATURE_PROPERTY] = signature
+    return node_tree
+
+
+
+def is_copy_of(id_name, base_name):
+    return id_name == base_name or (id_name.startswith(base_name + ".") and id_name[len(base_name) + 1:].isdigit())
+
+
+
+# merge node groups named base_name, base_name.001, ... that have identical content
+# into one copy and remap all their users to it. Returns the number of removed groups.
+def purge_duplicate_node_groups(base_name):
+    by_signature = {}
+    for node_tree in sorted(bpy.data.node_groups, key=lambda n: n.name):
+        if not is_copy_of(node_tree.name, base_name):
+            continue
+        signature = node_tree.get(NODE_SIGNATURE_PROPERTY) or node_tree_signature(node_tree)
+        by_signature.setdefault(signature, []).append(node_tree)
+
+    removed = 0
+    for signature, node_trees in by_signature.items():
+        keep = node_trees[0]
+        keep[NODE_SIGNATURE_PROPERTY] = signature
+        for duplicate in node_trees[1:]:
+            duplicate.user_remap(keep)
+            bpy.data.node_groups.remove(duplicate)
+            removed += 1
+    return removed
+
+
+
+# the shared stroke card: a unit 3x3 grid in the XY plane with its UVs in the brushUV
+# attribute. It is not linked to any scene, the painter modifiers read it through Object Info.
+def get_brush_card():
+    card = bpy.data.objects.get(CARD_NAME)
+    if card is not None and card.type == 'MESH' and ATTRIBUTE_UVMAP in card.data.attributes:
+        return card
+
+    u, v = np.meshgrid(np.linspace(0.0, 1.0, 3), np.linspace(0.0, 1.0, 3), indexing="ij")
+    uv = np.stack([u.ravel(), v.ravel(), np.zeros(9)], axis=-1)
+    faces = [(i * 3 + j, (i + 1) * 3 + j, (i + 1) * 3 + j + 1, i * 3 + j + 1) for i in range(2) for j in range(2)]
+    mesh = bpy.data.meshes.new(CARD_NAME)
+    mesh.from_pydata((uv - (0.5, 0.5, 0.0)).tolist(), [], faces)
+    mesh.attributes.new(ATTRIBUTE_UVMAP, 'FLOAT_VECTOR', 'POINT').data.foreach_set("vector", uv.ravel())
+    mesh.update()
+    if card is not None and card.type == 'MESH':
+        card.data = mesh
+    else:
+        card = bpy.data.objects.new(CARD_NAME, mesh)
+    return card
+
+
+
+# groups written before the density became a socket have it baked into a "Default Density"
+# value node. Point their users at the shared group with the same density as socket value.
+def migrate_legacy_tangent_groups(shared_group):
+    removed = 0
+    for node_tree in list(bpy.data.node_groups):
+        if node_tree == shared_group or not is_copy_of(node_tree.name, CURVE_TANGENT_NAME) \
+            or "Default Density" in node_tree.interface.items_tree:
+            continue
+        density_node = next((n for n in node_tree.nodes if n.label == "Default Density"), None)
+        if density_node is None:
+            continue
+        density = density_node.outputs[0].default_value
+        for user_tree in bpy.data.node_groups:
+            for node in user_tree.nodes:
+                if node.bl_idname == 'GeometryNodeGroup' and node.node_tree == node_tree:
+                    node.node_tree = shared_group
+                    node.inputs["Default Density"].default_value = density
+        if node_tree.users == 0:
+            bpy.data.node_groups.remove(node_tree)
+            removed += 1
+    return removed
+
+
+
+# Ramer-Douglas-Peucker: indices of the points to keep so that the polyline deviates
+# from the original by at most tolerance
+def simplify_polyline(points, tolerance):
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.linalg.norm(segment)
+        if length > 0:
+            distances = np.linalg.norm(np.cross(offsets, segment), axis=1) / length
+        else: # closed loop, measure from the shared end point
+            distances = np.linalg.norm(offsets, axis=1)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = start + 1 + farthest
+            keep[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+    return np.flatnonzero(keep)
+
+
+
+# pick up to count loops that spread evenly over the surface: farthest point sampling
+# over a few points taken along every loop, starting from the longest loop
+def select_covering_loops(coords, loops, count):
+    if len(loops) <= count:
+        return list(range(len(loops)))
+    samples = np.stack([coords[np.asarray(loop)[np.linspace(0, len(loop) - 1, COVERAGE_SAMPLES).round().astype(np.int64)]]
+                        for loop in loops])
+    flat_samples = samples.reshape(-1, 3)
+    gap = np.full(flat_samples.shape[0], np.inf)
+    chosen = [max(range(len(loops)), key=lambda i: len(loops[i]))]
+    while len(chosen) < count:
+        last = samples[chosen[-1]]
+        distances = np.linalg.norm(flat_samples[:, None, :] - last[None, :, :], axis=2).min(axis=1)
+        gap = np.minimum(gap, distances)
+        coverage_gap = gap.reshape(len(loops), COVERAGE_SAMPLES).mean(axis=1)
+        next_loop = int(np.argmax(coverage_gap))
+        if coverage_gap[next_loop] <= 0:
+            break
+        chosen.append(next_loop)
+    return sorted(chosen)
+
+
+
+# level of detail for the guide: keep count loops that cover the surface and thin each
+# one out within tolerance, so the guide size follows the object's shape rather than
+# its vertex count
+def simplify_surface_loops(coords, spline_points, count, tolerance, max_points):
+    guide_loops = []
+    for i in select_covering_loops(coords, spline_points, count):
+        loop = np.asarray(spline_points[i], dtype=np.int64)
+        kept = simplify_polyline(coords[loop].astype(np.float64), tolerance)
+        if len(kept) > max_points:
+            kept = kept[np.linspace(0, len(kept) - 1, max_points).round().astype(np.int64)]
+        guide_loops.append(loop[kept].tolist())
+    return guide_loops
+
+
+
+# walk outwards from the seed edges: trace the edge loop through every reached edge
+# and queue the edges across its quads. find_edge_loops and find_neighboring_edge
+# come from either the ObjectPainterEffect BMesh methods or a MeshTopology. counters,
+# when given, receives the number of loops traced and edges visited.
+def collect_surface_loops(seeds, find_edge_loops, find_neighboring_edge, counters=None):
+    spline_points = []
+    visited_edge = set() # searched for edge loop
+    expanded_edge = set() # expanded to neighbors
+    used_points = set() 
+    edge_queue = collections.deque(seeds)
+    while len(edge_queue) > 0:
+        top = edge_queue.popleft()
+        if top in expanded_edge:
+            continue
+        if top not in visited_edge:
+            curr_verts = find_edge_loops(top, visited_edge, used_points, edge_queue)
+            if len(curr_verts) >= 3:
+                spline_points.append(curr_verts)
+                used_points.update(curr_verts)
+        neighbors = find_neighboring_edge(top)
+        edge_queue.extend(neighbors)
+        expanded_edge.add(top)
+    if counters is not None:
+        counters["loops traced"] = len(spline_points)
+        counters["edges visited"] = len(expanded_edge)
+    return spline_points
+
+
+
+# whether the edge loops from collect_surface_loops are enough to orient the strokes of
+# a mesh with vert_count vertices, see FIELD_MIN_COVERAGE
+def loops_cover_surface(spline_points, vert_count):
+    if not spline_points or max(len(points) for points in spline_points) < FIELD_MIN_LOOP_POINTS:
+        return False
+    covered = np.unique(np.concatenate([np.asarray(points, dtype=np.int64) for points in spline_points]))
+    return len(covered) >= FIELD_MIN_COVERAGE * vert_count
+
+
+
+# guide loops and tracing counters for one mesh from plain arrays, without touching bpy
+# so it can run in a worker process. job is (mesh arrays from MeshTopology.read_mesh,
+# vertex coordinates, curve count, tolerance, max points per curve).
+def trace_guide_loops(job):
+    mesh_arrays, coords, count, tolerance, max_points = job
+    topology = MeshTopology(*mesh_arrays)
+    counters = {}
+    spline_points = collect_surface_loops(
+        topology.find_first_loop(), topology.find_edge_loops, topology.find_neighboring_edge, counters)
+    if not loops_cover_surface(spline_points, mesh_arrays[4]): # e.g. triangulated scans
+        return trace_field_loops(job)
+    return simplify_surface_loops(coords, spline_points, count, tolerance, max_points), counters
+
+
+
+# guide loops for one mesh from a smooth direction field instead of its edge loops, so any
+# topology gets oriented strokes. Takes and returns the same as trace_guide_loops.
+def trace_field_loops(job):
+    mesh_arrays, coords, count, tolerance, max_points = job
+    loop_verts, loop_edges, poly_sizes, edge_verts, vert_count = mesh_arrays
+    coords = np.asarray(coords, dtype=np.float64)
+    adjacency = vertex_adjacency(edge_verts, len(coords))
+    directions = surface_direction_field(coords, fan_triangles(loop_verts, poly_sizes), adjacency)
+    spline_points = integrate_direction_field(coords, adjacency, directions)
+    counters = {"loops traced": len(spline_points), "field vertices": int(sum(len(path) for path in spline_points))}
+    return simplify_surface_loops(coords, spline_points, count, tolerance, max_points), counters
+
+
+
+# polygons split into triangle fans, as vertex index triples
+def fan_triangles(loop_verts, poly_sizes):
+    loop_verts = np.asarray(loop_verts, dtype=np.int64)
+    poly_sizes = np.asarray(poly_sizes, dtype=np.int64)
+    poly_starts = np.cumsum(poly_sizes) - poly_sizes
+    fans = np.maximum(poly_sizes - 2, 0)
+    starts = np.repeat(poly_starts, fans)
+    offsets = np.arange(fans.sum()) - np.repeat(np.cumsum(fans) - fans, fans) + 1
+    return np.stack([loop_verts[starts], loop_verts[starts + offsets], loop_verts[starts + offsets + 1]], axis=-1)
+
+
+
+# direction of strongest bending at every vertex, as a line field in the tangent plane.
+# Along each edge the normal turns by curvature times length; the edge directions weighted
+# by that squared are summed as outer products, so opposite directions agree, smoothed
+# over the mesh and projected on the tangent plane. Flat parts follow the main axis of
+# the mesh.
+def surface_direction_field(coords, triangles, adjacency, smoothness=FIELD_SMOOTHNESS, iterations=FIELD_ITERATIONS):
+    vert_count = len(coords)
+    normals = vertex_normals(coords, triangles)
+
+    indptr, targets = adjacency
+    sources = np.repeat(np.arange(vert_count), np.diff(indptr))
+    edges = coords[targets] - coords[sources]
+    lengths = np.maximum(np.linalg.norm(edges, axis=1), 1e-12)
+    bending = np.einsum("ij,ij->i", normals[targets] - normals[sources], edges) / lengths ** 2
+    units = edges / lengths[:, None]
+    # the tensors are symmetric, only their upper triangle is summed and smoothed
+    rows, columns = np.triu_indices(3)
+    entries = scatter_sum(sources, (bending ** 2)[:, None] * units[:, rows] * units[:, columns], vert_count)
+    entries = smooth_vertex_values(entries, adjacency, smoothness, iterations)
+    tensors = np.empty((vert_count, 3, 3))
+    tensors[:, rows, columns] = entries
+    tensors[:, columns, rows] = entries
+    centered = coords - coords.mean(axis=0)
+    axis = np.linalg.eigh(centered.T @ centered)[1][:, 2]
+    scale = max(float(np.trace(tensors, axis1=1, axis2=2).mean()), 1e-12)
+    tensors += 1e-3 * scale * np.outer(axis, axis)
+
+    projection = np.eye(3) - normals[:, :, None] * normals[:, None, :]
+    return principal_directions(projection @ tensors @ projection)
+
+
+
+# area weighted vertex normals of a triangle mesh
+def vertex_normals(coords, triangles):
+    face_normals = np.cross(coords[triangles[:, 1]] - coords[triangles[:, 0]], coords[triangles[:, 2]] - coords[triangles[:, 0]])
+    normals = scatter_sum(triangles.ravel(), np.repeat(face_normals, 3, axis=0), len(coords))
+    return normals / np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+
+
+
+# curvature at every vertex: how fast the normal turns along its edges, averaged over
+# them, times size so it does not depend on the mesh's scale
+def vertex_curvature(coords, triangles, edge_verts, size):
+    coords = np.asarray(coords, dtype=np.float64)
+    edge_verts = np.asarray(edge_verts, dtype=np.int64).reshape(-1, 2)
+    normals = vertex_normals(coords, np.asarray(triangles, dtype=np.int64).reshape(-1, 3))
+    lengths = np.maximum(np.linalg.norm(coords[edge_verts[:, 1]] - coords[edge_verts[:, 0]], axis=1), 1e-12)
+    turns = np.linalg.norm(normals[edge_verts[:, 1]] - normals[edge_verts[:, 0]], axis=1) / lengths
+    vert_count = len(coords)
+    degree = np.maximum(np.bincount(edge_verts.ravel(), minlength=vert_count), 1)
+    return np.bincount(edge_verts.ravel(), np.repeat(turns, 2), minlength=vert_count) / degree * size
+
+
+
+# values per vertex smoothed over the edges of a vertex_adjacency: the solution of
+# (I + smoothness L) x = values for the graph Laplacian L, by conjugate gradients with the
+# diagonal as preconditioner, all columns at once. Stops at FIELD_TOLERANCE relative
+# residual or after iterations steps; scipy only speeds up the neighbour sums.
+def smooth_vertex_values(values, adjacency, smoothness, iterations, tolerance=FIELD_TOLERANCE):
+    indptr, indices = adjacency
+    if len(indices) == 0:
+        return values.copy()
+    # single precision is plenty for a smoothed field and halves the memory traffic
+    values = values.astype(np.float32)
+    degree = np.diff(indptr).astype(np.float32)
+    diagonal = (1.0 + smoothness * degree)[:, None]
+    if scipy is not None:
+        matrix = scipy.sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                                         shape=(len(values), len(values)))
+        neighbour_sum = matrix.dot
+    else:
+        starts = np.minimum(indptr[:-1], len(indices) - 1)
+        isolated = np.flatnonzero(degree == 0)
+        def neighbour_sum(x):
+            sums = np.add.reduceat(x[indices], starts, axis=0)
+            sums[isolated] = 0.0
+            return sums
+
+    smoothed = values.copy()
+    residual = values - (diagonal * smoothed - smoothness * neighbour_sum(smoothed))
+    target = (tolerance * np.linalg.norm(values, axis=0)) ** 2
+    preconditioned = residual / diagonal
+    direction = preconditioned.copy()
+    product = (residual * preconditioned).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for _ in range(iterations):
+            if ((residual ** 2).sum(axis=0) <= target).all():
+                break
+            image = diagonal * direction - smoothness * neighbour_sum(direction)
+            curvature = (direction * image).sum(axis=0)
+            step = np.where(curvature > 0, product / curvature, 0.0)
+            smoothed += step * direction
+            residual -= step * image
+            preconditioned = residual / diagonal
+            next_product = (residual * preconditioned).sum(axis=0)
+            direction = preconditioned + np.where(product > 0, next_product / product, 0.0) * direction
+            product = next_product
+    return smoothed
+
+
+
+# guide paths along the edges that follow a line field, in the spline points layout of
+# collect_surface_loops. Every vertex first gets its best aligned edge each way; walks
+# then start from every vertex not yet on a path and go both ways until the field turns
+# away from the edges or they reach another path.
+def integrate_direction_field(coords, adjacency, directions, min_alignment=FIELD_MIN_ALIGNMENT):
+    vert_count = len(coords)
+    indptr, targets = adjacency
+    sources = np.repeat(np.arange(vert_count), np.diff(indptr))
+    edges = coords[targets] - coords[sources]
+    units = edges / np.maximum(np.linalg.norm(edges, axis=1, keepdims=True), 1e-12)
+    alignment = np.einsum("ij,ij->i", units, directions[sources])
+    # the field's sign at the next vertex that keeps the walk going the same way
+    heading = np.where(np.einsum("ij,ij->i", units, directions[targets]) >= 0, 1, -1)
+
+    # the edges are grouped by their source vertex, so each vertex's best edge is the
+    # maximum of its group
+    starts = np.minimum(indptr[:-1], max(len(targets) - 1, 0))
+    steps = []
+    for sign in (1, -1):
+        next_vert = np.full(vert_count, -1, dtype=np.int64)
+        next_heading = np.zeros(vert_count, dtype=np.int64)
+        if len(targets):
+            score = sign * alignment
+            best = np.flatnonzero((score == np.maximum.reduceat(score, starts)[sources]) & (score >= min_alignment))
+            next_vert[sources[best]] = targets[best]
+            next_heading[sources[best]] = heading[best] * sign
+        steps.append((next_vert.tolist(), next_heading.tolist()))
+
+    used = [False] * vert_count
+    paths = []
+    for seed in np.random.default_rng(0).permutation(vert_count).tolist():
+        if used[seed]:
+            continue
+        used[seed] = True
+        halves = []
+        for start_heading in (1, -1):
+            half = []
+            vert, way = seed, start_heading
+            while True:
+                next_vert, next_heading = steps[0] if way > 0 else steps[1]
+                following = next_vert[vert]
+                if following < 0 or used[following]:
+                    break
+                used[following] = True
+                half.append(following)
+                way = next_heading[vert] * way
+                vert = following
+            halves.append(half)
+        path = halves[1][::-1] + [seed] + halves[0]
+        if len(path) >= 3:
+            paths.append(path)
+    return paths
+
+
+
+# count stroke positions on the triangles of a rest mesh, uniform by area, as triangle
+# corner vertices and barycentric weights. The guide direction at each position, from
+# the per vertex tangents, is kept as coefficients of the triangle edges b - a and c - a
+# so it follows the triangle when the mesh deforms. The same input binds the same points.
+def bind_surface_points(coords, triangles, tangents, count, seed=0):
+    coords = np.asarray(coords, dtype=np.float64)
+    triangles = np.asarray(triangles, dtype=np.int64).reshape(-1, 3)
+    tangents = np.asarray(tangents, dtype=np.float64)
+    corners = coords[triangles]
+    areas = 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+    if count <= 0 or areas.sum() <= 0:
+        count = 0
+
+    rng = np.random.default_rng(seed)
+    cumulative = np.cumsum(areas)
+    picked = np.minimum(np.searchsorted(cumulative, rng.random(count) * cumulative[-1] if count else []), len(triangles) - 1)
+    r1 = np.sqrt(rng.random(count))
+    r2 = rng.random(count)
+    weights = np.stack([1.0 - r1, r1 * (1.0 - r2), r1 * r2], axis=-1)
+
+    vertices = triangles[picked]
+    tangent = np.einsum("ij,ijk->ik", weights, tangents[vertices])
+    edge_b = coords[vertices[:, 1]] - coords[vertices[:, 0]]
+    edge_c = coords[vertices[:, 2]] - coords[vertices[:, 0]]
+    bb = np.einsum("ij,ij->i", edge_b, edge_b)
+    bc = np.einsum("ij,ij->i", edge_b, edge_c)
+    cc = np.einsum("ij,ij->i", edge_c, edge_c)
+    tb = np.einsum("ij,ij->i", edge_b, tangent)
+    tc = np.einsum("ij,ij->i", edge_c, tangent)
+    determinant = np.maximum(bb * cc - bc * bc, 1e-20)
+    coefficients = np.stack([(cc * tb - bc * tc) / determinant, (bb * tc - bc * tb) / determinant,
+                             np.zeros(count)], axis=-1)
+    return {"positions": np.einsum("ij,ijk->ik", weights, coords[vertices]), "vertices": vertices,
+            "weights": weights, "tangents": coefficients, "ranks": rng.random(count)}
+
+
+
+# principal direction of each 3x3 direction tensor, zero where the tensor is empty
+def principal_directions(tensors):
+    directions = np.linalg.eigh(tensors)[1][:, :, 2]
+    directions[~tensors.any(axis=(1, 2))] = 0.0
+    return directions
+
+
+
+# sum the rows of values by index into count rows
+def scatter_sum(index, values, count):
+    flat = values.reshape(len(values), -1)
+    summed = np.stack([np.bincount(index, flat[:, i], minlength=count) for i in range(flat.shape[1])], axis=-1)
+    return summed.reshape((count,) + values.shape[1:])
+
+
+
+# guide direction at every vertex: along the guide loops at their vertices, spread over
+# the edges to the rest of the mesh and smoothed. Directions are lines rather than
+# vectors, so they are averaged as outer products; a last walk over the edges flips
+# them to agree with their neighbours, so interpolating across a face does not cancel out.
+# Parts of the mesh no guide loop reaches start from the direction at the nearest guide
+# loop vertex, or from the main axis of the mesh when there are no guide loops.
+def bake_guide_tangents(coords, edge_verts, guide_loops, smoothing=TANGENT_SMOOTHING_STEPS):
+    coords = np.asarray(coords, dtype=np.float64)
+    edge_verts = np.asarray(edge_verts, dtype=np.int64).reshape(-1, 2)
+    vert_count = len(coords)
+    sources = np.concatenate([edge_verts[:, 0], edge_verts[:, 1]])
+    targets = np.concatenate([edge_verts[:, 1], edge_verts[:, 0]])
+
+    tensors = np.zeros((vert_count, 3, 3))
+    for loop in guide_loops:
+        if len(loop) < 2:
+            continue
+        loop = np.asarray(loop, dtype=np.int64)
+        steps = np.gradient(coords[loop], axis=0)
+        steps /= np.maximum(np.linalg.norm(steps, axis=1, keepdims=True), 1e-12)
+        tensors += scatter_sum(loop, steps[:, :, None] * steps[:, None, :], vert_count)
+    directions = principal_directions(tensors)
+
+    # each vertex also remembers the guide loop its direction came from, to find the
+    # loops that share a connected part
+    parts = list(range(len(guide_loops)))
+    def find(i):
+        while parts[i] != i:
+            parts[i] = parts[parts[i]]
+            i = parts[i]
+        return i
+    def join(a, b):
+        a, b = find(a), find(b)
+        parts[max(a, b)] = min(a, b)
+    origin = np.full(vert_count, -1, dtype=np.int64)
+    for i, loop in enumerate(guide_loops):
+        if len(loop) < 2:
+            continue
+        loop = np.asarray(loop, dtype=np.int64)
+        for crossed in np.unique(origin[loop]).tolist():
+            if crossed >= 0:
+                join(i, crossed)
+        origin[loop] = i
+    adjacency = vertex_adjacency(edge_verts, vert_count)
+    assigned = directions.any(axis=1)
+    guided = np.flatnonzero(assigned)
+    def spread(seeds):
+        for parents, inverse, reached, first in breadth_first_layers(adjacency, seeds, assigned):
+            parent_directions = directions[parents]
+            tensors = scatter_sum(inverse, parent_directions[:, :, None] * parent_directions[:, None, :], len(reached))
+            directions[reached] = principal_directions(tensors)
+            origin[reached] = origin[parents[first]]
+    spread(guided)
+
+    island_roots = []
+    if not assigned.all():
+        if len(guided):
+            nearest = lambda verts: directions[guided[np.argmin(
+                np.linalg.norm(coords[verts, None] - coords[guided], axis=-1), axis=1)]]
+        else:
+            centered = coords - coords.mean(axis=0)
+            axis = np.linalg.eigh(centered.T @ centered)[1][:, 2]
+            nearest = lambda verts: np.broadcast_to(axis, (len(verts), 3))
+        # loose vertices at once, then one part at a time from its first vertex
+        loose = np.flatnonzero(~assigned & (np.diff(adjacency[0]) == 0))
+        for start in range(0, len(loose), 1024):
+            chunk = loose[start:start + 1024]
+            directions[chunk] = nearest(chunk)
+        assigned[loose] = True
+        while not assigned.all():
+            seed = np.argmin(assigned)
+            directions[seed] = nearest([seed])[0]
+            assigned[seed] = True
+            island_roots.append(seed)
+            spread([seed])
+
+    for _ in range(smoothing):
+        outer = directions[:, :, None] * directions[:, None, :]
+        directions = principal_directions(outer + scatter_sum(targets, outer[sources], vert_count))
+
+    # flip each vertex to agree with the neighbour it is reached from, starting at one
+    # guide loop of every connected part, or its first vertex when it has no guide loop
+    meeting = (origin[sources] >= 0) & (origin[targets] >= 0) & (origin[sources] != origin[targets])
+    for a, b in np.unique(np.sort(np.stack([origin[sources[meeting]], origin[targets[meeting]]], axis=-1), axis=1), axis=0).tolist():
+        join(a, b)
+    roots = np.array([guide_loops[i][0] for i in range(len(guide_loops))
+                      if find(i) == i and len(guide_loops[i]) >= 2] + island_roots, dtype=np.int64)
+    visited = np.zeros(vert_count, dtype=bool)
+    visited[roots] = True
+    for parents, _, reached, first in breadth_first_layers(adjacency, roots, visited):
+        flip = np.einsum("ij,ij->i", directions[parents[first]], directions[reached]) < 0
+        directions[reached[flip]] *= -1
+    return directions.astype(np.float32)
+
+
+
+# the edges of a mesh as compressed rows: the neighbours of vertex v are
+# indices[indptr[v]:indptr[v + 1]]
+def vertex_adjacency(edge_verts, vert_count):
+    edge_verts = np.asarray(edge_verts, dtype=np.int64).reshape(-1, 2)
+    sources = np.concatenate([edge_verts[:, 0], edge_verts[:, 1]])
+    targets = np.concatenate([edge_verts[:, 1], edge_verts[:, 0]])
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(vert_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=vert_count), out=indptr[1:])
+    return indptr, targets[order]
+
+
+
+# breadth first search over a vertex_adjacency from seeds, one layer at a time, marking
+# the vertices in visited. Every layer gives the edges into it as parent vertices and the
+# index into reached of their ends, the newly reached vertices, and the first edge of each.
+# Each edge is looked at once, so a long thin mesh costs no more than a compact one.
+def breadth_first_layers(adjacency, seeds, visited):
+    indptr, indices = adjacency
+    frontier = np.asarray(seeds, dtype=np.int64)
+    while len(frontier):
+        counts = indptr[frontier + 1] - indptr[frontier]
+        offsets = np.arange(counts.sum()) + np.repeat(indptr[frontier] - (np.cumsum(counts) - counts), counts)
+        parents = np.repeat(frontier, counts)
+        children = indices[offsets]
+        fresh = ~visited[children]
+        parents, children = parents[fresh], children[fresh]
+        if len(children) == 0:
+            return
+        reached, first, inverse = np.unique(children, return_index=True, return_inverse=True)
+        visited[reached] = True
+        yield parents, inverse, reached, first
+        frontier = reached
+
+
+
+# traced guide loops by mesh hash, least recently used first. A loop set is stored as one
+# flat vertex index array and the loop sizes, the layout of the .npz files on disk.
+class GuideLoopCache:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+
+    # hash of everything the guide loops depend on: the index arrays and vertex count from
+    # MeshTopology.read_mesh, the vertex coordinates picking and simplifying the loops,
+    # and the engine and level of detail settings
+    @staticmethod
+    def key(mesh_arrays, coords, settings):
+        digest = hashlib.blake2b(digest_size=16)
+        for array in (*mesh_arrays[:4], coords):
+            array = np.ascontiguousarray(array)
+            digest.update(repr((array.dtype.str, array.shape)).encode())
+            digest.update(array)
+        digest.update(repr((mesh_arrays[4], settings)).encode())
+        return digest.hexdigest()
+
+
+    # the loops stored under key, from memory or else from directory; None on a miss
+    def get(self, key, directory=None):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif directory is not None:
+            path = os.path.join(directory, key + ".npz")
+            if not os.path.exists(path):
+                return None
+            try:
+                with np.load(path) as data:
+                    entry = (data["points"], data["sizes"])
+            except (OSError, ValueError, KeyError) as error:
+                print("Painter Effect: ignoring cache file", path, error)
+                return None
+            os.utime(path)
+            self.store(key, entry)
+        else:
+            return None
+        points, sizes = entry
+        if len(sizes) == 0:
+            return []
+        return [loop.tolist() for loop in np.split(points, np.cumsum(sizes)[:-1])]
+
+
+    def put(self, key, loops, directory=None):
+        sizes = np.array([len(loop) for loop in loops], dtype=np.int32)
+        points = np.fromiter(itertools.chain.from_iterable(loops), dtype=np.int32, count=int(sizes.sum()))
+        self.store(key, (points, sizes))
+        if directory is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                np.savez_compressed(os.path.join(directory, key + ".npz"), points=points, sizes=sizes)
+                self.prune_directory(directory)
+            except OSError as error:
+                print("Painter Effect: cannot write guide cache,", error)
+
+
+    def store(self, key, entry):
+        if key in self.entries:
+            self.size -= sum(a.nbytes for a in self.entries.pop(key))
+        self.entries[key] = entry
+        self.size += sum(a.nbytes for a in entry)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= sum(a.nbytes for a in evicted)
+
+
+    # remove the least recently used files until the directory fits the budget
+    def prune_directory(self, directory):
+        files = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".npz"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files[:-1]:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
 
 
-    
-class ObjectPainterEffect(bpy.types.Operator):
-    """Object Cursor Array"""
-    bl_idname = "object.painter_effect"
-    bl_label = "Painter Effect"
-    bl_options = {'REGISTER', 'UNDO'}
+guide_loop_cache = GuideLoopCache(GUIDE_CACHE_BYTES)
+
+
+
+# wall-clock time per stage and counters, per object, of one apply. Work that is not tied
+# to one object, like shared node groups or the tracing pool, goes to PROFILE_SHARED_ENTRY.
+class PainterProfile:
+
+    def __init__(self):
+        self.objects = {}
+        self.cprofile = None
+
+
+    def entry(self, name):
+        return self.objects.setdefault(name or PROFILE_SHARED_ENTRY, {"stages": {}, "counters": {}})
+
+
+    @contextlib.contextmanager
+    def stage(self, stage, name=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = self.entry(name)["stages"]
+            stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - start
+
+
+    def count(self, counter, amount=1, name=None):
+        counters = self.entry(name)["counters"]
+        counters[counter] = counters.get(counter, 0) + amount
+
+
+    # stage times and counters summed over all entries
+    def totals(self):
+        stages, counters = {}, {}
+        for entry in self.objects.values():
+            for stage, seconds in entry["stages"].items():
+                stages[stage] = stages.get(stage, 0.0) + seconds
+            for counter, amount in entry["counters"].items():
+                counters[counter] = counters.get(counter, 0) + amount
+        return {"stages": stages, "counters": counters}
+
+
+    def summary(self):
+        totals = self.totals()
+        seconds = sum(totals["stages"].values())
+        slowest = max(totals["stages"].items(), key=lambda item: item[1], default=("none", 0.0))
+        return (f"{len(self.objects) - (PROFILE_SHARED_ENTRY in self.objects)} objects in {seconds:.2f}s, "
+                f"slowest stage {slowest[0]} {slowest[1]:.2f}s")
+
+
+    def lines(self):
+        totals = self.totals()
+        return ([f"{stage:<24} {seconds:8.3f}s" for stage, seconds in totals["stages"].items()]
+                + [f"{counter:<24} {amount:>9}" for counter, amount in totals["counters"].items()])
+
+
+    def write(self, path):
+        with open(path, "w") as file:
+            json.dump({"totals": self.totals(), "objects": self.objects}, file, indent=2)
+
+
+# profile of the last profiled apply in this session, shown in the sidebar
+last_profile = None
+
+
+
+# the painter geometry nodes modifier of obj, None if the effect was never applied
+def get_painter_modifier(obj):
+    modifier = obj.modifiers.get("GeometryNodes")
+    if modifier is None or modifier.type != 'NODES' or modifier.node_group is None \
+            or TANGENT_NODE_NAME not in modifier.node_group.nodes:
+        return None
+    return modifier
+
+
+
+# instances the painter modifier of obj will produce before the budget: surface area
+# times the default density times the modifier's Density
+def estimate_instances(obj):
+    modifier = get_painter_modifier(obj)
+    if modifier is None or obj.type != 'MESH':
+        return 0.0
+    areas = np.empty(len(obj.data.polygons), dtype=np.float32)
+    obj.data.polygons.foreach_get("area", areas)
+    default_density = modifier.node_group.nodes[TANGENT_NODE_NAME].inputs["Default Density"].default_value
+    return float(areas.sum()) * default_density * get_modifier_density(modifier)
+
+
+
+# the Density input of a painter modifier
+def get_modifier_density(modifier):
+    density_socket = find_input_socket(modifier.node_group, "Density")
+    return float(modifier.get(density_socket.identifier, 1.0)) if density_socket is not None else 1.0
+
+
+
+# give every painter object in scene its instance budget: the object's own maximum, and a
+# share of scene_budget in proportion to its estimated instances. The tangent group lowers
+# the density wherever the estimate is above the budget. The estimates are kept on the
+# objects for the panel. Returns the estimated total.
+def update_instance_budgets(scene, scene_budget):
+    estimates = {obj: estimate_instances(obj) for obj in scene.objects if get_painter_modifier(obj) is not None}
+    total = sum(estimates.values())
+    for obj, estimate in estimates.items():
+        if obj.get(INSTANCE_ESTIMATE_PROPERTY) != estimate:
+            obj[INSTANCE_ESTIMATE_PROPERTY] = estimate
+        density = get_modifier_density(get_painter_modifier(obj))
+        if obj.get(ESTIMATE_DENSITY_PROPERTY) != density:
+            obj[ESTIMATE_DENSITY_PROPERTY] = density
+        budget = getattr(obj, "painter_max_instances", 0) or UNLIMITED_INSTANCES
+        if scene_budget > 0 and total > 0:
+            budget = min(budget, scene_budget * estimate / total)
+        tangent_transfer = get_painter_modifier(obj).node_group.nodes[TANGENT_NODE_NAME]
+        if "Instance Budget" in tangent_transfer.inputs:
+            set_socket_value(tangent_transfer.inputs["Instance Budget"], float(budget))
+    return total
+
+
+
+# turn the camera culling of obj's painter modifier on or off. The modifier points at a
+# camera only while culling is on, as the camera input re-evaluates the strokes on every
+# camera move; turning it on keeps a camera picked before, else takes camera. enabled
+# None keeps the modifier's setting.
+def set_camera_culling(obj, enabled, camera):
+    modifier = get_painter_modifier(obj)
+    if modifier is None:
+        return
+    culling = find_input_socket(modifier.node_group, "Camera Culling")
+    camera_socket = find_input_socket(modifier.node_group, "Camera")
+    if culling is None or camera_socket is None:
+        return
+    if enabled is None:
+        enabled = bool(modifier[culling.identifier])
+    modifier[culling.identifier] = enabled
+    if not enabled:
+        modifier[camera_socket.identifier] = None
+    elif modifier[camera_socket.identifier] is None:
+        modifier[camera_socket.identifier] = camera
+    obj.update_tag()
+
+
+
+# copy the uniform look inputs of obj's painter modifier into the object properties the
+# brush shader reads, see LOOK_PROPERTIES, instead of storing them on every instance.
+# Returns whether any changed.
+def sync_look_properties(obj):
+    modifier = get_painter_modifier(obj)
+    if modifier is None:
+        return False
+    sockets = {(item.parent.name, item.name): item.identifier for item in modifier.node_group.interface.items_tree
+               if item.item_type == 'SOCKET' and item.in_out == 'INPUT'}
+    changed = False
+    for prop, panel, names in LOOK_PROPERTIES:
+        if any((panel, name) not in sockets for name in names):
+            continue
+        values = [float(modifier[sockets[(panel, name)]]) for name in names]
+        if prop not in obj or list(obj[prop]) != values:
+            obj[prop] = values
+            changed = True
+    if changed:
+        obj.update_tag()
+    return changed
+
+
+
+# instance count per painter object name in an evaluated depsgraph
+def count_painter_instances(depsgraph):
+    return collections.Counter(instance.parent.original.name for instance in depsgraph.object_instances
+                               if instance.is_instance and instance.parent is not None)
+
+
+
+# stroke images by name, from the blend file's folder and the extra folders of the add-on
+# preferences; the first folder wins for a name. A folder is listed again only when its
+# modification time changes, and the stroke images are looked up once per file. The enum
+# items stay referenced here, which Blender requires of dynamic enums.
+class StrokeLibrary:
+
+    def __init__(self):
+        self.listings = {} # folder -> (modification time, stroke file names)
+        self.folders = ()
+        self.paths = {}
+        self.images = {}
+        self.enum_items = [("None", "None", "No images found")]
+        self.checked = -math.inf
+
+
+    # check the folders for changes, at most every STROKE_LIBRARY_INTERVAL seconds unless forced
+    def refresh(self, folders, force=False):
+        folders = tuple(folders)
+        if not force and folders == self.folders and time.monotonic() - self.checked < STROKE_LIBRARY_INTERVAL:
+            return
+        self.checked = time.monotonic()
+        changed = folders != self.folders
+        for folder in folders:
+            try:
+                mtime = os.stat(folder).st_mtime
+            except OSError:
+                mtime = None
+            listing = self.listings.get(folder)
+            if listing is None or listing[0] != mtime:
+                try:
+                    files = sorted(f for f in os.listdir(folder) if f.lower().endswith(".png"))
+                except OSError:
+                    files = []
+                self.listings[folder] = (mtime, files)
+                changed = True
+        if not changed:
+            return
+
+        self.folders = folders
+        self.paths = {}
+        for folder in folders:
+            for file in self.listings[folder][1]:
+                self.paths.setdefault(file, os.path.join(folder, file))
+        items = [(name, name, f"Use {name} as stroke style") for name in self.paths]
+        if len(items) > 1:
+            items.insert(0, (ATLAS_STYLE, "Atlas", "Mix all stroke images through one atlas texture, weighted by each object's painter_style_weights"))
+        self.enum_items = items or [("None", "None", "No images found")]
+
+
+    # file of the stroke image name from the last listing, None when no folder has it
+    def resolve(self, name):
+        return self.paths.get(name)
+
+
+    # the stroke image called name, loaded on first use
+    def image(self, name):
+        path = self.resolve(name)
+        if path is None:
+            return None
+        image = self.images.get(path)
+        try:
+            if image is not None and image.name:
+                return image
+        except ReferenceError: # removed from the blend data since
+            pass
+        image = bpy.data.images.load(path, check_existing=True)
+        self.images[path] = image
+        return image
+
+
+    # identifies the listed stroke files, to tell whether an atlas is up to date
+    def key(self):
+        return repr((list(self.paths.values()), [self.listings[folder][0] for folder in self.folders]))
+
+
+stroke_library = StrokeLibrary()
+
+
+
+# the blend file's folder, when saved, and the extra stroke folders of the preferences
+def get_stroke_folders():
+    folders = [os.path.dirname(bpy.data.filepath)] if bpy.data.filepath else []
+    addon = bpy.context.preferences.addons.get(__name__)
+    if addon is not None:
+        folders.extend(bpy.path.abspath(folder.strip()) for folder in addon.preferences.stroke_folders.split(";")
+                       if folder.strip())
+    return folders
+
+
+
+# pack the stroke images of library into one image: square tiles of the largest stroke
+# size, the first stroke at the bottom left, then row by row. The layout and the stroke
+# names go to the manifest property; an atlas of an unchanged library is reused. None
+# when there are no stroke images. Called once per apply, after the library refresh.
+def build_stroke_atlas(library):
+    files = list(library.paths)[:MAX_ATLAS_STYLES]
+    if not files:
+        return None
+    # the folder times miss strokes edited in place, so the few atlas files are checked too
+    mtimes = []
+    for f in files:
+        try:
+            mtimes.append(os.stat(library.paths[f]).st_mtime)
+        except OSError:
+            mtimes.append(None)
+    key = repr((library.key(), mtimes))
+    atlas = bpy.data.images.get(ATLAS_NAME)
+    if atlas is not None and json.loads(atlas.get(ATLAS_MANIFEST_PROPERTY, "{}")).get("key") == key:
+        return atlas
+
+    images = [library.image(f) for f in files]
+    if atlas is not None: # pick up strokes edited since they were loaded
+        for image in images:
+            image.reload()
+    tile = max(max(image.size) for image in images)
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    pixels = np.zeros((rows * tile, columns * tile, 4), dtype=np.float32)
+    for i, image in enumerate(images):
+        width, height = image.size
+        data = np.empty(width * height * 4, dtype=np.float32)
+        image.pixels.foreach_get(data)
+        # nearest neighbour scaling of smaller strokes to the tile
+        data = data.reshape(height, width, 4)[np.arange(tile) * height // tile][:, np.arange(tile) * width // tile]
+        row, column = divmod(i, columns)
+        pixels[row * tile:(row + 1) * tile, column * tile:(column + 1) * tile] = data
+
+    if atlas is None:
+        atlas = bpy.data.images.new(ATLAS_NAME, columns * tile, rows * tile, alpha=True)
+    elif tuple(atlas.size) != (columns * tile, rows * tile):
+        atlas.scale(columns * tile, rows * tile)
+    atlas.pixels.foreach_set(pixels.ravel())
+    atlas.pack()
+    atlas[ATLAS_MANIFEST_PROPERTY] = json.dumps({"key": key, "columns": columns, "rows": rows, "styles": files})
+    return atlas
+
+
+
+# thresholds of the Style Threshold nodes for weights {style: weight} over the atlas
+# styles: the cumulative share of all but the last style. Unused ones are never reached.
+def style_thresholds(styles, weights):
+    thresholds = np.full(MAX_ATLAS_STYLES - 1, 2.0)
+    if len(styles) > 1:
+        values = np.array([max(float(weights.get(style, 0.0)), 0.0) for style in styles])
+        if values.sum() <= 0:
+            values = np.ones(len(styles))
+        thresholds[:len(styles) - 1] = np.cumsum(values)[:-1] / values.sum()
+    return thresholds.tolist()
+
+
+
+# strokes of the painter modifier of obj in an evaluated depsgraph, relative to obj:
+# positions, XYZ euler rotations, scales and the surface normals with 1 + the atlas
+# style as alpha, laid out like the painter_instance attribute. The modifier is in bake
+# mode, so its evaluated mesh holds one vertex per stroke with these as attributes.
+def read_painter_instances(depsgraph, obj):
+    mesh = obj.evaluated_get(depsgraph).data
+    count = len(mesh.vertices)
+    positions = np.empty(count * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", positions)
+    arrays = {"positions": positions.reshape(-1, 3)}
+    for key, attribute_name, field, width in (("rotations", ATTRIBUTE_ROTATION, "vector", 3),
+                                              ("scales", ATTRIBUTE_SCALE, "vector", 3),
+                                              ("normals", ATTRIBUTE_INSTANCE, "color", 4)):
+        values = np.zeros(count * width, dtype=np.float32)
+        attribute = mesh.attributes.get(attribute_name)
+        if attribute is not None and count:
+            attribute.data.foreach_get(field, values)
+        arrays[key] = values.reshape(-1, width)
+    return arrays
+
+
+
+def write_bake_file(path, arrays):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez_compressed(path, **{name: np.asarray(arrays[name], dtype=np.float32) for name in BAKE_ARRAYS})
+
+
+
+def read_bake_file(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in BAKE_ARRAYS}
+
+
+
+# the baked strokes of obj as a mesh of loose vertices, one per stroke, with its
+# rotation, scale and normal as point attributes. The points object is not linked
+# to any scene, the bake reader modifier of obj reads it.
+def store_bake_points(obj, arrays):
+    name = obj.name + BAKE_SUFFIX
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(arrays["positions"]))
+    mesh.vertices.foreach_set("co", np.asarray(arrays["positions"], dtype=np.float32).ravel())
+    for attribute_name, values, data_type, field in (
+            (ATTRIBUTE_ROTATION, arrays["rotations"], 'FLOAT_VECTOR', "vector"),
+            (ATTRIBUTE_SCALE, arrays["scales"], 'FLOAT_VECTOR', "vector"),
+            (ATTRIBUTE_INSTANCE, arrays["normals"], 'FLOAT_COLOR', "color")):
+        attribute = mesh.attributes.new(attribute_name, data_type, 'POINT')
+        attribute.data.foreach_set(field, np.asarray(values, dtype=np.float32).ravel())
+    mesh.update()
+    return set_points_object(name, mesh)
+
+
+
+# the unlinked object called name, created or switched over to mesh
+def set_points_object(name, mesh):
+    points = bpy.data.objects.get(name)
+    if points is not None and points.type == 'MESH':
+        old_mesh = points.data
+        points.data = mesh
+        if old_mesh.users == 0:
+            bpy.data.meshes.remove(old_mesh)
+    else:
+        points = bpy.data.objects.new(name, mesh)
+    return points
+
+
+
+# drop the bake of obj and enable its live painter modifier again. Returns whether
+# there was a bake.
+def free_painter_bake(obj):
+    modifier = obj.modifiers.get(BAKE_MODIFIER_NAME)
+    if modifier is None:
+        return False
+    obj.modifiers.remove(modifier)
+    points = bpy.data.objects.get(obj.name + BAKE_SUFFIX)
+    if points is not None and points.users == 0:
+        mesh = points.data
+        bpy.data.objects.remove(points)
+        if mesh is not None and mesh.users == 0:
+            bpy.data.meshes.remove(mesh)
+    live = get_painter_modifier(obj)
+    if live is not None:
+        live.show_viewport = live.show_render = True
+    return True
+
+
+
+def find_input_socket(node_tree, name):
+    return next((item for item in node_tree.interface.items_tree
+                 if item.item_type == 'SOCKET' and item.in_out == 'INPUT' and item.name == name), None)
+
+
+
+class MeshTopology:
+    """Adjacency tables read once from a mesh, used to trace edge loops without BMesh.
+
+    Every loop is walked once into a loop index; seed selection and the surface walk then
+    read slices of that index. On consistently wound quad meshes both engines produce the
+    same spline points for the same mesh.
+    """
+
+    def __init__(self, loop_verts, loop_edges, poly_sizes, edge_verts, vert_count):
+        loop_verts = np.asarray(loop_verts, dtype=np.int64)
+        loop_edges = np.asarray(loop_edges, dtype=np.int64)
+        poly_sizes = np.asarray(poly_sizes, dtype=np.int64)
+        edge_verts = np.asarray(edge_verts, dtype=np.int64).reshape(-1, 2)
+        loop_count = len(loop_verts)
+        edge_count = len(edge_verts)
+
+        poly_starts = np.cumsum(poly_sizes) - poly_sizes
+        loop_sizes = np.repeat(poly_sizes, poly_sizes)
+        loop_next = np.arange(1, loop_count + 1)
+        loop_next[poly_starts + poly_sizes - 1] = poly_starts
+
+        # BMesh inserts each new loop after the edge's current loop and makes it the edge's
+        # first loop, so the radial cycle runs in face order and starts at the last face
+        order = np.argsort(loop_edges, kind='stable')
+        edge_loop_count = np.bincount(loop_edges, minlength=edge_count)
+        edge_loop_start = np.cumsum(edge_loop_count) - edge_loop_count
+        edge_loop_end = edge_loop_start + edge_loop_count - 1
+        sorted_edges = loop_edges[order]
+        position = np.arange(loop_count)
+        next_position = np.where(position == edge_loop_end[sorted_edges], edge_loop_start[sorted_edges], position + 1)
+        radial_next = np.empty(loop_count, dtype=np.int64)
+        radial_next[order] = order[next_position]
+        edge_first_loop = np.full(edge_count, -1, dtype=np.int64)
+        has_loops = edge_loop_count > 0
+        edge_first_loop[has_loops] = order[edge_loop_end[has_loops]]
+
+        # loop on the next edge of the loop strip: link_loop_next.link_loop_radial_next.link_loop_next
+        step = loop_next[radial_next[loop_next]] if loop_count else loop_next
+        valence = np.bincount(edge_verts.ravel(), minlength=vert_count)
+
+        # edge on the opposite side of each quad across a two-face edge
+        neighbors = np.full((edge_count, 2), -1, dtype=np.int64)
+        two_face = np.flatnonzero(edge_loop_count == 2)
+        for side, loops in enumerate((edge_first_loop[two_face], radial_next[edge_first_loop[two_face]])):
+            across = loop_next[loop_next[radial_next[loops]]]
+            valid = (loop_sizes[loops] == 4) & (loop_sizes[across] == 4) & (edge_loop_count[loop_edges[across]] == 2)
+            neighbors[two_face[valid], side] = loop_edges[across[valid]]
+
+        self.edge_count = edge_count
+        # plain lists index much faster than numpy arrays inside the python walk. Edges
+        # are kept flat: millions of small lists make the garbage collector crawl.
+        self.edge_verts = edge_verts.ravel().tolist()
+        self.edge_first_vert = np.where(has_loops, loop_verts[edge_first_loop], -1).tolist()
+        self.edge_loop_count = edge_loop_count.tolist()
+        self.valence = valence.tolist()
+        self.neighbors = neighbors.T.tolist()
+
+        # loop-level tables are only needed to walk each loop once
+        self.loop_verts = loop_verts.tolist()
+        self.loop_edges = loop_edges.tolist()
+        self.loop_next_vert = loop_verts[loop_next].tolist()
+        self.step = step.tolist()
+        self.edge_first_loop = edge_first_loop.tolist()
+        self.edge_second_loop = np.where(has_loops, radial_next[edge_first_loop], -1).tolist()
+        self.partition_loops()
+        del self.loop_verts, self.loop_edges, self.loop_next_vert, self.step
+        del self.edge_first_loop, self.edge_second_loop
+
+
+    @classmethod
+    def from_mesh(cls, mesh):
+        return cls(*cls.read_mesh(mesh))
+
+
+    # the constructor arguments as plain arrays, which can be pickled to a worker process
+    @staticmethod
+    def read_mesh(mesh):
+        loop_verts = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("vertex_index", loop_verts)
+        loop_edges = np.empty(len(mesh.loops), dtype=np.int32)
+        mesh.loops.foreach_get("edge_index", loop_edges)
+        poly_sizes = np.empty(len(mesh.polygons), dtype=np.int32)
+        mesh.polygons.foreach_get("loop_total", poly_sizes)
+        edge_verts = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+        mesh.edges.foreach_get("vertices", edge_verts)
+        return loop_verts, loop_edges, poly_sizes, edge_verts, len(mesh.vertices)
+
+
+    # label every quad edge with the loop it belongs to and its position on that loop.
+    # Each loop is walked once from its lowest edge, so this runs in O(E).
+    def partition_loops(self):
+        self.edge_loop_id = [-1] * self.edge_count
+        self.edge_position = [0] * self.edge_count
+        self.loops = [] # (seed edge, vertices, edges, closed, edge stepped over when turning back)
+        for e in range(self.edge_count):
+            if self.edge_loop_id[e] >= 0 or self.edge_loop_count[e] == 0:
+                continue
+            verts, edges, closed, skipped_edge = self.walk_loop(e)
+            loop_id = len(self.loops)
+            for position, loop_edge in enumerate(edges):
+                # an edge reached from a one-sided seed may already belong to another loop
+                if self.edge_loop_id[loop_edge] < 0:
+                    self.edge_loop_id[loop_edge] = loop_id
+                    self.edge_position[loop_edge] = position
+            self.loops.append((e, verts, edges, closed, skipped_edge))
+
+
+    # walk the whole loop through edge like ObjectPainterEffect.find_edge_loops with no used
+    # points, recording the edges between consecutive vertices as well
+    def walk_loop(self, edge):
+        loop_verts = self.loop_verts
+        loop_edges = self.loop_edges
+        loop_next_vert = self.loop_next_vert
+        step = self.step
+        valence = self.valence
+        edge_loop_count = self.edge_loop_count
+
+        first_loop = self.edge_first_loop[edge]
+        second_loop = self.edge_second_loop[edge]
+        verts = collections.deque([loop_verts[first_loop]])
+        edges = collections.deque([edge])
+        skipped_edge = None
+        curr_loop = first_loop
+        going_forward = True
+        direction_flag = False
+        while True:
+            next_loop = step[curr_loop]
+            expected_vert = loop_next_vert[curr_loop]
+
+            if next_loop == first_loop:
+                verts.append(loop_verts[next_loop])
+                return list(verts), list(edges), True, skipped_edge
+
+            next_vert = loop_verts[next_loop]
+            if next_vert != expected_vert or valence[next_vert] != 4 \
+                or edge_loop_count[loop_edges[next_loop]] != 2 \
+                or (not going_forward and next_loop == second_loop):
+                if going_forward:
+                    going_forward = False
+                    verts.append(expected_vert)
+                    if edge_loop_count[edge] > 1:
+                        curr_loop = second_loop
+                        direction_flag = True
+                        continue
+                elif not direction_flag:
+                    verts.appendleft(expected_vert)
+                    edges.appendleft(loop_edges[curr_loop])
+                return list(verts), list(edges), False, skipped_edge
+
+            if going_forward:
+                verts.append(next_vert)
+                edges.append(loop_edges[next_loop])
+            elif direction_flag:
+                direction_flag = False
+                skipped_edge = loop_edges[next_loop]
+            else:
+                verts.appendleft(next_vert)
+                edges.appendleft(loop_edges[curr_loop])
+            curr_loop = next_loop
+
+
+    # edge indices to start the surface walk from, see ObjectPainterEffect.find_first_loop
+    def find_first_loop(self):
+        cycles = []
+        longest_path = []
+        max_len = 0
+        for seed, verts, edges, closed, skipped_edge in self.loops:
+            if len(verts) >= 3 and len(verts) > max_len:
+                max_len = len(verts)
+                longest_path = [seed]
+            if len(verts) >= 4 and verts[0] == verts[-1]:
+                cycles.append(seed)
+                # the edge scan in the BMesh engine never marks the edge stepped over when
+                # turning back, so it walks this loop a second time from there
+                if skipped_edge is not None:
+                    cycles.append(skipped_edge)
+        if len(cycles) > 0:
+            return sorted(cycles)
+        return longest_path
+
+
+    # the part of edge's loop that ObjectPainterEffect.find_edge_loops would walk, read from
+    # the loop index: extend from the edge in both directions until a used point or the
+    # end of the loop. Marks and queues the same edges as the BMesh walk.
+    def find_edge_loops(self, edge, used_edge, used_points, queue):
+        verts_on_loop = collections.deque()
+        if self.edge_verts[2 * edge] in used_points or self.edge_verts[2 * edge + 1] in used_points:
+            return verts_on_loop
+        loop_id = self.edge_loop_id[edge]
+        if loop_id < 0:
+            return verts_on_loop
+        _, verts, edges, closed, _ = self.loops[loop_id]
+        edge_loop_count = self.edge_loop_count
+        valence = self.valence
+        position = self.edge_position[edge]
+        edge_total = len(edges)
+
+        # which way along the loop the BMesh walk starts: the edge's first loop decides
+        if self.edge_first_vert[edge] == verts[position]:
+            direction, start = 1, position
+        else:
+            direction, start = -1, position + 1
+
+        def next_edge(i, d):
+            if closed:
+                return i % edge_total if d > 0 else (i - 1) % edge_total
+            k = i if d > 0 else i - 1
+            return k if 0 <= k < edge_total else None
+
+        used_edge.add(edge)
+        queue.append(edge)
+        verts_on_loop.append(verts[start % edge_total if closed else start])
+        i = start + direction
+        while True:
+            vi = i % edge_total if closed else i
+            k = next_edge(vi, direction)
+            if closed and k == position:
+                verts_on_loop.append(verts[vi])
+                return verts_on_loop
+            v = verts[vi]
+            if v in used_points or k is None or valence[v] != 4 or edge_loop_count[edges[k]] != 2:
+                if not v in used_points:
+                    verts_on_loop.append(v)
+                break
+            used_edge.add(edges[k])
+            queue.append(edges[k])
+            verts_on_loop.append(v)
+            i += direction
+
+        if edge_loop_count[edge] < 2:
+            return verts_on_loop
+        # the BMesh walk steps over the first edge behind the start without marking it
+        i = start
+        first_step = True
+        while True:
+            vi = i % edge_total if closed else i
+            k = next_edge(vi, -direction)
+            v = verts[vi]
+            if v in used_points or k is None or k == position or valence[v] != 4 \
+                or edge_loop_count[edges[k]] != 2:
+                if not first_step and not v in used_points:
+                    verts_on_loop.appendleft(v)
+                break
+            if not first_step:
+                used_edge.add(edges[k])
+                queue.append(edges[k])
+                verts_on_loop.appendleft(v)
+            first_step = False
+            i -= direction
+        return verts_on_loop
+
+
+    def find_neighboring_edge(self, edge):
+        return [e for e in (self.neighbors[0][edge], self.neighbors[1][edge]) if e >= 0]
+
+
+
+# building blocks of the painter effect, shared by the operator and the command line batch.
+# Subclasses provide the guide settings (curve_engine, curve_count, curve_tolerance,
+# max_curve_points, worker_count, use_disk_cache) and report().
+class PainterEffectBuilder:
     node_x_location = 0
-    
+    profile = None # PainterProfile collecting stage times and counters, when profiling
+    stroke_folders = () # stroke folders searched after those of get_stroke_folders
+
 
     def create_node(self, node_tree, type_name, node_location_step_x=300):
         node_obj = node_tree.nodes.new(type=type_name)
@@ -42,84 +1584,467 @@ class ObjectPainterEffect(bpy.types.Operator):
 
 
 
-    def execute(self, context):
-        objs = context.selected_objects
-        if objs is None:
-            print("No active object in the scene.")
-            return {'CANCELLED'}
-        
+    # time the block as a stage of obj, or of the work shared by all objects; free when
+    # not profiling
+    @contextlib.contextmanager
+    def timed_stage(self, stage, obj=None):
+        if self.profile is None:
+            yield
+            return
+        with self.profile.stage(stage, obj.name if obj is not None else None):
+            yield
+
+
+    def count(self, counter, amount=1, obj=None):
+        if self.profile is not None:
+            self.profile.count(counter, amount, obj.name if obj is not None else None)
+
+
+    # instances the painter modifiers of objs produce, read from the evaluated depsgraph
+    def count_instances(self, depsgraph, objs):
+        counts = count_painter_instances(depsgraph)
         for obj in objs:
-            self.apply_painter_effect(context, obj)
+            self.count("instances", counts[obj.name], obj)
 
-        return {'FINISHED'}
 
 
-    def apply_painter_effect(self, context, obj):
-        if obj.type != 'MESH':
-            print("Object is not a mesh.")
-            return
-        stroke_style = context.scene.stroke_style
-        print(stroke_style)
+    # apply the effect to every object in objs. The guide curves go to collection, or to
+    # each object's own collection when it is None. Re-applying only rebuilds what changed.
+    def apply_to_objects(self, objs, collection, stroke_style):
+        stroke_library.refresh(get_stroke_folders() + list(self.stroke_folders), force=True)
+        # the stroke files are checked once here, not per material
+        if stroke_style == ATLAS_STYLE:
+            stroke = self.load_stroke_atlas()
+        else:
+            stroke = self.load_stroke_image(stroke_style), 1, 1
+        with self.timed_stage("plan"):
+            groups = self.group_by_mesh(objs)
+            owners = [users[0] for users in groups]
+        with self.timed_stage("trace guide loops"):
+            jobs = [self.create_guide_job(obj) for obj in owners]
+            keys = [guide_loop_cache.key(job[0], job[1], (self.curve_engine,) + job[2:]) for job in jobs]
+            # guide curves built from the same mesh and settings are kept as they are
+            stale = []
+            for i, users in enumerate(groups):
+                if any(name not in owners[i].data.attributes for name in (ATTRIBUTE_TANGENT, ATTRIBUTE_CURVATURE)) \
+                        or any(not self.has_guide_curve(obj, keys[i]) for obj in users):
+                    stale.append(i)
+            guide_loops = [None] * len(groups)
+            traced = self.trace_all_guide_loops([owners[i] for i in stale], [jobs[i] for i in stale], [keys[i] for i in stale])
+            for i, loops in zip(stale, traced):
+                guide_loops[i] = loops
+        for users, key, loops in zip(groups, keys, guide_loops):
+            self.apply_painter_effect(users, key, loops, collection, stroke_style, stroke)
+
+
+
+    # objs grouped by their mesh datablock, in selection order. Linked duplicates share
+    # the guide loops, tangent attribute, binding and material of their mesh, so those
+    # are made once per group.
+    def group_by_mesh(self, objs):
+        groups = {}
+        for obj in objs:
+            groups.setdefault(obj.data.name_full, []).append(obj)
+        return list(groups.values())
+
+
+
+    # the selected meshes and their mesh children, each object once
+    def collect_mesh_objects(self, objs):
+        mesh_objs = []
+        seen = set()
+        stack = list(reversed(objs))
+        while stack:
+            obj = stack.pop()
+            if obj.name in seen:
+                continue
+            seen.add(obj.name)
+            if obj.type != 'MESH':
+                self.report({'WARNING'}, f"{obj.name} is not a mesh")
+                continue
+            mesh_objs.append(obj)
+            stack.extend(reversed(obj.children))
+        return mesh_objs
+
+
+
+    # guide loops for objs from their create_guide_job jobs and cache keys. Meshes traced
+    # before with the same settings come from guide_loop_cache, optionally backed by .npz
+    # files next to the blend file.
+    def trace_all_guide_loops(self, objs, jobs, keys):
+        directory = self.get_cache_directory()
+        guide_loops = [guide_loop_cache.get(key, directory) for key in keys]
+        missing = [i for i, loops in enumerate(guide_loops) if loops is None]
 
-        curves = self.generate_surface_curves(obj, context)
-        tangent_group_name = self.create_tangent_tracer_group(obj)
+        if self.curve_engine == 'BMESH':
+            traced = [self.trace_bmesh_guide_loops(objs[i]) for i in missing]
+        else:
+            traced = self.trace_guide_jobs([jobs[i] for i in missing])
+        for i, (loops, counters) in zip(missing, traced):
+            guide_loops[i] = loops
+            guide_loop_cache.put(keys[i], loops, directory)
+            for counter, amount in counters.items():
+                self.count(counter, amount, objs[i])
+        self.count("guide cache hits", len(keys) - len(missing))
+        return guide_loops
+
+
+    def get_cache_directory(self):
+        if not self.use_disk_cache or not bpy.data.filepath:
+            return None
+        return bpy.path.abspath(GUIDE_CACHE_DIRECTORY)
+
+
+    # trace the jobs from create_guide_job in a pool of forked processes on Linux. Other
+    # platforms, a single job or worker_count 1 trace on the main thread instead.
+    def trace_guide_jobs(self, jobs):
+        tracer = trace_field_loops if self.curve_engine == 'FIELD' else trace_guide_loops
+        workers = min(self.worker_count or os.cpu_count() or 1, len(jobs))
+        # fork rather than spawn: a spawned interpreter would have to import this add-on,
+        # and bpy with it, outside Blender. Forking Blender's threads is only safe enough on
+        # Linux; macOS made spawn the default for that reason. A child that still deadlocks
+        # on a lock copied from another thread is caught by the timeout.
+        if workers > 1 and sys.platform.startswith("linux"):
+            pool = None
+            try:
+                pool = multiprocessing.get_context("fork").Pool(workers)
+                results = pool.imap(tracer, jobs)
+                traced = [results.next(GUIDE_WORKER_TIMEOUT) for _ in jobs]
+                pool.close()
+                return traced
+            except (OSError, multiprocessing.TimeoutError) as error:
+                self.report({'WARNING'}, f"Tracing on the main thread: {str(error) or 'the worker pool stopped responding'}")
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+        return [tracer(job) for job in jobs]
+
+
+    def create_guide_job(self, obj):
+        return (MeshTopology.read_mesh(obj.data), self.read_vertex_coords(obj),
+                self.curve_count, self.curve_tolerance * self.get_obj_size(obj), self.max_curve_points)
+
+
+    def trace_bmesh_guide_loops(self, obj):
+        bm = bmesh.new()   # create an empty BMesh
+        bm.from_mesh(obj.data)
+        bm.verts.ensure_lookup_table()
+        bm.edges.ensure_lookup_table()
+        initial_loops = self.find_first_loop(bm)
+        seeds = [e.index for e, _ in initial_loops] if initial_loops is not None else []
+        counters = {}
+        spline_points = collect_surface_loops(
+            seeds,
+            lambda e, visited, used, queue: self.find_edge_loops(bm.edges[e], visited, used, queue),
+            lambda e: self.find_neighboring_edge(bm.edges[e]),
+            counters)
+        bm.free()
+        if not loops_cover_surface(spline_points, len(obj.data.vertices)):
+            return trace_field_loops(self.create_guide_job(obj))
+        return simplify_surface_loops(self.read_vertex_coords(obj), spline_points, self.curve_count,
+                                      self.curve_tolerance * self.get_obj_size(obj), self.max_curve_points), counters
+
+
+    def read_vertex_coords(self, obj):
+        coords = np.empty(len(obj.data.vertices) * 3, dtype=np.float32)
+        obj.data.vertices.foreach_get("co", coords)
+        return coords.reshape(-1, 3)
+
+
+    # objs share one mesh, see group_by_mesh. The mesh level work runs on the first of
+    # them and every object gets its own guide curve and painter modifier.
+    # guide_loops is None when the objects' guide curves are already built from guide_key
+    def apply_painter_effect(self, objs, guide_key, guide_loops, collection, stroke_style, stroke):
+        owner = objs[0]
+        with self.timed_stage("guide curves", owner):
+            curves = []
+            for obj in objs:
+                curves.append(self.generate_surface_curves(obj, collection, guide_key, guide_loops,
+                                                           curves[0].data if curves else None))
+        if guide_loops is not None:
+            with self.timed_stage("tangent field", owner):
+                self.store_guide_tangents(owner, guide_loops)
+            with self.timed_stage("curvature", owner):
+                self.store_curvature(owner)
+        bindings = [None] * len(objs)
+        if self.use_deforming:
+            bindings = [bpy.data.objects.get(obj.name + BIND_SUFFIX) for obj in objs]
+            if None in bindings or guide_loops is not None:
+                with self.timed_stage("surface binding", owner):
+                    points = self.store_surface_binding(owner)
+                bindings = [set_points_object(obj.name + BIND_SUFFIX, points) for obj in objs]
+        with self.timed_stage("tangent group", owner):
+            tangent_group_name = self.create_tangent_tracer_group()
     
-        brush_material, existing_img_texture = self.create_shader(obj, stroke_style)
-        self.create_geometry_nodes(obj, tangent_group_name, curves, brush_material)
-        for child in obj.children:
-            self.apply_painter_effect(context, child)
+        with self.timed_stage("shader", owner):
+            brush_material, brush_image = self.create_shader(owner, stroke_style, stroke)
+        styles = []
+        if stroke_style == ATLAS_STYLE and brush_image is not None:
+            styles = json.loads(brush_image[ATLAS_MANIFEST_PROPERTY])["styles"]
+        for obj, curve, binding in zip(objs, curves, bindings):
+            with self.timed_stage("geometry nodes", obj):
+                self.create_geometry_nodes(obj, tangent_group_name, curve, brush_material, binding, styles)
+
+
+    # bind strokes to the rest surface of obj for the deforming mode: BIND_DENSITY times the
+    # default density, each on a triangle of obj.data. The tangent group follows the
+    # triangles every frame instead of scattering again. Returns the points mesh, which
+    # every user of obj.data can share.
+    def store_surface_binding(self, obj):
+        mesh = obj.data
+        mesh.calc_loop_triangles()
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get("vertices", triangles)
+        tangents = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+        mesh.attributes[ATTRIBUTE_TANGENT].data.foreach_get("vector", tangents)
+        areas = np.empty(len(mesh.polygons), dtype=np.float32)
+        mesh.polygons.foreach_get("area", areas)
+        count = round(float(areas.sum()) * self.get_default_density(obj) * BIND_DENSITY)
+        bound = bind_surface_points(self.read_vertex_coords(obj), triangles, tangents.reshape(-1, 3), count)
+        curvature = np.empty(len(mesh.vertices), dtype=np.float32)
+        mesh.attributes[ATTRIBUTE_CURVATURE].data.foreach_get("value", curvature)
+
+        points = bpy.data.meshes.new(obj.data.name + BIND_SUFFIX)
+        points.vertices.add(count)
+        points.vertices.foreach_set("co", bound["positions"].astype(np.float32).ravel())
+        for attribute_name, corner in zip(ATTRIBUTE_BIND_VERTICES, bound["vertices"].T):
+            points.attributes.new(attribute_name, 'INT', 'POINT').data.foreach_set("value", corner.astype(np.int32))
+        for attribute_name, values in ((ATTRIBUTE_BIND_WEIGHTS, bound["weights"]), (ATTRIBUTE_BIND_TANGENT, bound["tangents"])):
+            points.attributes.new(attribute_name, 'FLOAT_VECTOR', 'POINT').data.foreach_set("vector", values.astype(np.float32).ravel())
+        points.attributes.new(ATTRIBUTE_BIND_RANK, 'FLOAT', 'POINT').data.foreach_set("value", bound["ranks"].astype(np.float32))
+        points.attributes.new(ATTRIBUTE_CURVATURE, 'FLOAT', 'POINT').data.foreach_set(
+            "value", np.einsum("ij,ij->i", bound["weights"], curvature[bound["vertices"]]).astype(np.float32))
+        points.update()
+        self.count("bound strokes", count, obj)
+        return points
+
+
+    # replace the live painter modifiers of objs by readers of their strokes, baked into
+    # points objects. The strokes come from the modifiers evaluated at render density, or
+    # with from_file from the .npz files in directory; evaluated strokes are written there
+    # when a directory is given. The live modifiers are only disabled, free_painter_bake
+    # brings them back. Returns the number of baked strokes.
+    def bake_objects(self, objs, directory=None, from_file=False):
+        bakes = {}
+        if from_file:
+            for obj in objs:
+                path = self.get_bake_path(directory, obj)
+                if not os.path.exists(path):
+                    self.report({'WARNING'}, f"No baked strokes for {obj.name} in {directory}")
+                    continue
+                with self.timed_stage("bake read", obj):
+                    bakes[obj] = read_bake_file(path)
+        else:
+            with self.timed_stage("bake evaluation"):
+                # the viewport preview would bake reduced strokes; in bake mode the modifiers
+                # put out the strokes as vertices with their attributes
+                outdated = [obj for obj in objs if find_input_socket(get_painter_modifier(obj).node_group, "Bake Points") is None]
+                for obj in outdated:
+                    self.report({'WARNING'}, f"Apply the painter effect to {obj.name} again before baking it")
+                objs = [obj for obj in objs if obj not in outdated]
+                restore = []
+                for obj in objs:
+                    free_painter_bake(obj)
+                    modifier = get_painter_modifier(obj)
+                    for name, value in (("Viewport Density", 1.0), ("Viewport Points", False), ("Bake Points", True)):
+                        socket = find_input_socket(modifier.node_group, name)
+                        if socket is not None:
+                            restore.append((obj, modifier, socket.identifier, modifier[socket.identifier]))
+                            modifier[socket.identifier] = value
+                    obj.update_tag()
+                depsgraph = bpy.context.evaluated_depsgraph_get()
+                for obj in objs:
+                    bakes[obj] = read_painter_instances(depsgraph, obj)
+                for obj, modifier, identifier, value in restore:
+                    modifier[identifier] = value
+                    obj.update_tag()
+            if directory is not None:
+                for obj, arrays in bakes.items():
+                    with self.timed_stage("bake write", obj):
+                        write_bake_file(self.get_bake_path(directory, obj), arrays)
+
+        reader = self.create_bake_reader_group()
+        for obj, arrays in bakes.items():
+            with self.timed_stage("bake points", obj):
+                points = store_bake_points(obj, arrays)
+                live = get_painter_modifier(obj)
+                modifier = obj.modifiers.get(BAKE_MODIFIER_NAME) or obj.modifiers.new(BAKE_MODIFIER_NAME, 'NODES')
+                if modifier.node_group != reader:
+                    modifier.node_group = reader
+                for name, value in (("Strokes", points), ("Card", get_brush_card()),
+                                    ("Material", live.node_group.nodes[MATERIAL_NODE_NAME].inputs[2].default_value)):
+                    modifier[find_input_socket(reader, name).identifier] = value
+                live.show_viewport = live.show_render = False
+                obj.update_tag()
+            self.count("baked strokes", len(arrays["positions"]), obj)
+        return sum(len(arrays["positions"]) for arrays in bakes.values())
+
+
+    def get_bake_path(self, directory, obj):
+        return os.path.join(directory, bpy.path.clean_name(obj.name) + ".npz")
+
+
+    def create_bake_reader_group(self):
+        return get_shared_node_group(BAKE_READER_NAME, self.build_bake_reader_group)
+
+
+    # instance the brush card on the points of a bake with their stored rotation and
+    # scale. Point attributes, the packed normal among them, carry over to the instances.
+    def build_bake_reader_group(self):
+        node_tree = bpy.data.node_groups.new(BAKE_READER_NAME, 'GeometryNodeTree')
+        node_tree.interface.new_socket(name="Geometry", in_out="INPUT", socket_type="NodeSocketGeometry")
+        node_tree.interface.new_socket(name="Strokes", in_out="INPUT", socket_type="NodeSocketObject")
+        node_tree.interface.new_socket(name="Card", in_out="INPUT", socket_type="NodeSocketObject")
+        node_tree.interface.new_socket(name="Material", in_out="INPUT", socket_type="NodeSocketMaterial")
+        node_tree.interface.new_socket(name="Geometry", in_out="OUTPUT", socket_type="NodeSocketGeometry")
 
+        group_input = self.create_node(node_tree, 'NodeGroupInput')
+        group_input.location = (0, 0)
+
+        strokes_info = self.create_node(node_tree, 'GeometryNodeObjectInfo')
+        strokes_info.transform_space = 'ORIGINAL'
+        strokes_info.location = (200, 200)
+
+        card_info = self.create_node(node_tree, 'GeometryNodeObjectInfo')
+        card_info.transform_space = 'ORIGINAL'
+        card_info.location = (200, -100)
+
+        rotation = self.create_node(node_tree, 'GeometryNodeInputNamedAttribute')
+        rotation.data_type = 'FLOAT_VECTOR'
+        rotation.inputs["Name"].default_value = ATTRIBUTE_ROTATION
+        rotation.location = (200, -400)
+
+        scale = self.create_node(node_tree, 'GeometryNodeInputNamedAttribute')
+        scale.data_type = 'FLOAT_VECTOR'
+        scale.inputs["Name"].default_value = ATTRIBUTE_SCALE
+        scale.location = (200, -600)
 
-    def create_tangent_tracer_group(self, obj):
+        instance_on_points = self.create_node(node_tree, 'GeometryNodeInstanceOnPoints')
+        instance_on_points.location = (400, 0)
+
+        set_material = self.create_node(node_tree, 'GeometryNodeSetMaterial')
+        set_material.location = (600, 0)
+
+        join_geometry = self.create_node(node_tree, 'GeometryNodeJoinGeometry')
+        join_geometry.location = (800, 0)
+
+        group_output = self.create_node(node_tree, 'NodeGroupOutput')
+        group_output.location = (1000, 0)
+
+        links = node_tree.links
+        links.new(group_input.outputs["Strokes"], strokes_info.inputs["Object"])
+        links.new(group_input.outputs["Card"], card_info.inputs["Object"])
+        links.new(strokes_info.outputs["Geometry"], instance_on_points.inputs["Points"])
+        links.new(card_info.outputs["Geometry"], instance_on_points.inputs["Instance"])
+        links.new(rotation.outputs["Attribute"], instance_on_points.inputs["Rotation"])
+        links.new(scale.outputs["Attribute"], instance_on_points.inputs["Scale"])
+        links.new(instance_on_points.outputs["Instances"], set_material.inputs["Geometry"])
+        links.new(group_input.outputs["Material"], set_material.inputs["Material"])
+        links.new(set_material.outputs["Geometry"], join_geometry.inputs["Geometry"])
+        links.new(group_input.outputs["Geometry"], join_geometry.inputs["Geometry"])
+        links.new(join_geometry.outputs["Geometry"], group_output.inputs["Geometry"])
+        self.count("nodes created", len(node_tree.nodes))
+        return node_tree
+
+
+    # bake the guide directions onto the mesh, where the tangent group reads them for
+    # the scattered points
+    def store_guide_tangents(self, obj, guide_loops):
+        mesh = obj.data
+        edge_verts = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+        mesh.edges.foreach_get("vertices", edge_verts)
+        tangents = bake_guide_tangents(self.read_vertex_coords(obj), edge_verts, guide_loops)
+        attribute = mesh.attributes.get(ATTRIBUTE_TANGENT)
+        if attribute is None or attribute.data_type != 'FLOAT_VECTOR' or attribute.domain != 'POINT':
+            if attribute is not None:
+                mesh.attributes.remove(attribute)
+            attribute = mesh.attributes.new(ATTRIBUTE_TANGENT, 'FLOAT_VECTOR', 'POINT')
+        attribute.data.foreach_set("vector", tangents.ravel())
+        mesh.update()
+
+
+    # vertex curvature of obj's mesh for the stroke scale, read by the tangent group from
+    # the scattered or bound points
+    def store_curvature(self, obj):
+        mesh = obj.data
+        mesh.calc_loop_triangles()
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get("vertices", triangles)
+        edge_verts = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+        mesh.edges.foreach_get("vertices", edge_verts)
+        curvature = vertex_curvature(self.read_vertex_coords(obj), triangles, edge_verts, self.get_obj_size(obj))
+        attribute = mesh.attributes.get(ATTRIBUTE_CURVATURE)
+        if attribute is None or attribute.data_type != 'FLOAT' or attribute.domain != 'POINT':
+            if attribute is not None:
+                mesh.attributes.remove(attribute)
+            attribute = mesh.attributes.new(ATTRIBUTE_CURVATURE, 'FLOAT', 'POINT')
+        attribute.data.foreach_set("value", curvature.astype(np.float32))
+        mesh.update()
+
+
+    # the tangent tracer graph is the same for every object, so all painter modifiers share one copy
+    def create_tangent_tracer_group(self):
+        return get_shared_node_group(CURVE_TANGENT_NAME, self.build_tangent_tracer_group).name
+
+
+    def build_tangent_tracer_group(self):
         node_tree = bpy.data.node_groups.new(CURVE_TANGENT_NAME, 'GeometryNodeTree')
 
         node_tree.interface.new_socket(name="Mesh", in_out="INPUT", socket_type="NodeSocketGeometry")
         node_tree.interface.new_socket(name="Instance", in_out="INPUT", socket_type="NodeSocketGeometry")
+        # not read by the graph since the directions are baked on the mesh; it records the
+        # guide curve of the object for find_guide_curve
         node_tree.interface.new_socket(name="Curve", in_out="INPUT", socket_type="NodeSocketObject")
         node_tree.interface.new_socket(name="Density", in_out="INPUT", socket_type="NodeSocketFloat")
         node_tree.interface.new_socket(name="Scale", in_out="INPUT", socket_type="NodeSocketVector")
         node_tree.interface.new_socket(name="Normal", in_out="OUTPUT", socket_type="NodeSocketVector")
         node_tree.interface.new_socket(name="Instances", in_out="OUTPUT", socket_type="NodeSocketGeometry")
+        # created last so links to the older sockets survive when legacy groups are migrated
+        node_tree.interface.new_socket(name="Default Density", in_out="INPUT", socket_type="NodeSocketFloat")
+        instance_budget = node_tree.interface.new_socket(name="Instance Budget", in_out="INPUT", socket_type="NodeSocketFloat")
+        instance_budget.default_value = UNLIMITED_INSTANCES
+        node_tree.interface.new_socket(name="Camera", in_out="INPUT", socket_type="NodeSocketObject")
+        node_tree.interface.new_socket(name="Camera Culling", in_out="INPUT", socket_type="NodeSocketBool")
+        node_tree.interface.new_socket(name="Field of View", in_out="INPUT", socket_type="NodeSocketFloat")
+        node_tree.interface.new_socket(name="Frustum Margin", in_out="INPUT", socket_type="NodeSocketFloat")
+        node_tree.interface.new_socket(name="Falloff Distance", in_out="INPUT", socket_type="NodeSocketFloat")
+        node_tree.interface.new_socket(name="Deforming", in_out="INPUT", socket_type="NodeSocketBool")
+        node_tree.interface.new_socket(name="Binding", in_out="INPUT", socket_type="NodeSocketObject")
 
         group_input_1 = self.create_node(node_tree, 'NodeGroupInput')
         group_input_1.location = (-200, 0)
 
-        group_input_2 = self.create_node(node_tree, 'NodeGroupInput')
-        group_input_2.location = (-800, 300)
-
         group_output = self.create_node(node_tree, 'NodeGroupOutput')
         group_output.location = (1200, 0)
 
-        object_info = self.create_node(node_tree, 'GeometryNodeObjectInfo')
-        object_info.location = (-600, 300)
-
-        curve_to_mesh = self.create_node(node_tree, 'GeometryNodeCurveToMesh')
-        curve_to_mesh.location = (-400, 300)
-
-        mesh_to_curve = self.create_node(node_tree, 'GeometryNodeMeshToCurve')
-        mesh_to_curve.location = (-200, 300)
-
-        curve_tangent = self.create_node(node_tree, 'GeometryNodeInputTangent')
-        curve_tangent.location = (-200, 400)
+        # the guide direction baked on the mesh, interpolated to the points by the distribution
+        guide_tangent = self.create_node(node_tree, 'GeometryNodeInputNamedAttribute')
+        guide_tangent.data_type = 'FLOAT_VECTOR'
+        guide_tangent.inputs["Name"].default_value = ATTRIBUTE_TANGENT
+        guide_tangent.location = (500, 300)
 
-        capture_curve_tangent = self.create_node(node_tree, 'GeometryNodeCaptureAttribute')
-        capture_curve_tangent.location = (0, 300)
-        capture_curve_tangent.capture_items.new("VECTOR", "Tangent")
+        # highest Density that keeps the instances within the budget
+        face_area = self.create_node(node_tree, 'GeometryNodeInputMeshFaceArea')
+        face_area.location = (-600, -300)
 
-        curve_to_mesh_2 = self.create_node(node_tree, 'GeometryNodeCurveToMesh')
-        curve_to_mesh_2.location = (200, 300)
+        surface_area = self.create_node(node_tree, 'GeometryNodeAttributeStatistic')
+        surface_area.domain = 'FACE'
+        surface_area.location = (-400, -300)
 
-        sample_nearest = self.create_node(node_tree, 'GeometryNodeSampleNearest')
-        sample_nearest.location = (400, 300)
+        default_instances = self.create_node(node_tree, 'ShaderNodeMath')
+        default_instances.operation = 'MULTIPLY'
+        default_instances.location = (-200, -300)
 
-        sample_index = self.create_node(node_tree, 'GeometryNodeSampleIndex')
-        sample_index.location = (600, 300)
-        sample_index.data_type = "FLOAT_VECTOR"
+        budget_density = self.create_node(node_tree, 'ShaderNodeMath')
+        budget_density.label = "Budget Density"
+        budget_density.operation = 'DIVIDE'
+        budget_density.location = (-200, -500)
 
-        default_density = self.create_node(node_tree, 'ShaderNodeValue')
-        default_density.label= "Default Density"
-        default_density.outputs[0].default_value = self.get_default_density(obj)
-        default_density.location = (-200,-300)
+        clamped_density = self.create_node(node_tree, 'ShaderNodeMath')
+        clamped_density.label = "Clamped Density"
+        clamped_density.operation = 'MINIMUM'
+        clamped_density.location = (-200, -700)
 
         adjusted_density = self.create_node(node_tree, 'ShaderNodeMath')
         adjusted_density.label= "Adjusted Density"
@@ -169,28 +2094,29 @@ class ObjectPainterEffect(bpy.types.Operator):
 
         node_tree.links.new(group_input_1.outputs["Mesh"], distributePoint.inputs["Mesh"])
         node_tree.links.new(group_input_1.outputs["Instance"], instanceOnPoint.inputs["Instance"])
-        node_tree.links.new(distributePoint.outputs["Points"], instanceOnPoint.inputs["Points"])
-        node_tree.links.new(distributePoint.outputs["Normal"], group_output.inputs["Normal"])
-        node_tree.links.new(distributePoint.outputs["Normal"], alignNormal.inputs["Vector"])
+        points, point_normal, point_tangent, bound_selection = self.build_deforming_points(
+            node_tree, distributePoint, guide_tangent, clamped_density)
+        node_tree.links.new(points, instanceOnPoint.inputs["Points"])
+        node_tree.links.new(point_normal, group_output.inputs["Normal"])
+        node_tree.links.new(point_normal, alignNormal.inputs["Vector"])
         node_tree.links.new(alignNormal.outputs["Rotation"], align_tangent.inputs["Rotation"])
         node_tree.links.new(align_tangent.outputs["Rotation"], instanceOnPoint.inputs["Rotation"])
         node_tree.links.new(instanceOnPoint.outputs["Instances"], group_output.inputs["Instances"])
-        node_tree.links.new(group_input_2.outputs["Curve"], object_info.inputs["Object"])
-        node_tree.links.new(object_info.outputs["Geometry"], curve_to_mesh.inputs["Curve"])
-        node_tree.links.new(curve_to_mesh.outputs["Mesh"], mesh_to_curve.inputs["Mesh"])
-        node_tree.links.new(mesh_to_curve.outputs["Curve"], capture_curve_tangent.inputs["Geometry"])
-        node_tree.links.new(curve_tangent.outputs["Tangent"], capture_curve_tangent.inputs["Tangent"])
-        node_tree.links.new(capture_curve_tangent.outputs[0], curve_to_mesh_2.inputs["Curve"])
-        node_tree.links.new(capture_curve_tangent.outputs[1], sample_index.inputs["Value"])
-        node_tree.links.new(curve_to_mesh_2.outputs["Mesh"], sample_nearest.inputs["Geometry"])
-        node_tree.links.new(curve_to_mesh_2.outputs["Mesh"], sample_index.inputs["Geometry"])
-        node_tree.links.new(sample_nearest.outputs["Index"], sample_index.inputs["Index"])
-        node_tree.links.new(sample_index.outputs["Value"], align_tangent.inputs["Vector"])
+        node_tree.links.new(point_tangent, align_tangent.inputs["Vector"])
         
-        node_tree.links.new(default_density.outputs["Value"], adjusted_density.inputs[0])
-        node_tree.links.new(group_input_1.outputs["Density"], adjusted_density.inputs[1])
+        node_tree.links.new(group_input_1.outputs["Mesh"], surface_area.inputs["Geometry"])
+        node_tree.links.new(face_area.outputs["Area"], surface_area.inputs["Attribute"])
+        node_tree.links.new(surface_area.outputs["Sum"], default_instances.inputs[0])
+        node_tree.links.new(group_input_1.outputs["Default Density"], default_instances.inputs[1])
+        node_tree.links.new(group_input_1.outputs["Instance Budget"], budget_density.inputs[0])
+        node_tree.links.new(default_instances.outputs["Value"], budget_density.inputs[1])
+        node_tree.links.new(group_input_1.outputs["Density"], clamped_density.inputs[0])
+        node_tree.links.new(budget_density.outputs["Value"], clamped_density.inputs[1])
+
+        node_tree.links.new(group_input_1.outputs["Default Density"], adjusted_density.inputs[0])
+        node_tree.links.new(clamped_density.outputs["Value"], adjusted_density.inputs[1])
         node_tree.links.new(adjusted_density.outputs["Value"], distributePoint.inputs["Density"])
-        node_tree.links.new(group_input_1.outputs["Density"], calculated_size_1.inputs[1])
+        node_tree.links.new(clamped_density.outputs["Value"], calculated_size_1.inputs[1])
         node_tree.links.new(calculated_size_1.outputs["Value"], calculated_size_2.inputs["Value"])
         node_tree.links.new(calculated_size_2.outputs["Value"], size_multiplier.inputs["X"])
         node_tree.links.new(calculated_size_2.outputs["Value"], size_multiplier.inputs["Y"])
@@ -199,63 +2125,431 @@ class ObjectPainterEffect(bpy.types.Operator):
         node_tree.links.new(group_input_1.outputs["Scale"], scaled_size.inputs[1])
         node_tree.links.new(scaled_size.outputs["Vector"], adjusted_size.inputs[0])
         node_tree.links.new(size_multiplier.outputs["Vector"], adjusted_size.inputs[1])
-        node_tree.links.new(adjusted_size.outputs["Vector"], instanceOnPoint.inputs["Scale"])
-        
-        # Curvature 
-        capture_normal = self.create_node(node_tree, "GeometryNodeCaptureAttribute")
-        capture_normal.domain = "POINT"
-        capture_normal.location = (400, 500)
-
-        sample_nearest_curvature = self.create_node(node_tree, "GeometryNodeSampleNearest")
-        sample_nearest_curvature.location = (600, 500)
-
-        subtract_normals = self.create_node(node_tree, "ShaderNodeVectorMath")
-        subtract_normals.operation = "SUBTRACT"
-        subtract_normals.location = (800, 300)
-
-        curvature_length = self.create_node(node_tree, "ShaderNodeVectorMath")
-        curvature_length.operation = "LENGTH"
-        curvature_length.location = (800, 100)
-
-        map_range = self.create_node(node_tree, "ShaderNodeMapRange")
-        map_range.inputs["From Min"].default_value = 0.0
-        map_range.inputs["From Max"].default_value = 0.5
-        map_range.inputs["To Min"].default_value = 0.5
-        map_range.inputs["To Max"].default_value = 1.5
-        map_range.clamp = True
-        map_range.location = (1000, 300)
-
-        multiply_scale = self.create_node(node_tree, "ShaderNodeVectorMath")
-        multiply_scale.operation = "MULTIPLY"
-        multiply_scale.location = (1200, 300)
-
-        node_tree.links.new(distributePoint.outputs["Points"], capture_normal.inputs["Geometry"])
-        node_tree.links.new(capture_normal.outputs["Geometry"], sample_nearest_curvature.inputs["Geometry"])
-        node_tree.links.new(sample_nearest_curvature.outputs["Index"], subtract_normals.inputs[1])
-        # node_tree.links.new(capture_normal.outputs["Geometry"], subtract_normals.inputs[0])
-        node_tree.links.new(subtract_normals.outputs["Vector"], curvature_length.inputs[0])
-        node_tree.links.new(curvature_length.outputs["Value"], map_range.inputs["Value"])
-        node_tree.links.new(map_range.outputs["Result"], multiply_scale.inputs[1])
-        node_tree.links.new(group_input_1.outputs["Scale"], multiply_scale.inputs[0])
-        # node_tree.links.new(multiply_scale.outputs["Vector"], instanceOnPoint.inputs["Scale"])
-
-        return node_tree.name
+
+        # smaller strokes where the surface bends, from the curvature baked on the mesh and
+        # interpolated to the points like the guide direction
+        curvature = self.create_node(node_tree, 'GeometryNodeInputNamedAttribute')
+        curvature.data_type = 'FLOAT'
+        curvature.inputs["Name"].default_value = ATTRIBUTE_CURVATURE
+        curvature.location = (500, -600)
+
+        curvature_scale = self.create_node(node_tree, 'ShaderNodeMapRange')
+        curvature_scale.label = "Curvature Scale"
+        curvature_scale.inputs["From Min"].default_value = 0.0
+        curvature_scale.inputs["From Max"].default_value = CURVATURE_RANGE
+        curvature_scale.inputs["To Min"].default_value = 1.0
+        curvature_scale.inputs["To Max"].default_value = CURVATURE_MIN_SCALE
+        curvature_scale.clamp = True
+        curvature_scale.location = (700, -600)
+
+        curvature_size = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        curvature_size.operation = 'SCALE'
+        curvature_size.label = "Curvature Size"
+        curvature_size.location = (900, -400)
+
+        node_tree.links.new(curvature.outputs["Attribute"], curvature_scale.inputs["Value"])
+        node_tree.links.new(adjusted_size.outputs["Vector"], curvature_size.inputs["Vector"])
+        node_tree.links.new(curvature_scale.outputs["Result"], curvature_size.inputs["Scale"])
+        camera_selection = self.build_camera_culling(node_tree, point_normal, curvature_size, instanceOnPoint)
+        selection = self.create_node(node_tree, 'FunctionNodeBooleanMath')
+        selection.operation = 'AND'
+        selection.location = (1400, -900)
+        node_tree.links.new(camera_selection, selection.inputs[0])
+        node_tree.links.new(bound_selection, selection.inputs[1])
+        node_tree.links.new(selection.outputs["Boolean"], instanceOnPoint.inputs["Selection"])
+
+        self.count("nodes created", len(node_tree.nodes))
+        return node_tree
 
     
-    def create_geometry_nodes(self, obj, tangent_group_name, bezier_curve, brush_material):
+    # camera culling in the tangent group: drop points outside the camera frustum, widened
+    # by the margin, and points facing away from the camera. Beyond the falloff distance
+    # points are kept with probability (distance / falloff)^-2 and their strokes grow with
+    # the distance, so instances follow screen coverage. The frustum is the square around
+    # the widest field of view of the camera, which GN can not read from the camera itself.
+    # Returns the selection of the points that are kept.
+    def build_camera_culling(self, node_tree, point_normal, adjusted_size, instanceOnPoint):
+        group_input = self.create_node(node_tree, 'NodeGroupInput')
+        group_input.location = (-800, -1100)
+
+        camera_info = self.create_node(node_tree, 'GeometryNodeObjectInfo')
+        camera_info.transform_space = 'RELATIVE'
+        camera_info.location = (-600, -1100)
+
+        position = self.create_node(node_tree, 'GeometryNodeInputPosition')
+        position.location = (-600, -1300)
+
+        to_camera = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        to_camera.operation = 'SUBTRACT'
+        to_camera.location = (-400, -1100)
+
+        from_camera = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        from_camera.operation = 'SUBTRACT'
+        from_camera.location = (-400, -1300)
+
+        camera_space = self.create_node(node_tree, 'ShaderNodeVectorRotate')
+        camera_space.rotation_type = 'EULER_XYZ'
+        camera_space.invert = True
+        camera_space.location = (-200, -1300)
+
+        separate = self.create_node(node_tree, 'ShaderNodeSeparateXYZ')
+        separate.location = (0, -1300)
+
+        # the camera looks down its -Z axis
+        depth = self.create_node(node_tree, 'ShaderNodeMath')
+        depth.operation = 'MULTIPLY'
+        depth.inputs[1].default_value = -1.0
+        depth.location = (200, -1400)
+
+        half_angle = self.create_node(node_tree, 'ShaderNodeMath')
+        half_angle.operation = 'MULTIPLY'
+        half_angle.inputs[1].default_value = 0.5
+        half_angle.location = (-200, -1600)
+
+        half_width = self.create_node(node_tree, 'ShaderNodeMath')
+        half_width.operation = 'TANGENT'
+        half_width.location = (0, -1600)
+
+        margin_scale = self.create_node(node_tree, 'ShaderNodeMath')
+        margin_scale.operation = 'ADD'
+        margin_scale.inputs[1].default_value = 1.0
+        margin_scale.location = (0, -1800)
+
+        widened = self.create_node(node_tree, 'ShaderNodeMath')
+        widened.operation = 'MULTIPLY'
+        widened.location = (200, -1600)
+
+        frustum_limit = self.create_node(node_tree, 'ShaderNodeMath')
+        frustum_limit.operation = 'MULTIPLY'
+        frustum_limit.location = (400, -1500)
+
+        abs_x = self.create_node(node_tree, 'ShaderNodeMath')
+        abs_x.operation = 'ABSOLUTE'
+        abs_x.location = (200, -1200)
+
+        abs_y = self.create_node(node_tree, 'ShaderNodeMath')
+        abs_y.operation = 'ABSOLUTE'
+        abs_y.location = (200, -1300)
+
+        screen_extent = self.create_node(node_tree, 'ShaderNodeMath')
+        screen_extent.operation = 'MAXIMUM'
+        screen_extent.location = (400, -1250)
+
+        in_frustum = self.create_node(node_tree, 'FunctionNodeCompare')
+        in_frustum.data_type = 'FLOAT'
+        in_frustum.operation = 'LESS_EQUAL'
+        in_frustum.location = (600, -1300)
+
+        view_direction = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        view_direction.operation = 'NORMALIZE'
+        view_direction.location = (-200, -900)
+
+        facing = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        facing.operation = 'DOT_PRODUCT'
+        facing.location = (0, -900)
+
+        facing_limit = self.create_node(node_tree, 'ShaderNodeMath')
+        facing_limit.operation = 'MULTIPLY'
+        facing_limit.inputs[1].default_value = -1.0
+        facing_limit.location = (0, -1100)
+
+        front_facing = self.create_node(node_tree, 'FunctionNodeCompare')
+        front_facing.data_type = 'FLOAT'
+        front_facing.operation = 'GREATER_EQUAL'
+        front_facing.location = (200, -900)
+
+        distance = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        distance.operation = 'LENGTH'
+        distance.location = (-200, -700)
+
+        falloff_ratio = self.create_node(node_tree, 'ShaderNodeMath')
+        falloff_ratio.operation = 'DIVIDE'
+        falloff_ratio.location = (0, -700)
+
+        keep_probability = self.create_node(node_tree, 'ShaderNodeMath')
+        keep_probability.operation = 'POWER'
+        keep_probability.inputs[1].default_value = 2.0
+        keep_probability.location = (200, -700)
+
+        keep_random = self.create_node(node_tree, 'FunctionNodeRandomValue')
+        keep_random.data_type = 'BOOLEAN'
+        keep_random.location = (400, -700)
+
+        visible = self.create_node(node_tree, 'FunctionNodeBooleanMath')
+        visible.operation = 'AND'
+        visible.location = (800, -1000)
+
+        kept = self.create_node(node_tree, 'FunctionNodeBooleanMath')
+        kept.operation = 'AND'
+        kept.location = (1000, -900)
+
+        selection = self.create_node(node_tree, 'FunctionNodeBooleanMath')
+        selection.operation = 'IMPLY'
+        selection.label = "Camera Selection"
+        selection.location = (1200, -900)
+
+        stroke_growth = self.create_node(node_tree, 'ShaderNodeMath')
+        stroke_growth.operation = 'DIVIDE'
+        stroke_growth.location = (0, -500)
+
+        near_strokes = self.create_node(node_tree, 'ShaderNodeMath')
+        near_strokes.operation = 'MAXIMUM'
+        near_strokes.inputs[1].default_value = 1.0
+        near_strokes.location = (200, -500)
+
+        growth_switch = self.create_node(node_tree, 'GeometryNodeSwitch')
+        growth_switch.input_type = 'FLOAT'
+        growth_switch.inputs["False"].default_value = 1.0
+        growth_switch.location = (400, -500)
+
+        grown_size = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        grown_size.operation = 'SCALE'
+        grown_size.location = (900, -200)
+
+        links = node_tree.links
+        links.new(group_input.outputs["Camera"], camera_info.inputs["Object"])
+        links.new(camera_info.outputs["Location"], to_camera.inputs[0])
+        links.new(position.outputs["Position"], to_camera.inputs[1])
+        links.new(position.outputs["Position"], from_camera.inputs[0])
+        links.new(camera_info.outputs["Location"], from_camera.inputs[1])
+        links.new(from_camera.outputs["Vector"], camera_space.inputs["Vector"])
+        links.new(camera_info.outputs["Rotation"], camera_space.inputs["Rotation"])
+        links.new(camera_space.outputs["Vector"], separate.inputs["Vector"])
+        links.new(separate.outputs["Z"], depth.inputs[0])
+        links.new(group_input.outputs["Field of View"], half_angle.inputs[0])
+        links.new(half_angle.outputs["Value"], half_width.inputs[0])
+        links.new(group_input.outputs["Frustum Margin"], margin_scale.inputs[0])
+        links.new(half_width.outputs["Value"], widened.inputs[0])
+        links.new(margin_scale.outputs["Value"], widened.inputs[1])
+        links.new(widened.outputs["Value"], frustum_limit.inputs[0])
+        links.new(depth.outputs["Value"], frustum_limit.inputs[1])
+        links.new(separate.outputs["X"], abs_x.inputs[0])
+        links.new(separate.outputs["Y"], abs_y.inputs[0])
+        links.new(abs_x.outputs["Value"], screen_extent.inputs[0])
+        links.new(abs_y.outputs["Value"], screen_extent.inputs[1])
+        links.new(screen_extent.outputs["Value"], in_frustum.inputs["A"])
+        links.new(frustum_limit.outputs["Value"], in_frustum.inputs["B"])
+
+        links.new(to_camera.outputs["Vector"], view_direction.inputs[0])
+        links.new(view_direction.outputs["Vector"], facing.inputs[0])
+        links.new(point_normal, facing.inputs[1])
+        links.new(group_input.outputs["Frustum Margin"], facing_limit.inputs[0])
+        links.new(facing.outputs["Value"], front_facing.inputs["A"])
+        links.new(facing_limit.outputs["Value"], front_facing.inputs["B"])
+
+        links.new(to_camera.outputs["Vector"], distance.inputs[0])
+        links.new(group_input.outputs["Falloff Distance"], falloff_ratio.inputs[0])
+        links.new(distance.outputs["Value"], falloff_ratio.inputs[1])
+        links.new(falloff_ratio.outputs["Value"], keep_probability.inputs[0])
+        links.new(keep_probability.outputs["Value"], keep_random.inputs["Probability"])
+
+        links.new(in_frustum.outputs["Result"], visible.inputs[0])
+        links.new(front_facing.outputs["Result"], visible.inputs[1])
+        links.new(visible.outputs["Boolean"], kept.inputs[0])
+        links.new(keep_random.outputs[3], kept.inputs[1])
+        links.new(group_input.outputs["Camera Culling"], selection.inputs[0])
+        links.new(kept.outputs["Boolean"], selection.inputs[1])
+
+        links.new(distance.outputs["Value"], stroke_growth.inputs[0])
+        links.new(group_input.outputs["Falloff Distance"], stroke_growth.inputs[1])
+        links.new(stroke_growth.outputs["Value"], near_strokes.inputs[0])
+        links.new(group_input.outputs["Camera Culling"], growth_switch.inputs["Switch"])
+        links.new(near_strokes.outputs["Value"], growth_switch.inputs["True"])
+        links.new(adjusted_size.outputs["Vector"], grown_size.inputs["Vector"])
+        links.new(growth_switch.outputs["Output"], grown_size.inputs["Scale"])
+        links.new(grown_size.outputs["Vector"], instanceOnPoint.inputs["Scale"])
+        return selection.outputs["Boolean"]
+
+
+
+    # deforming mode of the tangent group: instead of scattering over the evaluated mesh,
+    # take the strokes bound to its rest triangles and move them onto the deformed triangles.
+    # Per frame this reads three corner positions per stroke, so the strokes stick to the
+    # surface and cost grows with their number only. Returns the points, their normal and
+    # guide direction fields and the selection of the bound strokes within the density;
+    # with Deforming off those are the scattered points, their fields and all points.
+    def build_deforming_points(self, node_tree, distributePoint, guide_tangent, clamped_density):
+        group_input = self.create_node(node_tree, 'NodeGroupInput')
+        group_input.location = (-800, 1000)
+
+        binding_info = self.create_node(node_tree, 'GeometryNodeObjectInfo')
+        binding_info.transform_space = 'ORIGINAL'
+        binding_info.location = (-600, 1000)
+
+        position = self.create_node(node_tree, 'GeometryNodeInputPosition')
+        position.location = (-600, 800)
+
+        corners = []
+        for i, name in enumerate(ATTRIBUTE_BIND_VERTICES):
+            corner_index = self.create_node(node_tree, 'GeometryNodeInputNamedAttribute')
+            corner_index.data_type = 'INT'
+            corner_index.inputs["Name"].default_value = name
+            corner_index.location = (-600, 600 - 200 * i)
+
+            corner = self.create_node(node_tree, 'GeometryNodeSampleIndex')
+            corner.data_type = 'FLOAT_VECTOR'
+            corner.domain = 'POINT'
+            corner.location = (-400, 800 - 200 * i)
+            node_tree.links.new(group_input.outputs["Mesh"], corner.inputs["Geometry"])
+            node_tree.links.new(position.outputs["Position"], corner.inputs["Value"])
+            node_tree.links.new(corner_index.outputs["Attribute"], corner.inputs["Index"])
+            corners.append(corner.outputs["Value"])
+
+        edge_b = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        edge_b.operation = 'SUBTRACT'
+        edge_b.location = (-200, 800)
+
+        edge_c = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        edge_c.operation = 'SUBTRACT'
+        edge_c.location = (-200, 600)
+
+        # position: a + wb (b - a) + wc (c - a), with the weights summing to one
+        weights = self.create_node(node_tree, 'GeometryNodeInputNamedAttribute')
+        weights.data_type = 'FLOAT_VECTOR'
+        weights.inputs["Name"].default_value = ATTRIBUTE_BIND_WEIGHTS
+        weights.location = (-400, 200)
+
+        tangent_coefficients = self.create_node(node_tree, 'GeometryNodeInputNamedAttribute')
+        tangent_coefficients.data_type = 'FLOAT_VECTOR'
+        tangent_coefficients.inputs["Name"].default_value = ATTRIBUTE_BIND_TANGENT
+        tangent_coefficients.location = (-400, 0)
+
+        combined = []
+        for i, (coefficients, x, y) in enumerate(((weights, "Y", "Z"), (tangent_coefficients, "X", "Y"))):
+            separate = self.create_node(node_tree, 'ShaderNodeSeparateXYZ')
+            separate.location = (-200, 200 - 300 * i)
+
+            along_b = self.create_node(node_tree, 'ShaderNodeVectorMath')
+            along_b.operation = 'SCALE'
+            along_b.location = (0, 300 - 300 * i)
+
+            along_c = self.create_node(node_tree, 'ShaderNodeVectorMath')
+            along_c.operation = 'SCALE'
+            along_c.location = (0, 100 - 300 * i)
+
+            sum_bc = self.create_node(node_tree, 'ShaderNodeVectorMath')
+            sum_bc.operation = 'ADD'
+            sum_bc.location = (200, 200 - 300 * i)
+
+            node_tree.links.new(coefficients.outputs["Attribute"], separate.inputs["Vector"])
+            node_tree.links.new(edge_b.outputs["Vector"], along_b.inputs["Vector"])
+            node_tree.links.new(separate.outputs[x], along_b.inputs["Scale"])
+            node_tree.links.new(edge_c.outputs["Vector"], along_c.inputs["Vector"])
+            node_tree.links.new(separate.outputs[y], along_c.inputs["Scale"])
+            node_tree.links.new(along_b.outputs["Vector"], sum_bc.inputs[0])
+            node_tree.links.new(along_c.outputs["Vector"], sum_bc.inputs[1])
+            combined.append(sum_bc)
+
+        deformed_position = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        deformed_position.operation = 'ADD'
+        deformed_position.location = (400, 300)
+
+        face_normal = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        face_normal.operation = 'CROSS_PRODUCT'
+        face_normal.location = (0, 700)
+
+        unit_normal = self.create_node(node_tree, 'ShaderNodeVectorMath')
+        unit_normal.operation = 'NORMALIZE'
+        unit_normal.location = (200, 700)
+
+        set_position = self.create_node(node_tree, 'GeometryNodeSetPosition')
+        set_position.location = (600, 1000)
+
+        # captured so the fields hold on the instances, where the painter tree reads the normal
+        capture = self.create_node(node_tree, 'GeometryNodeCaptureAttribute')
+        capture.domain = 'POINT'
+        capture.capture_items.new('VECTOR', "Normal")
+        capture.capture_items.new('VECTOR', "Tangent")
+        capture.location = (800, 1000)
+
+        # strokes beyond the density: bound at BIND_DENSITY, shown while rank * BIND_DENSITY < density
+        rank = self.create_node(node_tree, 'GeometryNodeInputNamedAttribute')
+        rank.data_type = 'FLOAT'
+        rank.inputs["Name"].default_value = ATTRIBUTE_BIND_RANK
+        rank.location = (400, -300)
+
+        scaled_rank = self.create_node(node_tree, 'ShaderNodeMath')
+        scaled_rank.operation = 'MULTIPLY'
+        scaled_rank.inputs[1].default_value = BIND_DENSITY
+        scaled_rank.location = (600, -300)
+
+        within_density = self.create_node(node_tree, 'FunctionNodeCompare')
+        within_density.data_type = 'FLOAT'
+        within_density.operation = 'LESS_THAN'
+        within_density.location = (800, -300)
+
+        bound_selection = self.create_node(node_tree, 'FunctionNodeBooleanMath')
+        bound_selection.operation = 'IMPLY'
+        bound_selection.location = (1000, -300)
+
+        points_switch = self.create_node(node_tree, 'GeometryNodeSwitch')
+        points_switch.input_type = 'GEOMETRY'
+        points_switch.location = (1000, 1000)
+
+        normal_switch = self.create_node(node_tree, 'GeometryNodeSwitch')
+        normal_switch.input_type = 'VECTOR'
+        normal_switch.location = (1000, 800)
+
+        tangent_switch = self.create_node(node_tree, 'GeometryNodeSwitch')
+        tangent_switch.input_type = 'VECTOR'
+        tangent_switch.location = (1000, 600)
+
+        links = node_tree.links
+        links.new(group_input.outputs["Binding"], binding_info.inputs["Object"])
+        links.new(corners[1], edge_b.inputs[0])
+        links.new(corners[0], edge_b.inputs[1])
+        links.new(corners[2], edge_c.inputs[0])
+        links.new(corners[0], edge_c.inputs[1])
+        links.new(corners[0], deformed_position.inputs[0])
+        links.new(combined[0].outputs["Vector"], deformed_position.inputs[1])
+        links.new(edge_b.outputs["Vector"], face_normal.inputs[0])
+        links.new(edge_c.outputs["Vector"], face_normal.inputs[1])
+        links.new(face_normal.outputs["Vector"], unit_normal.inputs[0])
+
+        links.new(binding_info.outputs["Geometry"], set_position.inputs["Geometry"])
+        links.new(deformed_position.outputs["Vector"], set_position.inputs["Position"])
+        links.new(set_position.outputs["Geometry"], capture.inputs["Geometry"])
+        links.new(unit_normal.outputs["Vector"], capture.inputs["Normal"])
+        links.new(combined[1].outputs["Vector"], capture.inputs["Tangent"])
+
+        links.new(group_input.outputs["Deforming"], points_switch.inputs["Switch"])
+        links.new(distributePoint.outputs["Points"], points_switch.inputs["False"])
+        links.new(capture.outputs["Geometry"], points_switch.inputs["True"])
+        links.new(group_input.outputs["Deforming"], normal_switch.inputs["Switch"])
+        links.new(distributePoint.outputs["Normal"], normal_switch.inputs["False"])
+        links.new(capture.outputs["Normal"], normal_switch.inputs["True"])
+        links.new(group_input.outputs["Deforming"], tangent_switch.inputs["Switch"])
+        links.new(guide_tangent.outputs["Attribute"], tangent_switch.inputs["False"])
+        links.new(capture.outputs["Tangent"], tangent_switch.inputs["True"])
+
+        links.new(rank.outputs["Attribute"], scaled_rank.inputs[0])
+        links.new(scaled_rank.outputs["Value"], within_density.inputs["A"])
+        links.new(clamped_density.outputs["Value"], within_density.inputs["B"])
+        links.new(group_input.outputs["Deforming"], bound_selection.inputs[0])
+        links.new(within_density.outputs["Result"], bound_selection.inputs[1])
+        return (points_switch.outputs["Output"], normal_switch.outputs["Output"],
+                tangent_switch.outputs["Output"], bound_selection.outputs["Boolean"])
+
+    
+    # binding is the surface binding object of a deforming object, None for static ones.
+    # styles are the stroke atlas styles the instances pick from, empty without an atlas.
+    def create_geometry_nodes(self, obj, tangent_group_name, bezier_curve, brush_material, binding=None, styles=()):
             
         node_tree = None
 
         # Check if the object has a geometry nodes modifier
         if obj.modifiers and obj.modifiers.get("GeometryNodes"):
-            print("get existing")
             # Get the geometry nodes modifier
             modifier = obj.modifiers["GeometryNodes"]
 
             # Access the node tree
             node_tree = modifier.node_group
+            # linked duplicates and copied modifiers share the tree, but the values set
+            # below are per object
+            if node_tree is not None and node_tree.users > 1:
+                node_tree = node_tree.copy()
+                modifier.node_group = node_tree
         else:
-            print("creating new")
             modifier = obj.modifiers.new(name="GeometryNodes", type='NODES')
 
             node_tree = bpy.data.node_groups.new(GEOMETRY_NAME, 'GeometryNodeTree')
@@ -264,6 +2558,56 @@ class ObjectPainterEffect(bpy.types.Operator):
         if node_tree is None:
             self.report({'ERROR'}, "Failed to create or access the Geometry Nodes node tree.")
             return 
+
+        # the graph only depends on the layout version, per object values are set below
+        if node_tree.get(GEOMETRY_VERSION_PROPERTY) != GEOMETRY_TREE_VERSION or any(
+                name not in node_tree.nodes for name in (TANGENT_NODE_NAME, CARD_NODE_NAME, CARD_SIZE_NODE_NAME, OFFSET_NODE_NAME, MATERIAL_NODE_NAME,
+                                              POINTS_NODE_NAME, f"{STYLE_NODE_NAME} 0")):
+            self.build_geometry_nodes(obj, node_tree)
+            node_tree[GEOMETRY_VERSION_PROPERTY] = GEOMETRY_TREE_VERSION
+            self.count("nodes created", len(node_tree.nodes), obj)
+
+        nodes = node_tree.nodes
+        tangent_transfer = nodes[TANGENT_NODE_NAME]
+        tangent_group = bpy.data.node_groups[tangent_group_name]
+        if tangent_transfer.node_tree != tangent_group:
+            tangent_transfer.node_tree = tangent_group
+        set_socket_value(tangent_transfer.inputs[2], bezier_curve)
+        set_socket_value(tangent_transfer.inputs["Default Density"], self.get_default_density(obj))
+        set_socket_value(tangent_transfer.inputs["Deforming"], binding is not None)
+        if binding is not None:
+            set_socket_value(tangent_transfer.inputs["Binding"], binding)
+        set_socket_value(nodes[CARD_NODE_NAME].inputs["Object"], get_brush_card())
+        # the card is unit sized, the object's stroke size is part of the instance scale
+        grid_x, grid_y = self.get_default_grid_size(obj)
+        card_size = nodes[CARD_SIZE_NODE_NAME].inputs[1].default_value
+        if not all(math.isclose(a, b, rel_tol=1e-6) for a, b in zip(card_size, (grid_x, grid_y, 1.0))):
+            card_size[:] = (grid_x, grid_y, 1.0)
+        translate_z = self.get_default_translate_z(obj)
+        offset = nodes[OFFSET_NODE_NAME].inputs[1].default_value
+        if not math.isclose(offset[2], translate_z, rel_tol=1e-6):
+            offset[2] = translate_z
+        set_socket_value(nodes[MATERIAL_NODE_NAME].inputs[2], brush_material)
+        set_socket_value(nodes[POINTS_NODE_NAME].inputs["Radius"], grid_x / 4)
+        # the object's weights pick the atlas styles, equal until the user sets them
+        if styles and STYLE_WEIGHTS_PROPERTY not in obj:
+            obj[STYLE_WEIGHTS_PROPERTY] = {style: 1.0 for style in styles}
+        weights = obj[STYLE_WEIGHTS_PROPERTY].to_dict() if styles else {}
+        for i, threshold in enumerate(style_thresholds(styles, weights)):
+            set_socket_value(nodes[f"{STYLE_NODE_NAME} {i}"].inputs["B"], threshold)
+        # earlier versions gave every modifier the scene camera, culling or not
+        set_camera_culling(obj, None, bpy.context.scene.camera)
+        # earlier versions drove the look properties from the modifier inputs
+        if obj.animation_data is not None:
+            for prop, _, _ in LOOK_PROPERTIES:
+                obj.driver_remove(f'["{prop}"]')
+        sync_look_properties(obj)
+
+
+
+    # build the painter graph into node_tree. Nodes with per object values are named so
+    # create_geometry_nodes can update them without rebuilding.
+    def build_geometry_nodes(self, obj, node_tree):
         node_tree.nodes.clear()
 
    
@@ -334,100 +2678,59 @@ class ObjectPainterEffect(bpy.types.Operator):
             gamma.min_value = 0.0
             gamma.max_value = 10.0
 
-        store_brightness = self.create_node(node_tree, "GeometryNodeStoreNamedAttribute")
-        store_brightness.inputs["Name"].default_value = ATTRIBUTE_BRIGHTNESS
-        store_brightness.data_type = 'FLOAT'
-        store_brightness.domain = "INSTANCE" 
-        store_brightness.location = (1400, -400)
-
-        store_contrast = self.create_node(node_tree, "GeometryNodeStoreNamedAttribute")
-        store_contrast.inputs["Name"].default_value = ATTRIBUTE_CONTRAST
-        store_contrast.data_type = 'FLOAT'
-        store_contrast.domain = "INSTANCE" 
-        store_contrast.location = (1600, -400)
-
-        store_alpha = self.create_node(node_tree, "GeometryNodeStoreNamedAttribute")
-        store_alpha.inputs["Name"].default_value = ATTRIBUTE_ALPHA
-        store_alpha.data_type = 'FLOAT'
-        store_alpha.domain = "INSTANCE" 
-        store_alpha.location = (1800, -400)
-
-        store_gamma = self.create_node(node_tree, "GeometryNodeStoreNamedAttribute")
-        store_gamma.inputs["Name"].default_value = ATTRIBUTE_GAMMA
-        store_gamma.data_type = 'FLOAT'
-        store_gamma.domain = "INSTANCE" 
-        store_gamma.location = (2000, -400)
+        # added after the first release, so older trees get them on rebuild
+        if not any(item.item_type == 'PANEL' and item.name == "Camera" for item in node_tree.interface.items_tree):
+            self.create_camera_sockets(obj, node_tree)
+        if not any(item.item_type == 'PANEL' and item.name == "Viewport" for item in node_tree.interface.items_tree):
+            self.create_viewport_sockets(obj, node_tree)
+        if find_input_socket(node_tree, "Bake Points") is None:
+            bake_points = node_tree.interface.new_socket(name="Bake Points", in_out='INPUT', socket_type='NodeSocketBool')
+            bake_points.hide_in_modifier = True
 
         brush_scale = self.create_node(node_tree, "ShaderNodeCombineXYZ")
         brush_scale.label = "Brush Scale"
         brush_scale.location = (200,200)
 
         tangent_transfer = self.create_node(node_tree, "GeometryNodeGroup")
-        tangent_transfer.node_tree = bpy.data.node_groups[tangent_group_name]
-        tangent_transfer.inputs[2].default_value = bezier_curve
+        tangent_transfer.name = TANGENT_NODE_NAME
+        tangent_transfer.node_tree = bpy.data.node_groups[self.create_tangent_tracer_group()]
         tangent_transfer.location = (400, 200)
 
-        grid = self.create_node(node_tree, "GeometryNodeMeshGrid")
-        grid.inputs[0].default_value, grid.inputs[1].default_value = self.get_default_grid_size(obj)
-        grid.location = (200, -100)
-        
-        store_uv_map = self.create_node(node_tree, "GeometryNodeStoreNamedAttribute")
-        store_uv_map.inputs["Name"].default_value = ATTRIBUTE_UVMAP
-        store_uv_map.data_type = 'FLOAT_VECTOR'
-        store_uv_map.domain = "POINT" 
-        store_uv_map.location = (400, -100)
+        card_size = self.create_node(node_tree, "ShaderNodeVectorMath")
+        card_size.name = CARD_SIZE_NODE_NAME
+        card_size.operation = 'MULTIPLY'
+        card_size.location = (300, 300)
+
+        brush_card = self.create_node(node_tree, "GeometryNodeObjectInfo")
+        brush_card.name = CARD_NODE_NAME
+        brush_card.transform_space = 'ORIGINAL'
+        brush_card.location = (200, -100)
         
         translateBrush = self.create_node(node_tree, "GeometryNodeTranslateInstances")
         translateBrush.location = (800, 200)
         
         zRamdon = self.create_node(node_tree, "FunctionNodeRandomValue")
+        zRamdon.name = OFFSET_NODE_NAME
         zRamdon.location = (600, 0)
         zRamdon.data_type = 'FLOAT_VECTOR'
         zRamdon.inputs[1].default_value[0]=0.0
         zRamdon.inputs[1].default_value[1]=0.0
-        zRamdon.inputs[1].default_value[2]= self.get_default_translate_z(obj)
         
+        # per instance data is packed into one color attribute: the normal and the atlas style.
+        # The color jitter comes from the instance random value in the shader and uniform
+        # values from object properties
         store_normal = self.create_node(node_tree, "GeometryNodeStoreNamedAttribute")
-        store_normal.inputs["Name"].default_value = ATTRIBUTE_NORMAL
-        store_normal.data_type = 'FLOAT_VECTOR'
+        store_normal.inputs["Name"].default_value = ATTRIBUTE_INSTANCE
+        store_normal.data_type = 'FLOAT_COLOR'
         store_normal.domain = "INSTANCE" 
         store_normal.location = (1000, 0)
 
-        color_value = self.create_node(node_tree, "ShaderNodeCombineXYZ")
-        color_value.label = "Color Value"
-        color_value.location = (800,700)
-        
-        color_randomness = self.create_node(node_tree, "ShaderNodeCombineXYZ")
-        color_randomness.label = "Color Randomness"
-        color_randomness.location = (800,500)
-
-        color_subtract = self.create_node(node_tree, "ShaderNodeMath")
-        color_subtract.label = "Color Substract"
-        color_subtract.operation= 'SUBTRACT'
-        color_subtract.location = (1000,700)
-
-        color_add = self.create_node(node_tree, "ShaderNodeMath")
-        color_add.label = "Color Add"
-        color_add.location = (1000,500)
-
-        random_value = self.create_node(node_tree, "FunctionNodeRandomValue")
-        random_value.data_type = 'FLOAT_VECTOR'
-        random_value.label = "Color Adjustment Node"
-        random_value.data_type = 'FLOAT_VECTOR'
-        random_value.location = (1000, 300)
-                
-        store_random = self.create_node(node_tree, "GeometryNodeStoreNamedAttribute")
-        store_random.inputs["Name"].default_value = ATTRIBUTE_RANDOM
-        store_random.data_type = 'FLOAT_VECTOR'
-        store_random.domain = "INSTANCE" 
-        store_random.location = (1200, 0)
-        
         joinGeometry = self.create_node(node_tree, "GeometryNodeJoinGeometry")
         joinGeometry.location = (1600, 0)
         
         set_material = self.create_node(node_tree, "GeometryNodeSetMaterial")
+        set_material.name = MATERIAL_NODE_NAME
         set_material.location = (1400, 0)
-        set_material.inputs[2].default_value = brush_material
         
         self_object = self.create_node(node_tree, 'GeometryNodeSelfObject')
         self_object.location = (200, 500)
@@ -439,331 +2742,570 @@ class ObjectPainterEffect(bpy.types.Operator):
         vector_rotate = self.create_node(node_tree, "ShaderNodeVectorRotate")
         vector_rotate.rotation_type = 'EULER_XYZ' 
         vector_rotate.location = (600, 500)
+
+        separate_normal = self.create_node(node_tree, "ShaderNodeSeparateXYZ")
+        separate_normal.location = (800, 500)
+
+        pack_instance = self.create_node(node_tree, "FunctionNodeCombineColor")
+        pack_instance.location = (1000, 500)
+
+        # atlas style of each instance: 1 + the number of thresholds its random value reaches
+        style_random = self.create_node(node_tree, "FunctionNodeRandomValue")
+        style_random.data_type = 'FLOAT'
+        style_random.inputs["Seed"].default_value = 1
+        style_random.location = (400, 900)
+        style_index = None
+        for i in range(MAX_ATLAS_STYLES - 1):
+            threshold = self.create_node(node_tree, "FunctionNodeCompare")
+            threshold.name = f"{STYLE_NODE_NAME} {i}"
+            threshold.data_type = 'FLOAT'
+            threshold.operation = 'GREATER_EQUAL'
+            threshold.location = (600, 900 + 200 * i)
+            node_tree.links.new(style_random.outputs["Value"], threshold.inputs["A"])
+
+            count_style = self.create_node(node_tree, "ShaderNodeMath")
+            count_style.operation = 'ADD'
+            count_style.location = (800, 900 + 200 * i)
+            if style_index is None:
+                count_style.inputs[0].default_value = 1.0
+            else:
+                node_tree.links.new(style_index.outputs["Value"], count_style.inputs[0])
+            node_tree.links.new(threshold.outputs["Result"], count_style.inputs[1])
+            style_index = count_style
         
+        # viewport preview: fewer strokes, or only their positions as points. The switches
+        # evaluate lazily, so the render branch costs nothing in the viewport.
+        is_viewport = self.create_node(node_tree, 'GeometryNodeIsViewport')
+        is_viewport.location = (0, 900)
+
+        density_switch = self.create_node(node_tree, 'GeometryNodeSwitch')
+        density_switch.input_type = 'FLOAT'
+        density_switch.inputs["False"].default_value = 1.0
+        density_switch.location = (200, 900)
+
+        viewport_density = self.create_node(node_tree, 'ShaderNodeMath')
+        viewport_density.label = "Viewport Density"
+        viewport_density.operation = 'MULTIPLY'
+        viewport_density.location = (200, 700)
+
+        show_points = self.create_node(node_tree, 'FunctionNodeBooleanMath')
+        show_points.operation = 'AND'
+        show_points.location = (1200, 900)
+
+        preview_points = self.create_node(node_tree, 'GeometryNodeInstancesToPoints')
+        preview_points.name = POINTS_NODE_NAME
+        preview_points.location = (1200, 700)
+
+        preview_switch = self.create_node(node_tree, 'GeometryNodeSwitch')
+        preview_switch.input_type = 'GEOMETRY'
+        preview_switch.label = "Viewport Preview"
+        preview_switch.location = (1500, 300)
+
+        # bake mode: only the strokes, as vertices carrying the attributes the shader reads
+        # and their rotation and scale, so bake_objects reads exactly what is shown
+        store_rotation = self.create_node(node_tree, "GeometryNodeStoreNamedAttribute")
+        store_rotation.inputs["Name"].default_value = ATTRIBUTE_ROTATION
+        store_rotation.data_type = 'FLOAT_VECTOR'
+        store_rotation.domain = 'INSTANCE'
+        store_rotation.location = (1200, -300)
+
+        instance_rotation = self.create_node(node_tree, "GeometryNodeInputInstanceRotation")
+        instance_rotation.location = (1000, -500)
+
+        store_scale = self.create_node(node_tree, "GeometryNodeStoreNamedAttribute")
+        store_scale.inputs["Name"].default_value = ATTRIBUTE_SCALE
+        store_scale.data_type = 'FLOAT_VECTOR'
+        store_scale.domain = 'INSTANCE'
+        store_scale.location = (1400, -300)
+
+        instance_scale = self.create_node(node_tree, "GeometryNodeInputInstanceScale")
+        instance_scale.location = (1200, -500)
+
+        bake_points = self.create_node(node_tree, "GeometryNodeInstancesToPoints")
+        bake_points.location = (1600, -300)
+
+        bake_vertices = self.create_node(node_tree, "GeometryNodePointsToVertices")
+        bake_vertices.location = (1800, -300)
+
+        bake_switch = self.create_node(node_tree, 'GeometryNodeSwitch')
+        bake_switch.input_type = 'GEOMETRY'
+        bake_switch.label = "Bake Points"
+        bake_switch.location = (1800, 0)
+
         group_output = self.create_node(node_tree, 'NodeGroupOutput')
-        group_output.location = (1800, 0)
-        node_tree.interface.new_socket(name="Geometry", in_out="INPUT", socket_type="NodeSocketGeometry")
-        node_tree.interface.new_socket(name="Geometry", in_out="OUTPUT", socket_type="NodeSocketGeometry")
+        group_output.location = (2000, 0)
+        # one geometry socket each way; earlier versions appended another pair on every apply
+        for in_out in ("INPUT", "OUTPUT"):
+            geometry_sockets = [item for item in node_tree.interface.items_tree if item.item_type == 'SOCKET'
+                                and item.in_out == in_out and item.socket_type == "NodeSocketGeometry"]
+            if not geometry_sockets:
+                node_tree.interface.new_socket(name="Geometry", in_out=in_out, socket_type="NodeSocketGeometry")
+            for extra_socket in geometry_sockets[1:]:
+                node_tree.interface.remove(extra_socket)
         
         node_tree.links.new(group_input.outputs["Geometry"], tangent_transfer.inputs["Mesh"])
-        node_tree.links.new(group_input.outputs["Density"],tangent_transfer.inputs["Density"])
+        node_tree.links.new(group_input.outputs["Density"], viewport_density.inputs[0])
+        node_tree.links.new(is_viewport.outputs["Is Viewport"], density_switch.inputs["Switch"])
+        node_tree.links.new(group_input.outputs["Viewport Density"], density_switch.inputs["True"])
+        node_tree.links.new(density_switch.outputs["Output"], viewport_density.inputs[1])
+        node_tree.links.new(viewport_density.outputs["Value"], tangent_transfer.inputs["Density"])
         node_tree.links.new(group_input.outputs["Scale: X"], brush_scale.inputs["X"])
         node_tree.links.new(group_input.outputs["Scale: Y"], brush_scale.inputs["Y"])
         node_tree.links.new(group_input.outputs["Scale: Z"], brush_scale.inputs["Z"])
-        node_tree.links.new(brush_scale.outputs["Vector"],tangent_transfer.inputs["Scale"])
-        node_tree.links.new(group_input.outputs[5], color_value.inputs["X"])
-        node_tree.links.new(group_input.outputs[6], color_value.inputs["Y"])
-        node_tree.links.new(group_input.outputs[7], color_value.inputs["Z"])
-        node_tree.links.new(group_input.outputs[8], color_randomness.inputs["X"])
-        node_tree.links.new(group_input.outputs[9], color_randomness.inputs["Y"])
-        node_tree.links.new(group_input.outputs[10], color_randomness.inputs["Z"])
-
-        node_tree.links.new(group_input.outputs[11], store_brightness.inputs["Value"])
-        node_tree.links.new(store_random.outputs["Geometry"], store_brightness.inputs["Geometry"])
-        node_tree.links.new(group_input.outputs[12], store_contrast.inputs["Value"])
-        node_tree.links.new(store_brightness.outputs["Geometry"], store_contrast.inputs["Geometry"])
-        node_tree.links.new(group_input.outputs[13], store_alpha.inputs["Value"])
-        node_tree.links.new(store_contrast.outputs["Geometry"], store_alpha.inputs["Geometry"])
-        node_tree.links.new(group_input.outputs[14], store_gamma.inputs["Value"])
-        node_tree.links.new(store_alpha.outputs["Geometry"], store_gamma.inputs["Geometry"])
-
-        node_tree.links.new(color_value.outputs["Vector"], color_subtract.inputs[0])
-        node_tree.links.new(color_randomness.outputs["Vector"], color_subtract.inputs[1])
-        node_tree.links.new(color_value.outputs["Vector"], color_add.inputs[0])
-        node_tree.links.new(color_randomness.outputs["Vector"], color_add.inputs[1])
-        node_tree.links.new(color_subtract.outputs["Value"], random_value.inputs["Min"])
-        node_tree.links.new(color_add.outputs["Value"], random_value.inputs["Max"])
-        node_tree.links.new(grid.outputs["Mesh"], store_uv_map.inputs["Geometry"])
-        node_tree.links.new(grid.outputs["UV Map"], store_uv_map.inputs["Value"])
-        node_tree.links.new(store_uv_map.outputs["Geometry"], tangent_transfer.inputs["Instance"])
+        node_tree.links.new(brush_scale.outputs["Vector"], card_size.inputs[0])
+        node_tree.links.new(card_size.outputs["Vector"], tangent_transfer.inputs["Scale"])
+
+        node_tree.links.new(brush_card.outputs["Geometry"], tangent_transfer.inputs["Instance"])
         node_tree.links.new(tangent_transfer.outputs["Instances"], translateBrush.inputs["Instances"])
         node_tree.links.new(zRamdon.outputs["Value"], translateBrush.inputs["Translation"])
         node_tree.links.new(translateBrush.outputs["Instances"], store_normal.inputs["Geometry"])
-        node_tree.links.new(random_value.outputs["Value"], store_random.inputs["Value"])
-        node_tree.links.new(store_normal.outputs["Geometry"], store_random.inputs["Geometry"])
-        node_tree.links.new(store_gamma.outputs["Geometry"], set_material.inputs["Geometry"])
-        node_tree.links.new(set_material.outputs["Geometry"], joinGeometry.inputs["Geometry"])
+        node_tree.links.new(store_normal.outputs["Geometry"], set_material.inputs["Geometry"])
+        node_tree.links.new(set_material.outputs["Geometry"], preview_switch.inputs["False"])
+        node_tree.links.new(tangent_transfer.outputs["Instances"], preview_points.inputs["Instances"])
+        node_tree.links.new(preview_points.outputs["Points"], preview_switch.inputs["True"])
+        node_tree.links.new(is_viewport.outputs["Is Viewport"], show_points.inputs[0])
+        node_tree.links.new(group_input.outputs["Viewport Points"], show_points.inputs[1])
+        node_tree.links.new(show_points.outputs["Boolean"], preview_switch.inputs["Switch"])
+        node_tree.links.new(preview_switch.outputs["Output"], joinGeometry.inputs["Geometry"])
 
         node_tree.links.new(group_input.outputs["Geometry"], joinGeometry.inputs["Geometry"])
         node_tree.links.new(self_object.outputs["Self Object"], object_info.inputs["Object"])
         node_tree.links.new(object_info.outputs["Rotation"], vector_rotate.inputs["Rotation"])
         node_tree.links.new(tangent_transfer.outputs["Normal"], vector_rotate.inputs["Vector"])
-        node_tree.links.new(vector_rotate.outputs["Vector"], store_normal.inputs["Value"])
-        node_tree.links.new(joinGeometry.outputs["Geometry"], group_output.inputs["Geometry"])
-
-
-
-    def create_shader(self, obj, stroke_style):
-        material = None
-        existing_texture_node = None
-
-        for m in obj.data.materials:
-            if m.name.startswith(SHADER_NAME):
-                material = m
-                nodes = material.node_tree.nodes
-                for node in nodes:
-                    if node.type == "TEX_IMAGE":
-                        existing_texture_node = node
-                break
-                
-        
-        existing_material = obj.active_material
+        node_tree.links.new(vector_rotate.outputs["Vector"], separate_normal.inputs["Vector"])
+        node_tree.links.new(separate_normal.outputs["X"], pack_instance.inputs["Red"])
+        node_tree.links.new(separate_normal.outputs["Y"], pack_instance.inputs["Green"])
+        node_tree.links.new(separate_normal.outputs["Z"], pack_instance.inputs["Blue"])
+        node_tree.links.new(style_index.outputs["Value"], pack_instance.inputs["Alpha"])
+        node_tree.links.new(pack_instance.outputs["Color"], store_normal.inputs["Value"])
+        node_tree.links.new(store_normal.outputs["Geometry"], store_rotation.inputs["Geometry"])
+        node_tree.links.new(instance_rotation.outputs["Rotation"], store_rotation.inputs["Value"])
+        node_tree.links.new(store_rotation.outputs["Geometry"], store_scale.inputs["Geometry"])
+        node_tree.links.new(instance_scale.outputs["Scale"], store_scale.inputs["Value"])
+        node_tree.links.new(store_scale.outputs["Geometry"], bake_points.inputs["Instances"])
+        node_tree.links.new(bake_points.outputs["Points"], bake_vertices.inputs["Points"])
+        node_tree.links.new(group_input.outputs["Bake Points"], bake_switch.inputs["Switch"])
+        node_tree.links.new(joinGeometry.outputs["Geometry"], bake_switch.inputs["False"])
+        node_tree.links.new(bake_vertices.outputs["Mesh"], bake_switch.inputs["True"])
+        node_tree.links.new(bake_switch.outputs["Output"], group_output.inputs["Geometry"])
+        for name in ("Camera", "Camera Culling", "Field of View", "Frustum Margin", "Falloff Distance"):
+            node_tree.links.new(group_input.outputs[name], tangent_transfer.inputs[name])
+
+
+
+    # viewport preview inputs of the modifier: a quarter of the strokes while working,
+    # full density in renders
+    def create_viewport_sockets(self, obj, node_tree):
+        modifier = obj.modifiers["GeometryNodes"]
+        viewport_panel = node_tree.interface.new_panel(name="Viewport", default_closed=True)
+        density = node_tree.interface.new_socket(name="Viewport Density", in_out='INPUT', socket_type='NodeSocketFloat', parent=viewport_panel)
+        density.subtype = 'FACTOR'
+        density.min_value = 0.0
+        density.max_value = 1.0
+        modifier[density.identifier] = 0.25
+        points = node_tree.interface.new_socket(name="Viewport Points", in_out='INPUT', socket_type='NodeSocketBool', parent=viewport_panel)
+        modifier[points.identifier] = False
+
+
+
+    # optional camera culling inputs of the modifier, off until Camera Culling is enabled,
+    # see set_camera_culling. They start from the scene camera's field of view, with full
+    # density up to ten object sizes away.
+    def create_camera_sockets(self, obj, node_tree):
+        modifier = obj.modifiers["GeometryNodes"]
+        camera = bpy.context.scene.camera
+        camera_panel = node_tree.interface.new_panel(name="Camera", default_closed=True)
+        node_tree.interface.new_socket(name="Camera", in_out='INPUT', socket_type='NodeSocketObject', parent=camera_panel)
+        culling = node_tree.interface.new_socket(name="Camera Culling", in_out='INPUT', socket_type='NodeSocketBool', parent=camera_panel)
+        modifier[culling.identifier] = False
+        field_of_view = node_tree.interface.new_socket(name="Field of View", in_out='INPUT', socket_type='NodeSocketFloat', parent=camera_panel)
+        field_of_view.subtype = 'ANGLE'
+        field_of_view.min_value = 0.0
+        field_of_view.max_value = math.pi
+        modifier[field_of_view.identifier] = camera.data.angle if camera is not None and camera.type == 'CAMERA' else math.radians(50)
+        margin = node_tree.interface.new_socket(name="Frustum Margin", in_out='INPUT', socket_type='NodeSocketFloat', parent=camera_panel)
+        margin.min_value = 0.0
+        margin.max_value = 1.0
+        modifier[margin.identifier] = 0.1
+        falloff = node_tree.interface.new_socket(name="Falloff Distance", in_out='INPUT', socket_type='NodeSocketFloat', parent=camera_panel)
+        falloff.subtype = 'DISTANCE'
+        falloff.min_value = 0.001
+        modifier[falloff.identifier] = 10 * self.get_obj_size(obj)
+
+
+
+    # find the shared brush material for this stroke style and base look. Objects with the same
+    # look reuse one material; per-object variation comes from the instancer attributes.
+    # stroke is the image, columns and rows loaded for the style by apply_to_objects.
+    def create_shader(self, obj, stroke_style, stroke):
+        default_color, default_img, metallic, roughness, ior = self.get_base_look(obj)
+        image, columns, rows = stroke
+        key = repr((MATERIAL_LAYOUT_VERSION, stroke_style,
+                    default_img.name if default_img is not None else None,
+                    None if default_img is not None else tuple(round(c, 4) for c in default_color),
+                    round(metallic, 4), round(roughness, 4), round(ior, 4)))
+
+        material = next((m for m in bpy.data.materials if m.get(MATERIAL_KEY_PROPERTY) == key), None)
+        if material is None:
+            material = self.build_brush_material(default_color, default_img, metallic, roughness, ior)
+            material[MATERIAL_KEY_PROPERTY] = key
+            self.count("nodes created", len(material.node_tree.nodes), obj)
+
+        brush_texture = material.node_tree.nodes.get(BRUSH_TEXTURE_NAME)
+        if brush_texture is None: # materials made by older versions keep the stroke in their last image node
+            brush_texture = next((n for n in reversed(material.node_tree.nodes) if n.type == "TEX_IMAGE"), None)
+
+        if image is not None and brush_texture is not None and brush_texture.image != image:
+            brush_texture.image = image
+        for name, value in ((ATLAS_COLUMNS_NODE_NAME, columns), (ATLAS_ROWS_NODE_NAME, rows)):
+            layout_node = material.node_tree.nodes.get(name)
+            if layout_node is not None:
+                set_socket_value(layout_node.outputs[0], float(value))
+
+        # replace a previous painter material in place instead of stacking another slot
+        materials = obj.data.materials
+        slot_index = next((i for i, m in enumerate(materials) if m is not None and m.name.startswith(SHADER_NAME)), None)
+        if slot_index is None:
+            materials.append(material)
+        elif materials[slot_index] != material:
+            materials[slot_index] = material
+
+        return (material, brush_texture.image if brush_texture else None)
+
+
+
+    # read base color or base image, metallic, roughness and IOR from the object's own material
+    def get_base_look(self, obj):
         default_img = None
         default_color = (0.506, 0.8, 0.192, 1)
-        
+        metallic, roughness, ior = 0.387, 0.573, 1.5
+
+        existing_material = obj.active_material
+        if existing_material is None or existing_material.name.startswith(SHADER_NAME):
+            existing_material = next((m for m in obj.data.materials
+                                      if m is not None and not m.name.startswith(SHADER_NAME)), None)
+        principled = None
         if existing_material is not None and existing_material.node_tree is not None:
-            nodes = existing_material.node_tree.nodes
-            principled = next(n for n in nodes if n.type == 'BSDF_PRINCIPLED')
+            principled = next((n for n in existing_material.node_tree.nodes if n.type == 'BSDF_PRINCIPLED'), None)
+
+        if principled is not None:
             base_color = principled.inputs['Base Color']
-            print("current base color", base_color)
             if len(base_color.links) > 0:
                 from_node = base_color.links[0].from_node
                 if type(from_node) is bpy.types.ShaderNodeTexImage:
                     default_img = from_node.image
             else:
-                default_color = base_color.default_value
-        else:
-            existing_material = bpy.data.materials.new(name="Material")
-            existing_material.use_nodes = True
-
-
-        if material is None: 
-            material = bpy.data.materials.new(name=SHADER_NAME)
-            obj.data.materials.append(material)
-            material.use_nodes = True
-            # material.surface_render_method = "BLENDED"
-            node_tree = material.node_tree
-            node_tree.nodes.clear()
-
-            geometry = self.create_node(node_tree, 'ShaderNodeNewGeometry')
-            geometry.location = (0, 0)
-
-            attribute_normal = node_tree.nodes.new(type='ShaderNodeAttribute')
-            attribute_normal.attribute_type = 'INSTANCER'
-            attribute_normal.attribute_name = ATTRIBUTE_NORMAL
-            # attribute_normal.inputs["Name"].default_value = "normal" 
-            attribute_normal.location = (200, -100)
-
-            multiply_add_a = node_tree.nodes.new(type='ShaderNodeMath')
-            multiply_add_a.operation = 'MULTIPLY_ADD'
-            multiply_add_a.inputs[1].default_value = 0.2 #multiplier
-            multiply_add_a.inputs[2].default_value = 1.0 #addend
-            multiply_add_a.location = (200, 100)
-
-            mix_rgb = node_tree.nodes.new(type='ShaderNodeMix')
-            mix_rgb.data_type = 'VECTOR'  
-    #        mix_rgb.use_clamp = True  
-    #        mix_rgb.inputs['Fac'].default_value = 1.0  
-            mix_rgb.location = (400, 0)
-
-            multiply_add_b = node_tree.nodes.new(type='ShaderNodeMath')
-            multiply_add_b.operation = 'MULTIPLY_ADD'
-            multiply_add_b.inputs[1].default_value = 0.2 #multiplier
-            multiply_add_b.inputs[2].default_value = 1.0 #addend
-            multiply_add_b.location = (200, 300)
-
-            multiply_add_c = node_tree.nodes.new(type='ShaderNodeMath')
-            multiply_add_c.operation = 'MULTIPLY_ADD'
-            multiply_add_c.inputs[1].default_value = 0.02  #multiplier
-            multiply_add_c.inputs[2].default_value = 0.5  #addend
-            multiply_add_c.location = (200, 500)
-            
-            attribute_random = node_tree.nodes.new(type='ShaderNodeAttribute')
-            attribute_random.attribute_type = 'INSTANCER'
-            attribute_random.attribute_name = ATTRIBUTE_RANDOM
-            attribute_random.location = (-200, 300)
-            
-            separate_color = node_tree.nodes.new(type='ShaderNodeSeparateColor')
-            separate_color.location = (0, 300)
-
-            hue_saturation = node_tree.nodes.new(type='ShaderNodeHueSaturation')
-            hue_saturation.location = (400, 300)
-            hue_saturation.inputs[4].default_value = (0.506, 0.8, 0.192, 1) if default_color is None else default_color
-            if default_img is not None:
-                img_texture = node_tree.nodes.new(type="ShaderNodeTexImage")
-                img_texture.image = default_img
-                attribute_uv = node_tree.nodes.new(type='ShaderNodeAttribute')
-                attribute_uv.attribute_type = 'INSTANCER'
-                attribute_uv.attribute_name = 'UVMap'
-
-            bright_contrast = node_tree.nodes.new(type='ShaderNodeBrightContrast')
-            bright_contrast.location = (600, 300)
-
-            attribute_bright = node_tree.nodes.new(type='ShaderNodeAttribute')
-            attribute_bright.attribute_type = 'INSTANCER'
-            attribute_bright.attribute_name = ATTRIBUTE_BRIGHTNESS
-            attribute_bright.location = (600, 700)
-            
-            attribute_contrast = node_tree.nodes.new(type='ShaderNodeAttribute')
-            attribute_contrast.attribute_type = 'INSTANCER'
-            attribute_contrast.attribute_name = ATTRIBUTE_CONTRAST
-            attribute_contrast.location = (600, 500)
-
-            gamma = node_tree.nodes.new(type='ShaderNodeGamma')
-            gamma.location = (800, 300)
-
-            attribute_gamma = node_tree.nodes.new(type='ShaderNodeAttribute')
-            attribute_gamma.attribute_type = 'INSTANCER'
-            attribute_gamma.attribute_name = ATTRIBUTE_GAMMA
-            attribute_gamma.location = (800, 500)
-            
+                default_color = tuple(base_color.default_value)
+            metallic = principled.inputs['Metallic'].default_value
+            roughness = principled.inputs['Roughness'].default_value
+            ior = principled.inputs['IOR'].default_value
+        return default_color, default_img, metallic, roughness, ior
 
-            attribute_brushuv = node_tree.nodes.new(type='ShaderNodeAttribute')
-            attribute_brushuv.attribute_type = 'GEOMETRY'
-            attribute_brushuv.attribute_name = ATTRIBUTE_UVMAP
-            attribute_brushuv.location = (-400, -400)
-            
-            brush_texture = node_tree.nodes.new(type='ShaderNodeTexImage')
-            brush_texture.location = (-200, -400)
 
-            alpha_adjustment = node_tree.nodes.new(type='ShaderNodeMath')
-            alpha_adjustment.operation = 'MULTIPLY'
-            alpha_adjustment.location = (100, -400)
 
-            attribute_alpha = node_tree.nodes.new(type='ShaderNodeAttribute')
-            attribute_alpha.attribute_type = 'INSTANCER'
-            attribute_alpha.attribute_name = ATTRIBUTE_ALPHA
-            attribute_alpha.location = (100, -600)
+    # the stroke atlas of the stroke library and its columns and rows
+    def load_stroke_atlas(self):
+        atlas = build_stroke_atlas(stroke_library)
+        if atlas is None:
+            self.report({'ERROR'}, "No stroke images for an atlas")
+            return None, 1, 1
+        manifest = json.loads(atlas[ATLAS_MANIFEST_PROPERTY])
+        return atlas, manifest["columns"], manifest["rows"]
 
-            multiply = node_tree.nodes.new(type='ShaderNodeMath')
-            multiply.operation = 'MULTIPLY'
-            multiply.location = (300, -400)
-            
-            light_path = node_tree.nodes.new(type='ShaderNodeLightPath')
-            light_path.location = (-200, -700)
-            
-            mix_float = node_tree.nodes.new(type='ShaderNodeMix')
-            mix_float.data_type = 'FLOAT'  
-    #        mix_float.use_clamp = True  
-            mix_float.inputs['A'].default_value = 1.0  
-            mix_float.location = (500, -400)
-
-            principled_bsdf = node_tree.nodes.new(type='ShaderNodeBsdfPrincipled')
-            if existing_material is not None and existing_material.node_tree is not None:
-                nodes = existing_material.node_tree.nodes
-                principled = next(n for n in nodes if n.type == 'BSDF_PRINCIPLED')
-                principled_bsdf.inputs['Metallic'].default_value = principled.inputs['Metallic'].default_value
-                principled_bsdf.inputs['Roughness'].default_value = principled.inputs['Roughness'].default_value
-                principled_bsdf.inputs['IOR'].default_value = principled.inputs['IOR'].default_value
-            else:
-                principled_bsdf.inputs['Metallic'].default_value = 0.387
-                principled_bsdf.inputs['Roughness'].default_value = 0.573 
-                principled_bsdf.inputs['IOR'].default_value = 1.5  
-                
-            principled_bsdf.location = (700, -400)
-            
-            material_output = node_tree.nodes.new(type='ShaderNodeOutputMaterial')
-            material_output.location = (1000, -400)
-
-            node_tree.links.new(geometry.outputs["Normal"], mix_rgb.inputs["A"])
-            node_tree.links.new(attribute_normal.outputs["Vector"], mix_rgb.inputs["B"])
-            node_tree.links.new(mix_rgb.outputs["Result"], principled_bsdf.inputs["Normal"])
-            node_tree.links.new(principled_bsdf.outputs["BSDF"], material_output.inputs["Surface"])
-            node_tree.links.new(attribute_brushuv.outputs["Vector"], brush_texture.inputs["Vector"])
-            node_tree.links.new(brush_texture.outputs["Alpha"], alpha_adjustment.inputs[0])
-            node_tree.links.new(attribute_alpha.outputs["Fac"], alpha_adjustment.inputs[1])
-            node_tree.links.new(alpha_adjustment.outputs["Value"], multiply.inputs[1])
-            node_tree.links.new(light_path.outputs["Is Camera Ray"], multiply.inputs["Value"])
-            node_tree.links.new(attribute_normal.outputs["Alpha"], mix_float.inputs["Factor"])
-            node_tree.links.new(multiply.outputs["Value"], mix_float.inputs["B"])
-            node_tree.links.new(mix_float.outputs["Result"], principled_bsdf.inputs["Alpha"])
-            node_tree.links.new(attribute_normal.outputs["Alpha"], mix_rgb.inputs["Factor"])
-
-            node_tree.links.new(multiply_add_c.outputs["Value"], hue_saturation.inputs["Hue"])
-            node_tree.links.new(multiply_add_b.outputs["Value"], hue_saturation.inputs["Saturation"])
-            node_tree.links.new(multiply_add_a.outputs["Value"], hue_saturation.inputs["Value"])
-            if default_img is not None:
-                node_tree.links.new(attribute_uv.outputs["Vector"], img_texture.inputs["Vector"])
-                node_tree.links.new(img_texture.outputs["Color"], hue_saturation.inputs["Color"])
-
-            node_tree.links.new(hue_saturation.outputs["Color"], bright_contrast.inputs["Color"])
-            node_tree.links.new(attribute_bright.outputs["Fac"], bright_contrast.inputs["Bright"])
-            node_tree.links.new(attribute_contrast.outputs["Fac"], bright_contrast.inputs["Contrast"])
-            node_tree.links.new(bright_contrast.outputs["Color"], gamma.inputs["Color"])
-            node_tree.links.new(attribute_gamma.outputs["Fac"], gamma.inputs["Gamma"])
-            node_tree.links.new(gamma.outputs["Color"], principled_bsdf.inputs["Base Color"])
-            node_tree.links.new(separate_color.outputs["Red"], multiply_add_c.inputs["Value"])
-            node_tree.links.new(separate_color.outputs["Green"], multiply_add_b.inputs["Value"])
-            node_tree.links.new(separate_color.outputs["Blue"], multiply_add_a.inputs["Value"])
-            node_tree.links.new(attribute_random.outputs["Color"], separate_color.inputs["Color"])
-
-            if ATTRIBUTE_RANDOM not in obj.data.attributes:
-                print(f"Attribute {ATTRIBUTE_RANDOM} not found, creating it and restarting the function...")
-                return self.create_shader(obj, stroke_style)
-            
-            existing_texture_node = node_tree.nodes.new(type='ShaderNodeTexImage')
-            existing_texture_node.location = (0, -400)
-            
-        blend_file_directory = os.path.dirname(bpy.data.filepath)
-        image_path = os.path.join(blend_file_directory, stroke_style)
 
-        if os.path.exists(image_path):
-            image_name = os.path.basename(image_path)
-            if image_name in bpy.data.images:
-                image = bpy.data.images[image_name]
-            else:
-                image = bpy.data.images.load(image_path)
 
-            existing_texture_node.image = image
-            existing_texture_node.interpolation = 'Smart'
-            existing_texture_node.extension = 'REPEAT'
+    # from the stroke library, refreshed once per apply by apply_to_objects
+    def load_stroke_image(self, stroke_style):
+        image = stroke_library.image(stroke_style)
+        if image is None:
+            self.report({'ERROR'}, f"Cannot find image file: {stroke_style}")
+        return image
 
 
-            bpy.context.view_layer.update()
-        else:
-            self.report({'ERROR'}, f"Cannot find image file: {stroke_style}")
 
-        return (material, existing_texture_node.image if existing_texture_node else None)
+    def build_brush_material(self, default_color, default_img, metallic, roughness, ior):
+        material = bpy.data.materials.new(name=SHADER_NAME)
+        material.use_nodes = True
+        # material.surface_render_method = "BLENDED"
+        node_tree = material.node_tree
+        node_tree.nodes.clear()
+
+
+        geometry = self.create_node(node_tree, 'ShaderNodeNewGeometry')
+        geometry.location = (0, 0)
+
+        attribute_normal = node_tree.nodes.new(type='ShaderNodeAttribute')
+        attribute_normal.attribute_type = 'INSTANCER'
+        attribute_normal.attribute_name = ATTRIBUTE_INSTANCE
+        # attribute_normal.inputs["Name"].default_value = "normal" 
+        attribute_normal.location = (200, -100)
+
+        multiply_add_a = node_tree.nodes.new(type='ShaderNodeMath')
+        multiply_add_a.operation = 'MULTIPLY_ADD'
+        multiply_add_a.inputs[1].default_value = 0.2 #multiplier
+        multiply_add_a.inputs[2].default_value = 1.0 #addend
+        multiply_add_a.location = (200, 100)
+
+        mix_rgb = node_tree.nodes.new(type='ShaderNodeMix')
+        mix_rgb.data_type = 'VECTOR'  
+#        mix_rgb.use_clamp = True  
+#        mix_rgb.inputs['Fac'].default_value = 1.0  
+        mix_rgb.location = (400, 0)
+
+        multiply_add_b = node_tree.nodes.new(type='ShaderNodeMath')
+        multiply_add_b.operation = 'MULTIPLY_ADD'
+        multiply_add_b.inputs[1].default_value = 0.2 #multiplier
+        multiply_add_b.inputs[2].default_value = 1.0 #addend
+        multiply_add_b.location = (200, 300)
+
+        multiply_add_c = node_tree.nodes.new(type='ShaderNodeMath')
+        multiply_add_c.operation = 'MULTIPLY_ADD'
+        multiply_add_c.inputs[1].default_value = 0.02  #multiplier
+        multiply_add_c.inputs[2].default_value = 0.5  #addend
+        multiply_add_c.location = (200, 500)
+        
+        # color jitter per instance: value + (2 * noise - 1) * randomness for each channel,
+        # with value and randomness read from the instancer's custom properties
+        object_info = node_tree.nodes.new(type='ShaderNodeObjectInfo')
+        object_info.location = (-1000, 300)
+
+        white_noise = node_tree.nodes.new(type='ShaderNodeTexWhiteNoise')
+        white_noise.noise_dimensions = '1D'
+        white_noise.location = (-800, 300)
+
+        noise_signed = node_tree.nodes.new(type='ShaderNodeVectorMath')
+        noise_signed.operation = 'MULTIPLY_ADD'
+        noise_signed.inputs[1].default_value = (2.0, 2.0, 2.0)
+        noise_signed.inputs[2].default_value = (-1.0, -1.0, -1.0)
+        noise_signed.location = (-600, 300)
+
+        attribute_color_value = node_tree.nodes.new(type='ShaderNodeAttribute')
+        attribute_color_value.attribute_type = 'INSTANCER'
+        attribute_color_value.attribute_name = LOOK_PROPERTIES[0][0]
+        attribute_color_value.location = (-600, 700)
+
+        attribute_color_randomness = node_tree.nodes.new(type='ShaderNodeAttribute')
+        attribute_color_randomness.attribute_type = 'INSTANCER'
+        attribute_color_randomness.attribute_name = LOOK_PROPERTIES[1][0]
+        attribute_color_randomness.location = (-600, 500)
+
+        attribute_random = node_tree.nodes.new(type='ShaderNodeVectorMath')
+        attribute_random.operation = 'MULTIPLY_ADD'
+        attribute_random.location = (-400, 300)
+
+        separate_color = node_tree.nodes.new(type='ShaderNodeSeparateXYZ')
+        separate_color.location = (0, 300)
+
+        hue_saturation = node_tree.nodes.new(type='ShaderNodeHueSaturation')
+        hue_saturation.location = (400, 300)
+        hue_saturation.inputs[4].default_value = (0.506, 0.8, 0.192, 1) if default_color is None else default_color
+        if default_img is not None:
+            img_texture = node_tree.nodes.new(type="ShaderNodeTexImage")
+            img_texture.image = default_img
+            attribute_uv = node_tree.nodes.new(type='ShaderNodeAttribute')
+            attribute_uv.attribute_type = 'INSTANCER'
+            attribute_uv.attribute_name = 'UVMap'
+
+        bright_contrast = node_tree.nodes.new(type='ShaderNodeBrightContrast')
+        bright_contrast.location = (600, 300)
+
+        # brightness, contrast, transparency and gamma in one property
+        attribute_adjustment = node_tree.nodes.new(type='ShaderNodeAttribute')
+        attribute_adjustment.attribute_type = 'INSTANCER'
+        attribute_adjustment.attribute_name = LOOK_PROPERTIES[2][0]
+        attribute_adjustment.location = (400, 700)
+
+        separate_adjustment = node_tree.nodes.new(type='ShaderNodeSeparateColor')
+        separate_adjustment.location = (600, 700)
+
+        gamma = node_tree.nodes.new(type='ShaderNodeGamma')
+        gamma.location = (800, 300)
+
+
+        attribute_brushuv = node_tree.nodes.new(type='ShaderNodeAttribute')
+        attribute_brushuv.attribute_type = 'GEOMETRY'
+        attribute_brushuv.attribute_name = ATTRIBUTE_UVMAP
+        attribute_brushuv.location = (-400, -400)
+        
+        # atlas tile of the instance's style: column style % columns, row style // columns
+        painter_flag = node_tree.nodes.new(type='ShaderNodeMath')
+        painter_flag.operation = 'MINIMUM'
+        painter_flag.inputs[1].default_value = 1.0
+        painter_flag.location = (400, -200)
+
+        style_index = node_tree.nodes.new(type='ShaderNodeMath')
+        style_index.operation = 'SUBTRACT'
+        style_index.inputs[1].default_value = 1.0
+        style_index.location = (-1000, -600)
+
+        atlas_columns = node_tree.nodes.new(type='ShaderNodeValue')
+        atlas_columns.name = ATLAS_COLUMNS_NODE_NAME
+        atlas_columns.outputs[0].default_value = 1.0
+        atlas_columns.location = (-1000, -800)
+
+        atlas_rows = node_tree.nodes.new(type='ShaderNodeValue')
+        atlas_rows.name = ATLAS_ROWS_NODE_NAME
+        atlas_rows.outputs[0].default_value = 1.0
+        atlas_rows.location = (-1000, -1000)
+
+        tile_column = node_tree.nodes.new(type='ShaderNodeMath')
+        tile_column.operation = 'FLOORED_MODULO'
+        tile_column.location = (-800, -600)
+
+        tile_row = node_tree.nodes.new(type='ShaderNodeMath')
+        tile_row.operation = 'DIVIDE'
+        tile_row.location = (-800, -800)
+
+        tile_row_floor = node_tree.nodes.new(type='ShaderNodeMath')
+        tile_row_floor.operation = 'FLOOR'
+        tile_row_floor.location = (-600, -800)
+
+        tile = node_tree.nodes.new(type='ShaderNodeCombineXYZ')
+        tile.location = (-600, -600)
+
+        atlas_size = node_tree.nodes.new(type='ShaderNodeCombineXYZ')
+        atlas_size.inputs["Z"].default_value = 1.0
+        atlas_size.location = (-600, -1000)
+
+        tile_offset = node_tree.nodes.new(type='ShaderNodeVectorMath')
+        tile_offset.operation = 'ADD'
+        tile_offset.location = (-400, -600)
+
+        atlas_uv = node_tree.nodes.new(type='ShaderNodeVectorMath')
+        atlas_uv.operation = 'DIVIDE'
+        atlas_uv.location = (-300, -700)
+
+        brush_texture = node_tree.nodes.new(type='ShaderNodeTexImage')
+        brush_texture.name = BRUSH_TEXTURE_NAME
+        brush_texture.interpolation = 'Smart'
+        brush_texture.extension = 'REPEAT'
+        brush_texture.location = (-200, -400)
+
+        alpha_adjustment = node_tree.nodes.new(type='ShaderNodeMath')
+        alpha_adjustment.operation = 'MULTIPLY'
+        alpha_adjustment.location = (100, -400)
+
+        multiply = node_tree.nodes.new(type='ShaderNodeMath')
+        multiply.operation = 'MULTIPLY'
+        multiply.location = (300, -400)
+        
+        light_path = node_tree.nodes.new(type='ShaderNodeLightPath')
+        light_path.location = (-200, -700)
+        
+        mix_float = node_tree.nodes.new(type='ShaderNodeMix')
+        mix_float.data_type = 'FLOAT'  
+#        mix_float.use_clamp = True  
+        mix_float.inputs['A'].default_value = 1.0  
+        mix_float.location = (500, -400)
+
+        principled_bsdf = node_tree.nodes.new(type='ShaderNodeBsdfPrincipled')
+        principled_bsdf.inputs['Metallic'].default_value = metallic
+        principled_bsdf.inputs['Roughness'].default_value = roughness
+        principled_bsdf.inputs['IOR'].default_value = ior
+        principled_bsdf.location = (700, -400)
+        
+        material_output = node_tree.nodes.new(type='ShaderNodeOutputMaterial')
+        material_output.location = (1000, -400)
+
+        node_tree.links.new(geometry.outputs["Normal"], mix_rgb.inputs["A"])
+        node_tree.links.new(attribute_normal.outputs["Vector"], mix_rgb.inputs["B"])
+        node_tree.links.new(mix_rgb.outputs["Result"], principled_bsdf.inputs["Normal"])
+        node_tree.links.new(principled_bsdf.outputs["BSDF"], material_output.inputs["Surface"])
+        node_tree.links.new(attribute_normal.outputs["Alpha"], painter_flag.inputs[0])
+        node_tree.links.new(attribute_normal.outputs["Alpha"], style_index.inputs[0])
+        node_tree.links.new(style_index.outputs["Value"], tile_column.inputs[0])
+        node_tree.links.new(atlas_columns.outputs["Value"], tile_column.inputs[1])
+        node_tree.links.new(style_index.outputs["Value"], tile_row.inputs[0])
+        node_tree.links.new(atlas_columns.outputs["Value"], tile_row.inputs[1])
+        node_tree.links.new(tile_row.outputs["Value"], tile_row_floor.inputs[0])
+        node_tree.links.new(tile_column.outputs["Value"], tile.inputs["X"])
+        node_tree.links.new(tile_row_floor.outputs["Value"], tile.inputs["Y"])
+        node_tree.links.new(atlas_columns.outputs["Value"], atlas_size.inputs["X"])
+        node_tree.links.new(atlas_rows.outputs["Value"], atlas_size.inputs["Y"])
+        node_tree.links.new(attribute_brushuv.outputs["Vector"], tile_offset.inputs[0])
+        node_tree.links.new(tile.outputs["Vector"], tile_offset.inputs[1])
+        node_tree.links.new(tile_offset.outputs["Vector"], atlas_uv.inputs[0])
+        node_tree.links.new(atlas_size.outputs["Vector"], atlas_uv.inputs[1])
+        node_tree.links.new(atlas_uv.outputs["Vector"], brush_texture.inputs["Vector"])
+        node_tree.links.new(brush_texture.outputs["Alpha"], alpha_adjustment.inputs[0])
+        node_tree.links.new(separate_adjustment.outputs["Blue"], alpha_adjustment.inputs[1])
+        node_tree.links.new(alpha_adjustment.outputs["Value"], multiply.inputs[1])
+        node_tree.links.new(light_path.outputs["Is Camera Ray"], multiply.inputs["Value"])
+        node_tree.links.new(painter_flag.outputs["Value"], mix_float.inputs["Factor"])
+        node_tree.links.new(multiply.outputs["Value"], mix_float.inputs["B"])
+        node_tree.links.new(mix_float.outputs["Result"], principled_bsdf.inputs["Alpha"])
+        node_tree.links.new(painter_flag.outputs["Value"], mix_rgb.inputs["Factor"])
+
+        node_tree.links.new(multiply_add_c.outputs["Value"], hue_saturation.inputs["Hue"])
+        node_tree.links.new(multiply_add_b.outputs["Value"], hue_saturation.inputs["Saturation"])
+        node_tree.links.new(multiply_add_a.outputs["Value"], hue_saturation.inputs["Value"])
+        if default_img is not None:
+            node_tree.links.new(attribute_uv.outputs["Vector"], img_texture.inputs["Vector"])
+            node_tree.links.new(img_texture.outputs["Color"], hue_saturation.inputs["Color"])
+
+        node_tree.links.new(hue_saturation.outputs["Color"], bright_contrast.inputs["Color"])
+        node_tree.links.new(attribute_adjustment.outputs["Color"], separate_adjustment.inputs["Color"])
+        node_tree.links.new(separate_adjustment.outputs["Red"], bright_contrast.inputs["Bright"])
+        node_tree.links.new(separate_adjustment.outputs["Green"], bright_contrast.inputs["Contrast"])
+        node_tree.links.new(bright_contrast.outputs["Color"], gamma.inputs["Color"])
+        node_tree.links.new(attribute_adjustment.outputs["Alpha"], gamma.inputs["Gamma"])
+        node_tree.links.new(gamma.outputs["Color"], principled_bsdf.inputs["Base Color"])
+        node_tree.links.new(separate_color.outputs["X"], multiply_add_c.inputs["Value"])
+        node_tree.links.new(separate_color.outputs["Y"], multiply_add_b.inputs["Value"])
+        node_tree.links.new(separate_color.outputs["Z"], multiply_add_a.inputs["Value"])
+        node_tree.links.new(object_info.outputs["Random"], white_noise.inputs["W"])
+        node_tree.links.new(white_noise.outputs["Color"], noise_signed.inputs[0])
+        node_tree.links.new(noise_signed.outputs["Vector"], attribute_random.inputs[0])
+        node_tree.links.new(attribute_color_randomness.outputs["Vector"], attribute_random.inputs[1])
+        node_tree.links.new(attribute_color_value.outputs["Vector"], attribute_random.inputs[2])
+        node_tree.links.new(attribute_random.outputs["Vector"], separate_color.inputs["Vector"])
+
+        return material
 
         
     
     
     # generate bezier curves on the surface of obj to guide the direction of brush strokes
-    # TODO: reduce frequency of curves when mesh is very complicated
-    def generate_surface_curves(self, obj, context):
-        bm = bmesh.new()   # create an empty BMesh
-        bm.from_mesh(obj.data)
-        bm.verts.ensure_lookup_table()
-        bm.edges.ensure_lookup_table()
+    # guide_loops are lists of vertex indices from trace_all_guide_loops. An existing
+    # guide curve is refilled in place, or kept as it is when guide_loops is None.
+    # shared_curve is the curve data already filled for another user of obj's mesh.
+    def generate_surface_curves(self, obj, collection, guide_key, guide_loops, shared_curve=None):
+        new_bezier = self.find_guide_curve(obj)
+        if new_bezier is not None and guide_loops is None:
+            return new_bezier
 
-        crv = bpy.data.curves.new('crv', 'CURVE')
-        crv.dimensions = '3D'
-        new_bezier = bpy.data.objects.new('Bezier', crv)
-        new_bezier.parent = obj
-        context.collection.objects.link(new_bezier)
+        if new_bezier is None:
+            if shared_curve is not None:
+                crv = shared_curve
+            else:
+                crv = bpy.data.curves.new('crv', 'CURVE')
+                crv.dimensions = '3D'
+            new_bezier = bpy.data.objects.new('Bezier', crv)
+            new_bezier.parent = obj
+            if collection is None:
+                collection = obj.users_collection[0] if obj.users_collection else bpy.context.scene.collection
+            collection.objects.link(new_bezier)
+        elif shared_curve is not None:
+            old_curve = new_bezier.data
+            if old_curve != shared_curve:
+                new_bezier.data = shared_curve
+                if old_curve.users == 0:
+                    bpy.data.curves.remove(old_curve)
+        else:
+            crv = new_bezier.data
+            if crv.users > 1: # shared with other objects, refill a copy so only this one changes
+                crv = bpy.data.curves.new('crv', 'CURVE')
+                crv.dimensions = '3D'
+                new_bezier.data = crv
+            else:
+                crv.splines.clear()
 
-        # selected_edges = [ e for e in bm.edges if e.select ]
-        # verts_on_edge_loop = self.find_edge_loops(selected_edges[0], set(), [])
-        initial_loops = self.find_first_loop(bm)
-        if initial_loops is None: # couldn't find any valid loops
+        new_bezier[GUIDE_KEY_PROPERTY] = guide_key
+        if shared_curve is not None:
             return new_bezier
-        spline_points = []
-        visited_edge = set() # searched for edge loop
-        expanded_edge = set() # expanded to neighbors
-        used_points = set() 
-        edge_queue = collections.deque()
-        for e, _ in initial_loops:
-            edge_queue.append(e.index)
-        while len(edge_queue) > 0:
-            top = edge_queue.popleft()
-            if top in expanded_edge:
-                continue
-            if top not in visited_edge:
-                curr_verts = self.find_edge_loops(bm.edges[top], visited_edge, used_points, edge_queue)
-                if len(curr_verts) >= 3:
-                    spline_points.append(curr_verts)
-                    used_points.update(curr_verts)
-            neighbors = self.find_neighboring_edge(bm.edges[top])
-            edge_queue.extend(neighbors)
-            expanded_edge.add(top)
-
-
-        # print('first loop:', initial_loops)
-        # print("spline points:", spline_points)
-        sampling = math.floor(len(spline_points) / TARGET_LINE_NUMBER)
-        for i in range(0, len(spline_points), max(sampling, 1)):
-            spline = self.create_spline_from_points(bm, crv, spline_points[i])
-        # spline = self.create_spline_from_points(bm, crv, verts_on_edge_loop)
+        self.create_splines_from_points(self.read_vertex_coords(obj), crv, guide_loops)
+        self.count("splines", len(guide_loops), obj)
+        self.count("spline points", sum(len(loop) for loop in guide_loops), obj)
 
         # modifier = new_bezier.modifiers.new(name="Shrinkwrap", type='SHRINKWRAP')
         # modifier.target = obj
@@ -772,6 +3314,31 @@ class ObjectPainterEffect(bpy.types.Operator):
 
 
 
+    def has_guide_curve(self, obj, guide_key):
+        curve = self.find_guide_curve(obj)
+        return curve is not None and curve.get(GUIDE_KEY_PROPERTY) == guide_key
+
+
+    # the guide curve of an earlier apply: the curve object the painter modifier's tangent
+    # node reads, if it is still a curve parented to obj
+    def find_guide_curve(self, obj):
+        modifier = obj.modifiers.get("GeometryNodes")
+        if modifier is None or modifier.type != 'NODES' or modifier.node_group is None:
+            return None
+        nodes = modifier.node_group.nodes
+        tangent_transfer = nodes.get(TANGENT_NODE_NAME)
+        if tangent_transfer is None: # trees made by older versions
+            tangent_transfer = next((n for n in nodes if n.type == 'GROUP' and n.node_tree is not None
+                                     and is_copy_of(n.node_tree.name, CURVE_TANGENT_NAME)), None)
+        if tangent_transfer is None:
+            return None
+        curve = tangent_transfer.inputs[2].default_value
+        if curve is None or curve.type != 'CURVE' or curve.parent != obj:
+            return None
+        return curve
+
+
+
     def get_default_density(self, obj):
         min_extent = self.get_obj_size(obj)
         return 1500 / min_extent**2
@@ -898,20 +3465,247 @@ class ObjectPainterEffect(bpy.types.Operator):
 
 
 
-    # generate a bezier curve given the control points
+    # generate one bezier curve per list of control point indices
     # the handles are automatically set by blender
-    def create_spline_from_points(self, mesh, crv, points):
-        spline = crv.splines.new(type='BEZIER')
-        spline.bezier_points.add(len(points)-1)
-        for p, vert_idx in zip(spline.bezier_points, points):
-            vertex = mesh.verts[vert_idx]
-            p.co = vertex.co
-            p.handle_left_type = "AUTO"
-            p.handle_right_type = "AUTO"
-        return spline
+    def create_splines_from_points(self, coords, crv, loops):
+        if len(loops) == 0:
+            return
+        sizes = [len(points) for points in loops]
+        flat_points = coords[np.fromiter(itertools.chain.from_iterable(loops), dtype=np.int64, count=sum(sizes))]
+        auto_handles = np.full(max(sizes), HANDLE_TYPE_AUTO, dtype=np.int32)
+        offset = 0
+        for size in sizes:
+            spline = crv.splines.new(type='BEZIER')
+            spline.bezier_points.add(size - 1)
+            bezier_points = spline.bezier_points
+            bezier_points.foreach_set("co", flat_points[offset:offset + size].ravel())
+            bezier_points.foreach_set("handle_left_type", auto_handles[:size])
+            bezier_points.foreach_set("handle_right_type", auto_handles[:size])
+            # foreach_set skips the RNA update, one regular assignment makes blender place the handles
+            bezier_points[0].handle_left_type = "AUTO"
+            offset += size
+    
+
+
+class ObjectPainterEffect(PainterEffectBuilder, bpy.types.Operator):
+    """Object Cursor Array"""
+    bl_idname = "object.painter_effect"
+    bl_label = "Painter Effect"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    curve_engine: bpy.props.EnumProperty(
+        name="Curve Engine",
+        description="How the guide curves are traced over the mesh",
+        items=[
+            ('NUMPY', "NumPy", "Trace loops over adjacency arrays read once from the mesh"),
+            ('BMESH', "BMesh", "Walk the mesh element by element with BMesh"),
+            ('FIELD', "Field", "Follow a smooth direction field, for triangle and n-gon meshes without edge loops"),
+        ],
+        default='NUMPY',
+    )
+    curve_count: bpy.props.IntProperty(
+        name="Curve Count",
+        description="Number of guide curves to keep, chosen to cover the surface evenly",
+        default=TARGET_LINE_NUMBER,
+        min=1,
+    )
+    curve_tolerance: bpy.props.FloatProperty(
+        name="Curve Tolerance",
+        description="How far a simplified guide curve may stray from its edge loop, relative to the object size",
+        default=CURVE_TOLERANCE,
+        min=0.0,
+        max=0.1,
+        precision=4,
+    )
+    max_curve_points: bpy.props.IntProperty(
+        name="Max Curve Points",
+        description="Upper limit of control points per guide curve",
+        default=MAX_CURVE_POINTS,
+        min=2,
+    )
+    worker_count: bpy.props.IntProperty(
+        name="Worker Processes",
+        description="Processes tracing guide curves for the selected objects in parallel, 0 uses every core and 1 traces on the main thread",
+        default=0,
+        min=0,
+    )
+    use_deforming: bpy.props.BoolProperty(
+        name="Deforming Mesh",
+        description="Bind the strokes to the rest surface so they follow armatures and shape keys instead of being scattered every frame. The painter modifier must come after the deforming modifiers",
+        default=False,
+    )
+    use_disk_cache: bpy.props.BoolProperty(
+        name="Disk Cache",
+        description="Keep traced guide curves in a painter_effect_cache folder next to the blend file",
+        default=False,
+    )
+    use_profile: bpy.props.BoolProperty(
+        name="Profile",
+        description="Time every stage per object, count the work done and write painter_effect_profile.json next to the blend file",
+        default=False,
+    )
+    use_cprofile: bpy.props.BoolProperty(
+        name="Python Profile",
+        description="Also capture a cProfile of the whole apply into painter_effect_profile.prof",
+        default=False,
+    )
     
 
 
+    def execute(self, context):
+        objs = context.selected_objects
+        if objs is None:
+            self.report({'ERROR'}, "No active object in the scene.")
+            return {'CANCELLED'}
+        
+        if not self.use_profile and not self.use_cprofile:
+            self.apply_to_objects(self.collect_mesh_objects(objs), context.collection, context.scene.stroke_style)
+            update_instance_budgets(context.scene, context.scene.painter_max_instances)
+            return {'FINISHED'}
+
+        global last_profile
+        self.profile = PainterProfile()
+        if self.use_cprofile:
+            self.profile.cprofile = cProfile.Profile()
+            self.profile.cprofile.enable()
+        # a failed apply must not leave the profiler running for the rest of the session
+        try:
+            mesh_objs = self.collect_mesh_objects(objs)
+            self.apply_to_objects(mesh_objs, context.collection, context.scene.stroke_style)
+            with self.timed_stage("instance budget"):
+                update_instance_budgets(context.scene, context.scene.painter_max_instances)
+            with self.timed_stage("depsgraph evaluation"):
+                depsgraph = context.evaluated_depsgraph_get()
+            self.count_instances(depsgraph, mesh_objs)
+        finally:
+            if self.use_cprofile:
+                self.profile.cprofile.disable()
+        if self.use_cprofile:
+            self.profile.cprofile.dump_stats(self.get_profile_path(PROFILE_STATS_PATH))
+        self.profile.write(self.get_profile_path(PROFILE_LOG_PATH))
+        last_profile = self.profile
+        self.report({'INFO'}, f"Painter Effect: {self.profile.summary()}")
+        return {'FINISHED'}
+
+
+    # next to the blend file, or in the temporary directory while it is unsaved
+    def get_profile_path(self, path):
+        if bpy.data.filepath:
+            return bpy.path.abspath(path)
+        return os.path.join(bpy.app.tempdir, os.path.basename(path[2:]))
+
+
+
+# painter effect settings for a run without the operator, e.g. from run_batch
+class PainterEffectBatch(PainterEffectBuilder):
+    curve_engine = 'NUMPY'
+    curve_count = TARGET_LINE_NUMBER
+    curve_tolerance = CURVE_TOLERANCE
+    max_curve_points = MAX_CURVE_POINTS
+    worker_count = 0
+    use_deforming = False
+    use_disk_cache = False
+
+
+    def report(self, level, message):
+        print(f"{', '.join(sorted(level))}: {message}")
+
+
+
+class ObjectPainterEffectPurge(bpy.types.Operator):
+    """Merge duplicate painter effect node groups left by earlier applies into one shared copy"""
+    bl_idname = "object.painter_effect_purge"
+    bl_label = "Purge Duplicate Painter Data"
+    bl_options = {'REGISTER', 'UNDO'}
+
+
+    def execute(self, context):
+        # migrate first: legacy groups differ only in their density, which the migration
+        # moves to the users before any of them can be merged
+        removed = 0
+        shared_group = next((n for n in bpy.data.node_groups
+                             if is_copy_of(n.name, CURVE_TANGENT_NAME) and "Default Density" in n.interface.items_tree), None)
+        if shared_group is not None:
+            removed += migrate_legacy_tangent_groups(shared_group)
+        removed += purge_duplicate_node_groups(CURVE_TANGENT_NAME)
+        self.report({'INFO'}, f"Removed {removed} duplicate node groups")
+        return {'FINISHED'}
+
+
+
+class ObjectPainterEffectBake(PainterEffectBuilder, bpy.types.Operator):
+    """Bake the brush strokes of the selected objects so renders and frame changes read them instead of scattering again"""
+    bl_idname = "object.painter_effect_bake"
+    bl_label = "Bake Painter Effect"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    source: bpy.props.EnumProperty(
+        name="Source",
+        description="Where the baked strokes come from",
+        items=[
+            ('MODIFIER', "Modifier", "Evaluate the painter modifier once at render density"),
+            ('FILE', "File", "Load the strokes an earlier bake exported to painter_effect_bake next to the blend file"),
+        ],
+        default='MODIFIER',
+    )
+    use_export: bpy.props.BoolProperty(
+        name="Export",
+        description="Also write the strokes as .npz files to a painter_effect_bake folder next to the blend file",
+        default=False,
+    )
+
+
+    def execute(self, context):
+        objs = [obj for obj in context.selected_objects if get_painter_modifier(obj) is not None]
+        if not objs:
+            self.report({'ERROR'}, "No selected object has a painter effect")
+            return {'CANCELLED'}
+        directory = None
+        if self.use_export or self.source == 'FILE':
+            if not bpy.data.filepath:
+                self.report({'ERROR'}, "Save the blend file first, bakes are exported next to it")
+                return {'CANCELLED'}
+            directory = bpy.path.abspath(BAKE_DIRECTORY)
+        strokes = self.bake_objects(objs, directory, self.source == 'FILE')
+        self.report({'INFO'}, f"Baked {strokes} strokes")
+        return {'FINISHED'}
+
+
+
+class ObjectPainterEffectFreeBake(bpy.types.Operator):
+    """Remove the baked strokes of the selected objects and enable their live painter effect again"""
+    bl_idname = "object.painter_effect_free_bake"
+    bl_label = "Free Painter Bake"
+    bl_options = {'REGISTER', 'UNDO'}
+
+
+    def execute(self, context):
+        freed = sum(free_painter_bake(obj) for obj in context.selected_objects)
+        self.report({'INFO'}, f"Freed {freed} bakes")
+        return {'FINISHED'}
+
+
+
+class ObjectPainterEffectBudget(bpy.types.Operator):
+    """Fit the painter effect of every object in the scene into its instance budget and count the instances"""
+    bl_idname = "object.painter_effect_budget"
+    bl_label = "Update Instance Budget"
+    bl_options = {'REGISTER', 'UNDO'}
+
+
+    def execute(self, context):
+        estimated = update_instance_budgets(context.scene, context.scene.painter_max_instances)
+        counts = count_painter_instances(context.evaluated_depsgraph_get())
+        total = 0
+        for obj in context.scene.objects:
+            if get_painter_modifier(obj) is not None:
+                obj[INSTANCE_COUNT_PROPERTY] = counts[obj.name]
+                total += counts[obj.name]
+        self.report({'INFO'}, f"{total} instances, {estimated:.0f} before the budget")
+        return {'FINISHED'}
+
+
+
 class ObjectPainterEffect_Panel(bpy.types.Panel):
     bl_label = "Painter Effect Tools"
     bl_idname = "OBJECT_PT_painter_effect_panel"
@@ -930,6 +3724,50 @@ class ObjectPainterEffect_Panel(bpy.types.Panel):
 
         layout.operator("object.painter_effect", text= "Apply Painter Effect")
         layout.prop(context.scene, "stroke_style", text="Stroke Style") 
+        layout.operator("object.painter_effect_purge", text= "Purge Duplicate Data")
+
+        layout.prop(context.scene, "painter_max_instances", text="Scene Instance Budget")
+        layout.prop(object, "painter_max_instances", text="Object Instance Budget")
+        if get_painter_modifier(object) is not None:
+            layout.prop(object, "painter_camera_culling", text="Camera Culling")
+            if INSTANCE_ESTIMATE_PROPERTY in object:
+                layout.label(text=f"Estimated instances: {object[INSTANCE_ESTIMATE_PROPERTY]:.0f}")
+            if INSTANCE_COUNT_PROPERTY in object:
+                layout.label(text=f"Instances at last update: {object[INSTANCE_COUNT_PROPERTY]}")
+        layout.operator("object.painter_effect_budget", text= "Update Instance Budget")
+
+        row = layout.row(align=True)
+        row.operator("object.painter_effect_bake", text= "Bake")
+        row.operator("object.painter_effect_free_bake", text= "Free Bake")
+        if BAKE_MODIFIER_NAME in object.modifiers:
+            layout.label(text="Strokes are baked")
+
+
+class VIEW3D_PT_painter_effect_profile(bpy.types.Panel):
+    bl_label = "Painter Effect Profile"
+    bl_space_type = 'VIEW_3D'
+    bl_region_type = 'UI'
+    bl_category = "Painter"
+
+
+    def draw(self, context):
+        layout = self.layout
+        if last_profile is None:
+            layout.label(text="Apply with Profile enabled to see timings")
+            return
+
+        layout.label(text=last_profile.summary())
+        totals = last_profile.totals()
+        column = layout.column(align=True)
+        for stage, seconds in sorted(totals["stages"].items(), key=lambda item: -item[1]):
+            row = column.row()
+            row.label(text=stage)
+            row.label(text=f"{seconds:.3f}s")
+        column = layout.column(align=True)
+        for counter, amount in totals["counters"].items():
+            row = column.row()
+            row.label(text=counter)
+            row.label(text=str(amount))
 
 
 def menu_func(self, context):
@@ -937,38 +3775,200 @@ def menu_func(self, context):
 
 
 def load_stroke_images_callback(self, context):
-    image_dir = os.path.dirname(bpy.data.filepath)
-    images = []
-    if os.path.exists(image_dir):
-        for file in os.listdir(image_dir):
-            if file.lower().endswith('.png'):
-                images.append((file, file, f"Use {file} as stroke style"))
-    if not images:
-        images.append(("None", "None", "No images found"))
-    
-    return images
+    stroke_library.refresh(get_stroke_folders())
+    return stroke_library.enum_items
+
+
+def instance_budget_callback(self, context):
+    update_instance_budgets(context.scene, context.scene.painter_max_instances)
+
+
+# modifier inputs have no update callbacks, so edits to them are noticed here: the look
+# inputs are copied to the object properties, and a changed Density makes the budget
+# shares of the scene again
+@bpy.app.handlers.persistent
+def painter_update_handler(scene, depsgraph):
+    stale_budgets = False
+    for update in depsgraph.updates:
+        if not isinstance(update.id, bpy.types.Object):
+            continue
+        obj = update.id.original
+        modifier = get_painter_modifier(obj)
+        if modifier is None:
+            continue
+        sync_look_properties(obj)
+        if obj.get(ESTIMATE_DENSITY_PROPERTY) != get_modifier_density(modifier):
+            stale_budgets = True
+    if stale_budgets:
+        update_instance_budgets(scene, scene.painter_max_instances)
+
+
+def camera_culling_callback(self, context):
+    set_camera_culling(self, self.painter_camera_culling, context.scene.camera)
+
+
+class PainterEffectPreferences(bpy.types.AddonPreferences):
+    bl_idname = __name__
+
+    stroke_folders: bpy.props.StringProperty(
+        name="Stroke Folders",
+        description="Extra folders with stroke images, separated by semicolons. The blend file's folder is searched first",
+        default="",
+    )
+
+
+    def draw(self, context):
+        self.layout.prop(self, "stroke_folders")
 
 
 def register():
+    bpy.utils.register_class(PainterEffectPreferences)
     bpy.types.Scene.stroke_style = bpy.props.EnumProperty(
         name="Stroke Style",
         description="Choose the stroke style",
         items=load_stroke_images_callback
     )
+    bpy.types.Scene.painter_max_instances = bpy.props.IntProperty(
+        name="Scene Instance Budget",
+        description="Most brush stroke instances all painter objects in the scene may produce together, 0 for no limit",
+        default=0,
+        min=0,
+        update=instance_budget_callback,
+    )
+    bpy.types.Object.painter_max_instances = bpy.props.IntProperty(
+        name="Object Instance Budget",
+        description="Most brush stroke instances this object's painter effect may produce, 0 for no limit",
+        default=0,
+        min=0,
+        update=instance_budget_callback,
+    )
+    bpy.types.Object.painter_camera_culling = bpy.props.BoolProperty(
+        name="Camera Culling",
+        description="Drop strokes outside the view of the scene camera and thin out distant ones",
+        default=False,
+        update=camera_culling_callback,
+    )
     
     bpy.types.VIEW3D_MT_object.append(menu_func)
+    bpy.app.handlers.depsgraph_update_post.append(painter_update_handler)
     bpy.utils.register_class(ObjectPainterEffect)
+    bpy.utils.register_class(ObjectPainterEffectPurge)
+    bpy.utils.register_class(ObjectPainterEffectBudget)
+    bpy.utils.register_class(ObjectPainterEffectBake)
+    bpy.utils.register_class(ObjectPainterEffectFreeBake)
     bpy.utils.register_class(ObjectPainterEffect_Panel)
+    bpy.utils.register_class(VIEW3D_PT_painter_effect_profile)
         
         
        
 def unregister():
     del bpy.types.Scene.stroke_style
+    del bpy.types.Scene.painter_max_instances
+    del bpy.types.Object.painter_max_instances
+    del bpy.types.Object.painter_camera_culling
     bpy.types.VIEW3D_MT_object.remove(menu_func)
+    if painter_update_handler in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(painter_update_handler)
     bpy.utils.unregister_class(ObjectPainterEffect)
+    bpy.utils.unregister_class(ObjectPainterEffectPurge)
+    bpy.utils.unregister_class(ObjectPainterEffectBudget)
+    bpy.utils.unregister_class(ObjectPainterEffectBake)
+    bpy.utils.unregister_class(ObjectPainterEffectFreeBake)
     bpy.utils.unregister_class(ObjectPainterEffect_Panel)
+    bpy.utils.unregister_class(VIEW3D_PT_painter_effect_profile)
+    bpy.utils.unregister_class(PainterEffectPreferences)
     
 
 
+# command line driver for render farms and asset libraries, no UI state needed:
+# blender -b file.blend --python PainterEffect.py -- --objects Rock Tree --stroke marker.png --out out.blend
+def run_batch(argv):
+    parser = argparse.ArgumentParser(prog="blender -b file.blend --python PainterEffect.py --",
+                                     description="Apply the painter effect to objects of a blend file and save the result.")
+    parser.add_argument("--objects", nargs="+", default=[], metavar="NAME", help="objects to paint, with their mesh children")
+    parser.add_argument("--collections", nargs="+", default=[], metavar="NAME", help="collections whose objects to paint")
+    parser.add_argument("--all", action="store_true", help="paint every mesh object in the file")
+    parser.add_argument("--stroke", required=True, help=f"stroke image: a name from the stroke folders, a path relative to the blend file or an absolute path, or {ATLAS_STYLE} to mix all of them")
+    parser.add_argument("--out", required=True, help="blend file to write the result to")
+    parser.add_argument("--engine", choices=["NUMPY", "BMESH", "FIELD"], default="NUMPY", help="how the guide curves are traced")
+    parser.add_argument("--curve-count", type=int, default=TARGET_LINE_NUMBER, help="guide curves per object")
+    parser.add_argument("--curve-tolerance", type=float, default=CURVE_TOLERANCE, help="guide simplification, relative to object size")
+    parser.add_argument("--max-curve-points", type=int, default=MAX_CURVE_POINTS, help="control points per guide curve")
+    parser.add_argument("--workers", type=int, default=0, help="tracing processes, 0 uses every core")
+    parser.add_argument("--deforming", action="store_true", help="bind the strokes to the rest surface of rigged or shape keyed meshes")
+    parser.add_argument("--disk-cache", action="store_true", help="reuse and store traced guide curves next to the blend file")
+    parser.add_argument("--max-instances", type=int, default=0, help="instance budget shared by all painted objects, 0 for no limit")
+    parser.add_argument("--bake", action="store_true", help="bake the strokes into the saved file instead of keeping the live modifiers")
+    parser.add_argument("--bake-export", metavar="DIR", help="with --bake, also write the strokes as .npz files to DIR")
+    parser.add_argument("--profile-log", metavar="PATH", help="write per object timings and counters, instances included, as JSON")
+    parser.add_argument("--cprofile", metavar="PATH", help="write a cProfile capture of the run")
+    args = parser.parse_args(argv)
+
+    objs = []
+    for name in args.objects:
+        if name not in bpy.data.objects:
+            parser.error(f"no object named {name}")
+        objs.append(bpy.data.objects[name])
+    for name in args.collections:
+        if name not in bpy.data.collections:
+            parser.error(f"no collection named {name}")
+        objs.extend(bpy.data.collections[name].all_objects)
+    if args.all:
+        objs.extend(obj for obj in bpy.data.objects if obj.type == 'MESH')
+    if not objs:
+        parser.error("nothing to paint, pass --objects, --collections or --all")
+    builder = PainterEffectBatch()
+    # a stroke file outside the stroke folders adds its own folder and goes by its file name
+    stroke = args.stroke
+    path = os.path.join(os.path.dirname(bpy.data.filepath), bpy.path.abspath(stroke))
+    if stroke != ATLAS_STYLE and os.path.isfile(path):
+        builder.stroke_folders = (os.path.dirname(path),)
+        stroke = os.path.basename(path)
+    stroke_library.refresh(get_stroke_folders() + list(builder.stroke_folders), force=True)
+    if stroke_library.resolve(stroke) is None and (stroke != ATLAS_STYLE or not stroke_library.paths):
+        parser.error(f"cannot find stroke image {args.stroke}")
+
+    builder.curve_engine = args.engine
+    builder.curve_count = args.curve_count
+    builder.curve_tolerance = args.curve_tolerance
+    builder.max_curve_points = args.max_curve_points
+    builder.worker_count = args.workers
+    builder.use_deforming = args.deforming
+    builder.use_disk_cache = args.disk_cache
+    builder.profile = PainterProfile()
+
+    if args.cprofile:
+        builder.profile.cprofile = cProfile.Profile()
+        builder.profile.cprofile.enable()
+    try:
+        mesh_objs = builder.collect_mesh_objects(objs)
+        builder.apply_to_objects(mesh_objs, None, stroke)
+        with builder.timed_stage("instance budget"):
+            update_instance_budgets(bpy.context.scene, args.max_instances)
+        if args.bake:
+            builder.bake_objects(mesh_objs, os.path.abspath(args.bake_export) if args.bake_export else None)
+        if args.profile_log:
+            with builder.timed_stage("depsgraph evaluation"):
+                depsgraph = bpy.context.evaluated_depsgraph_get()
+            builder.count_instances(depsgraph, mesh_objs)
+        with builder.timed_stage("save"):
+            bpy.ops.wm.save_as_mainfile(filepath=os.path.abspath(args.out), copy=True)
+    finally:
+        if args.cprofile:
+            builder.profile.cprofile.disable()
+    if args.cprofile:
+        builder.profile.cprofile.dump_stats(args.cprofile)
+    if args.profile_log:
+        builder.profile.write(args.profile_log)
+
+    print(f"Painter Effect: {builder.profile.summary()}")
+    for line in builder.profile.lines():
+        print("  " + line)
+
+
+
 if __name__ == "__main__":
-    register()
\ No newline at end of file
+    if "--" in sys.argv: # blender -b ... --python PainterEffect.py -- arguments
+        run_batch(sys.argv[sys.argv.index("--") + 1:])
+    else:
+        register()
\ No newline at end of file
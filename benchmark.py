@@ -0,0 +1,224 @@
+# Benchmark of the painter effect pipeline on generated meshes
+#
+#   blender -b --factory-startup --python benchmark.py -- --out results.json
+#   blender -b --factory-startup --python benchmark.py -- --out new.json --baseline results.json --threshold 0.2
+#   blender -b --factory-startup --python benchmark.py -- --out huge.json --sizes huge --repeat 1
+#
+# Every stage is timed on its own for each mesh and size, cold on the first run with the
+# shared painter data built again and warm on the others. With --baseline the run exits with
+# status 1 when a stage got slower than the baseline by more than the threshold.
+
+import argparse
+import json
+import math
+import os
+import sys
+
+import bpy
+import bmesh
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import PainterEffect
+
+# subdivision level of each size, the meshes grow roughly fourfold per step. huge, about
+# 250k to 1.2M faces depending on the mesh, is production scale and only runs when asked for.
+SIZES = {"small": 4, "medium": 8, "large": 16, "huge": 128}
+DEFAULT_SIZES = ["small", "medium", "large"]
+# differences below this many seconds are noise, not regressions
+NOISE_FLOOR = 0.01
+# the stroke image next to this script, found through its folder
+STROKE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+STROKE_IMAGE = "marker.png"
+# the modifiers preview a quarter of the strokes in the viewport; the benchmark evaluates
+# all of them, like a render
+VIEWPORT_DENSITY = 1.0
+
+
+
+def mesh_from_bmesh(name, bm):
+    mesh = bpy.data.meshes.new(name)
+    bm.to_mesh(mesh)
+    bm.free()
+    return mesh
+
+
+
+def subdivided_cube(name, level):
+    bm = bmesh.new()
+    bmesh.ops.create_cube(bm, size=2.0)
+    bmesh.ops.subdivide_edges(bm, edges=bm.edges, cuts=level * 2, use_grid_fill=True)
+    return mesh_from_bmesh(name, bm)
+
+
+
+# quad rings between two triangle fans around the poles
+def uv_sphere(name, level):
+    bm = bmesh.new()
+    bmesh.ops.create_uvsphere(bm, u_segments=level * 8, v_segments=level * 4, radius=1.0)
+    return mesh_from_bmesh(name, bm)
+
+
+
+def torus(name, level):
+    major, minor = level * 12, level * 6
+    u, v = np.meshgrid(np.linspace(0, 2 * math.pi, major, endpoint=False),
+                       np.linspace(0, 2 * math.pi, minor, endpoint=False), indexing="ij")
+    ring = 1.0 + 0.25 * np.cos(v)
+    verts = np.stack([ring * np.cos(u), ring * np.sin(u), 0.25 * np.sin(v)], axis=-1).reshape(-1, 3)
+    i, j = np.meshgrid(np.arange(major), np.arange(minor), indexing="ij")
+    faces = np.stack([i * minor + j, ((i + 1) % major) * minor + j,
+                      ((i + 1) % major) * minor + (j + 1) % minor, i * minor + (j + 1) % minor], axis=-1)
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(verts.tolist(), [], faces.reshape(-1, 4).tolist())
+    mesh.update()
+    return mesh
+
+
+
+def triangulated_cube(name, level):
+    bm = bmesh.new()
+    bmesh.ops.create_cube(bm, size=2.0)
+    bmesh.ops.subdivide_edges(bm, edges=bm.edges, cuts=level * 2, use_grid_fill=True)
+    bmesh.ops.triangulate(bm, faces=bm.faces)
+    return mesh_from_bmesh(name, bm)
+
+
+
+# quad sides with one n-gon cap at each end
+def ngon_cylinder(name, level):
+    bm = bmesh.new()
+    bmesh.ops.create_cone(bm, cap_ends=True, cap_tris=False, segments=level * 8,
+                          radius1=1.0, radius2=1.0, depth=2.0)
+    side_edges = [e for e in bm.edges if abs(e.verts[0].co.z - e.verts[1].co.z) > 1e-6]
+    bmesh.ops.subdivide_edges(bm, edges=side_edges, cuts=level * 2, use_grid_fill=True)
+    return mesh_from_bmesh(name, bm)
+
+
+MESHES = {
+    "cube": subdivided_cube,
+    "uv_sphere": uv_sphere,
+    "torus": torus,
+    "triangles": triangulated_cube,
+    "ngon_cylinder": ngon_cylinder,
+}
+
+
+
+# remove what applies share between objects: the tangent group, brush materials and
+# card, so the next run builds them again
+def clear_shared_data():
+    PainterEffect.node_group_signatures.clear()
+    for node_tree in [n for n in bpy.data.node_groups if PainterEffect.is_copy_of(n.name, PainterEffect.CURVE_TANGENT_NAME)]:
+        bpy.data.node_groups.remove(node_tree)
+    for material in [m for m in bpy.data.materials if m.name.startswith(PainterEffect.SHADER_NAME)]:
+        bpy.data.materials.remove(material)
+    card = bpy.data.objects.get(PainterEffect.CARD_NAME)
+    if card is not None:
+        mesh = card.data
+        bpy.data.objects.remove(card)
+        bpy.data.meshes.remove(mesh)
+
+
+
+# run the pipeline once on a fresh object, timing every stage. A cold run also builds the
+# shared data again, a warm one reuses what the previous run left.
+def run_case(mesh_func, name, level, args, cold):
+    if cold:
+        clear_shared_data()
+    mesh = mesh_func(name, level)
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+
+    # start from an empty guide cache so every repeat traces the mesh again
+    PainterEffect.guide_loop_cache = PainterEffect.GuideLoopCache(PainterEffect.GUIDE_CACHE_BYTES)
+    builder = PainterEffect.PainterEffectBatch()
+    builder.curve_engine = args.engine
+    builder.worker_count = 1
+    builder.profile = PainterEffect.PainterProfile()
+    builder.stroke_folders = (STROKE_FOLDER,)
+    builder.apply_to_objects([obj], bpy.context.scene.collection, STROKE_IMAGE)
+    modifier = PainterEffect.get_painter_modifier(obj)
+    modifier[PainterEffect.find_input_socket(modifier.node_group, "Viewport Density").identifier] = VIEWPORT_DENSITY
+
+    with builder.timed_stage("depsgraph evaluation"):
+        depsgraph = bpy.context.evaluated_depsgraph_get()
+        depsgraph.update()
+    with builder.timed_stage("count instances"):
+        builder.count_instances(depsgraph, [obj])
+    totals = builder.profile.totals()
+    stats = {"vertices": len(mesh.vertices), "faces": len(mesh.polygons), "instances": totals["counters"]["instances"]}
+
+    for child in obj.children:
+        bpy.data.objects.remove(child)
+    bpy.data.node_groups.remove(obj.modifiers["GeometryNodes"].node_group)
+    bpy.data.objects.remove(obj)
+    bpy.data.meshes.remove(mesh)
+    return totals["stages"], stats
+
+
+
+def run_benchmark(args):
+    cases = {}
+    for mesh_name in args.meshes:
+        for size in args.sizes:
+            case = f"{mesh_name}_{size}"
+            # the first run is cold, the fastest of the others counts as warm
+            cold, stats = run_case(MESHES[mesh_name], case, SIZES[size], args, cold=True)
+            best = {}
+            for _ in range(args.repeat - 1):
+                timings, stats = run_case(MESHES[mesh_name], case, SIZES[size], args, cold=False)
+                for stage, seconds in timings.items():
+                    best[stage] = min(seconds, best.get(stage, math.inf))
+            cases[case] = dict(stats, cold_stages=cold, stages=best or cold)
+            print(f"{case:<24} {stats['faces']:>8} faces {stats['instances']:>9} instances "
+                  f"{sum(cold.values()):8.3f}s cold {sum((best or cold).values()):8.3f}s warm")
+    return {"blender": bpy.app.version_string, "engine": args.engine, "repeat": args.repeat,
+            "viewport density": VIEWPORT_DENSITY, "cases": cases}
+
+
+
+# stages slower than the baseline by more than threshold, as printable lines
+def find_regressions(results, baseline, threshold):
+    regressions = []
+    for case, entry in results["cases"].items():
+        for kind in ("cold_stages", "stages"):
+            base_stages = baseline.get("cases", {}).get(case, {}).get(kind, {})
+            for stage, seconds in entry.get(kind, {}).items():
+                base = base_stages.get(stage)
+                if base is not None and seconds > base * (1 + threshold) and seconds - base > NOISE_FLOOR:
+                    label = f"{stage} (cold)" if kind == "cold_stages" else stage
+                    regressions.append(f"{case} {label}: {base:.3f}s -> {seconds:.3f}s")
+    return regressions
+
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="blender -b --python benchmark.py --",
+                                     description="Time the painter effect stages on generated meshes.")
+    parser.add_argument("--out", required=True, help="JSON file to write the timings to")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown against the baseline, 0.2 is 20%%")
+    parser.add_argument("--meshes", nargs="+", choices=list(MESHES), default=list(MESHES))
+    parser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=DEFAULT_SIZES,
+                        help="mesh sizes to run, huge is left out unless listed")
+    parser.add_argument("--engine", choices=["NUMPY", "BMESH", "FIELD"], default="NUMPY")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case: the first is timed cold, the fastest of the others warm")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args)
+    with open(args.out, "w") as file:
+        json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = find_regressions(results, json.load(file), args.threshold)
+        for line in regressions:
+            print("regression:", line)
+        if regressions:
+            sys.exit(1)
+
+
+
+if __name__ == "__main__":
+    main(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
@@ -0,0 +1,90 @@
+# Tests of the painter effect add-on. They need Blender's bpy module:
+#
+#   blender -b --factory-startup --python-expr "import pytest, sys; sys.exit(pytest.main(['tests']))"
+
+import os
+import sys
+
+import pytest
+
+bpy = pytest.importorskip("bpy")
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import PainterEffect
+
+STROKE_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STROKE_IMAGE = "marker.png"
+
+
+
+# a subdivided grid of quads, or of triangles with triangulate
+def grid_object(name, size=10, triangulate=False):
+    x, y = np.meshgrid(np.arange(size + 1), np.arange(size + 1), indexing="ij")
+    verts = np.stack([x.ravel(), y.ravel(), np.zeros(x.size)], axis=-1) / size
+    i, j = np.meshgrid(np.arange(size), np.arange(size), indexing="ij")
+    a, b = i * (size + 1) + j, (i + 1) * (size + 1) + j
+    if triangulate:
+        faces = np.concatenate([np.stack([a, b, b + 1], axis=-1).reshape(-1, 3),
+                                np.stack([a, b + 1, a + 1], axis=-1).reshape(-1, 3)])
+    else:
+        faces = np.stack([a, b, b + 1, a + 1], axis=-1).reshape(-1, 4)
+    mesh = bpy.data.meshes.new(name)
+    mesh.from_pydata(verts.tolist(), [], faces.tolist())
+    mesh.update()
+    obj = bpy.data.objects.new(name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+    return obj
+
+
+
+def apply(objs):
+    builder = PainterEffect.PainterEffectBatch()
+    builder.stroke_folders = (STROKE_FOLDER,)
+    builder.apply_to_objects(objs, bpy.context.scene.collection, STROKE_IMAGE)
+    return builder
+
+
+
+def test_reapply_shared_tree_keeps_guide_curves():
+    first = grid_object("shared_first")
+    apply([first])
+    second = first.copy() # linked duplicate: same mesh, same modifier tree
+    bpy.context.scene.collection.objects.link(second)
+
+    apply([first, second])
+    curves = {obj.name for obj in bpy.data.objects if obj.type == 'CURVE'}
+    apply([first, second])
+
+    assert {obj.name for obj in bpy.data.objects if obj.type == 'CURVE'} == curves
+    assert PainterEffect.get_painter_modifier(first).node_group != PainterEffect.get_painter_modifier(second).node_group
+    builder = PainterEffect.PainterEffectBatch()
+    for obj in (first, second):
+        assert builder.find_guide_curve(obj) is not None
+
+
+
+def test_triangulated_grid_traces_field():
+    obj = grid_object("triangulated_grid", triangulate=True)
+    builder = PainterEffect.PainterEffectBatch()
+    # the stray edge loop through a few vertices must not stop the field fallback
+    for loops, counters in (PainterEffect.trace_guide_loops(builder.create_guide_job(obj)),
+                            builder.trace_bmesh_guide_loops(obj)):
+        assert counters.get("field vertices", 0) >= len(obj.data.vertices) // 2
+        assert len(loops) > 1
+
+
+
+def test_island_without_guide_loop_gets_tangents():
+    # two 10x10 grids side by side, the guide loop only runs over the first
+    x, y = np.meshgrid(np.arange(10.0), np.arange(10.0), indexing="ij")
+    grid = np.stack([x.ravel(), y.ravel(), np.zeros(x.size)], axis=-1)
+    coords = np.concatenate([grid, grid + (20.0, 0.0, 0.0)])
+    index = np.arange(100).reshape(10, 10)
+    edges = np.concatenate([np.stack([index[:-1].ravel(), index[1:].ravel()], axis=-1),
+                            np.stack([index[:, :-1].ravel(), index[:, 1:].ravel()], axis=-1)])
+    edges = np.concatenate([edges, edges + 100])
+
+    tangents = PainterEffect.bake_guide_tangents(coords, edges, [index[:, 5].tolist()])
+    assert np.all(np.linalg.norm(tangents, axis=1) > 0.5)
+    assert np.all(np.abs(tangents[100:, 0]) > 0.9) # along the guide loop of the first grid